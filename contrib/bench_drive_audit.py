@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Info:
+#   Benchmark of the kern.log scan of swift-drive-audit-nextgen. A
+#   synthetic kernel log of SIZE MB (2GB by default) is generated, then
+#   the errors found by the full scan (get_errors) and by the incremental
+#   scan (LogCursor) are compared and both are timed: on the whole log,
+#   after lines have been appended, after a rotation and after a
+#   truncation. Expect the default run to take about 15 minutes, most
+#   of it spent in the two full scans.
+#
+# Usage:
+#   bench_drive_audit.py [-s SCRIPT] [-d WORK_DIR] [-m SIZE]
+#
+
+import os
+import imp
+import sys
+import time
+import random
+import datetime
+from optparse import OptionParser
+
+
+SCRIPT = 'templates/storage/usr/local/bin/swift-drive-audit-nextgen'
+
+"Window wide enough to stay put while a multi-GB log is fully scanned"
+MINUTES = 60
+
+
+def log_lines(count, start, step):
+    """
+    Yields count kernel log lines starting at start, step apart, with
+    about one in a thousand being a drive error
+
+    :param count: Number of lines
+    :param start: Time of the first line
+    :param step: timedelta between two lines
+    """
+    stamp = start
+    second = None
+    for i in xrange(count):
+        if stamp.replace(microsecond=0) != second:
+            second = stamp.replace(microsecond=0)
+            ts = stamp.strftime('%b %d %H:%M:%S')
+        r = random.random()
+        if r < 0.001:
+            yield ('%s host kernel: [ 12.3] end_request: I/O error, '
+                   'dev sd%s, sector 1\n' % (ts, random.choice('bcd')))
+        elif r < 0.002:
+            yield ('%s host kernel: [ 12.3] sd%s: error on write\n'
+                   % (ts, random.choice('bcd')))
+        else:
+            yield ('%s host kernel: [ 12.3] eth0: link is up, some '
+                   'padding text\n' % ts)
+        stamp += step
+
+
+def write_lines(path, lines, mode='w'):
+    """
+    Writes the lines to path in chunks, so that multi-GB logs are not
+    held in memory
+    """
+    chunk = []
+    with open(path, mode) as f:
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= 100000:
+                f.writelines(chunk)
+                chunk = []
+        f.writelines(chunk)
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def incremental(audit, state_file, log_file):
+    cursor = audit.LogCursor(state_file, log_file)
+    cursor.update()
+    errors = cursor.errors(MINUTES)
+    cursor.save()
+    return errors, cursor
+
+
+def main():
+    p = OptionParser()
+    p.add_option('-s', '--script', default=SCRIPT,
+                 help='Drive audit script [default: %default]')
+    p.add_option('-d', '--dir', default='/tmp/bench-drive-audit',
+                 help='Work directory [default: %default]')
+    p.add_option('-m', '--size', type='int', default=2048,
+                 help='MB of synthetic log [default: %default]')
+    options, args = p.parse_args()
+
+    audit = imp.load_source('swift_drive_audit', options.script)
+    if not os.path.isdir(options.dir):
+        os.makedirs(options.dir)
+    log_file = os.path.join(options.dir, 'kern.log')
+    state_file = os.path.join(options.dir, 'drive-audit.state')
+    for path in (log_file, log_file + '.1', state_file):
+        if os.path.exists(path):
+            os.remove(path)
+
+    "Line count worked out from the average line length of a sample"
+    sample = list(log_lines(10000, datetime.datetime.now(),
+                            datetime.timedelta(0)))
+    n = int(options.size * 1048576.0 * len(sample) / len(''.join(sample)))
+
+    "Errors are kept clear of the window edge, the full scan is slow"
+    now = datetime.datetime.now()
+    write_lines(log_file, log_lines(n * 9 / 10,
+                                    now - datetime.timedelta(hours=6),
+                                    datetime.timedelta(seconds=14400.0 / n)))
+    write_lines(log_file, log_lines(n / 10,
+                                    now - datetime.timedelta(minutes=10),
+                                    datetime.timedelta(seconds=600.0 / n)),
+                'a')
+    print 'Log size: %.1fMB (%d lines), generated in %.0fs' % (
+        os.path.getsize(log_file) / 1048576.0, n,
+        (datetime.datetime.now() - now).total_seconds())
+
+    full, secs = timed(audit.get_errors, MINUTES, log_file)
+    print 'Full scan: %.3fs %s' % (secs, full)
+    (inc, cursor), secs = timed(incremental, audit, state_file, log_file)
+    print 'First incremental scan: %.3fs %s' % (secs, inc)
+    if full != inc:
+        print 'MISMATCH'
+        return 1
+
+    write_lines(log_file, log_lines(20000, now, datetime.timedelta(0)),
+                'a')
+    full, secs = timed(audit.get_errors, MINUTES, log_file)
+    print 'Full scan after append: %.3fs' % secs
+    (inc, cursor), secs = timed(incremental, audit, state_file, log_file)
+    print 'Incremental scan after append: %.3fs' % secs
+    if full != inc:
+        print 'MISMATCH %s %s' % (full, inc)
+        return 1
+
+    "Rotation with lines still written to the old file, then truncation"
+    more = list(log_lines(5000, now, datetime.timedelta(0)))
+    os.rename(log_file, log_file + '.1')
+    with open(log_file + '.1', 'a') as f:
+        f.writelines(more[:2500])
+    with open(log_file, 'w') as f:
+        f.writelines(more[2500:])
+    (inc, cursor), secs = timed(incremental, audit, state_file, log_file)
+    print 'Incremental scan after rotation: %.3fs %s' % (secs, inc)
+    with open(log_file, 'w') as f:
+        f.writelines(more[:100])
+    (inc, cursor), secs = timed(incremental, audit, state_file, log_file)
+    if cursor.offset != os.path.getsize(log_file):
+        print 'Truncated log not read from the start'
+        return 1
+    print 'Incremental scan after truncation: %.3fs' % secs
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
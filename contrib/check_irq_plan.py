@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Info:
+#   Runs the NIC irq affinity planner of swift_setup.node.irqtune against
+#   captured GATHER_COMMAND output (the /sys/class/net queue counts
+#   followed by /proc/interrupts). With no fixture given, the captures
+#   under contrib/irq_fixtures are planned and checked against their
+#   expected masks. With a fixture given (e.g: the output of
+#   GATHER_COMMAND saved from a real node), its plan and the script
+#   that would be installed are printed.
+#
+# Usage:
+#   PYTHONPATH=. contrib/check_irq_plan.py [-r RESERVED] [-i IFACES] [FILE]
+#
+
+import os
+import sys
+from optparse import OptionParser
+from swift_setup.node.irqtune import IrqTuner, affinity_script
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'irq_fixtures')
+
+"""
+Expected plans of the bundled fixtures: (reserved cpus, plan)
+"""
+EXPECTED = {
+    '8cpu-eth0x4.gather': ('0-1', {
+        'eth0': {
+            'vectors': [('eth0-TxRx-0', '4'), ('eth0-TxRx-1', '8'),
+                        ('eth0-TxRx-2', '10'), ('eth0-TxRx-3', '20')],
+            'rps': [(0, '44'), (1, '88'), (2, '10'), (3, '20')],
+            'xps': [(0, '44'), (1, '88'), (2, '10'), (3, '20')],
+        },
+    }),
+    '4cpu-eth2x8.gather': ('', {
+        'eth2': {
+            'vectors': [('eth2-rx-0', '1'), ('eth2-tx-0', '1'),
+                        ('eth2-rx-1', '2'), ('eth2-tx-1', '2'),
+                        ('eth2-rx-2', '4'), ('eth2-tx-2', '4'),
+                        ('eth2-rx-3', '8'), ('eth2-tx-3', '8'),
+                        ('eth2-rx-4', '1'), ('eth2-tx-4', '1'),
+                        ('eth2-rx-5', '2'), ('eth2-tx-5', '2'),
+                        ('eth2-rx-6', '4'), ('eth2-tx-6', '4'),
+                        ('eth2-rx-7', '8'), ('eth2-tx-7', '8')],
+            'rps': [(q, '0') for q in range(8)],
+            'xps': [(q, '%x' % (1 << (q % 4))) for q in range(8)],
+        },
+    }),
+}
+
+
+def plan_file(path, reserved='', interfaces=''):
+    with open(path, 'r') as f:
+        return IrqTuner(reserved, interfaces).plan(f.read())
+
+
+def check_fixtures():
+    failed = 0
+    for name in sorted(EXPECTED):
+        reserved, expected = EXPECTED[name]
+        plan = plan_file(os.path.join(FIXTURE_DIR, name), reserved)
+        if plan == expected:
+            print 'ok   %s (reserved: %s)' % (name, reserved or 'none')
+            continue
+        failed += 1
+        print 'FAIL %s (reserved: %s)' % (name, reserved or 'none')
+        for iface in sorted(set(plan) | set(expected)):
+            print '     expected %s: %s' % (iface, expected.get(iface))
+            print '     planned  %s: %s' % (iface, plan.get(iface))
+    return 1 if failed else 0
+
+
+def main():
+    p = OptionParser(usage='%prog [options] [FILE]')
+    p.add_option('-r', '--reserved', default='',
+                 help='cpu list kept free of network interrupts')
+    p.add_option('-i', '--interfaces', default='',
+                 help='Space separated interfaces to tune')
+    options, args = p.parse_args()
+    if not args:
+        return check_fixtures()
+
+    plan = plan_file(args[0], options.reserved, options.interfaces)
+    if not plan:
+        print 'No multi-queue interface to tune'
+        return 0
+    for iface in sorted(plan):
+        print iface
+        for kind in ('vectors', 'rps', 'xps'):
+            print '  %-8s %s' % (kind, ' '.join(['%s=%s' % v for v in
+                                                 plan[iface][kind]]))
+    print
+    print affinity_script(plan)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
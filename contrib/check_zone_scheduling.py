@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Info:
+#   Checks the zone caps of the rolling deploy scheduler against a zone
+#   map built by generate_zone_map from a throwaway base directory:
+#   storage nodes placed by the zone1 host group file or by their name
+#   (-zN), plus proxies and storage nodes that cannot be placed. Zoned
+#   hosts must be capped per zone while the hosts left out of the map
+#   must only be limited by the overall concurrency.
+#
+# Usage:
+#   PYTHONPATH=. contrib/check_zone_scheduling.py
+#
+
+import os
+import sys
+import shutil
+import tempfile
+from swift_setup.common.utils import generate_zone_map
+from swift_setup.node.scheduler import DeployScheduler
+
+
+def check(name, result, expected):
+    ok = result == expected
+    print '%-4s %s: %r' % ('ok' if ok else 'FAIL', name, result)
+    return ok
+
+
+def main():
+    base_dir = tempfile.mkdtemp(prefix='swift-setup-zones.')
+    try:
+        os.mkdir(base_dir + '/hosts')
+        with open(base_dir + '/hosts/zone1', 'w') as f:
+            f.write('storage1\nstorage2\n')
+        hosts = ['proxy1', 'proxy2', 'proxy3', 'storage1', 'storage2',
+                 'storage3-z2', 'storage4-z2', 'storage5']
+        zone_map = generate_zone_map(base_dir, hosts)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    results = [check('zone map', zone_map,
+                     {'storage1': 'zone1', 'storage2': 'zone1',
+                      'storage3-z2': 'zone2', 'storage4-z2': 'zone2'})]
+
+    s = DeployScheduler(concurrency=5, zone_concurrency=1,
+                        zone_map=zone_map)
+    results.append(check('proxy next to a proxy in flight',
+                         s._next_host(['proxy2'], {'proxy1': None}),
+                         'proxy2'))
+    results.append(check('unzoned storage next to one in flight',
+                         s._next_host(['storage5'], {'proxy1': None}),
+                         'storage5'))
+    results.append(check('zone1 host next to zone1 in flight',
+                         s._next_host(['storage2'], {'storage1': None}),
+                         None))
+    results.append(check('zone2 host next to zone1 in flight',
+                         s._next_host(['storage2', 'storage3-z2'],
+                                      {'storage1': None}),
+                         'storage3-z2'))
+
+    "First hosts started from a single wave with the zone caps applied"
+    pending = list(s._split_waves(hosts)[0])
+    in_flight = {}
+    while pending and len(in_flight) < s.concurrency:
+        host = s._next_host(pending, in_flight)
+        if host is None:
+            break
+        pending.remove(host)
+        in_flight[host] = None
+    results.append(check('first slots filled', sorted(in_flight),
+                         ['proxy1', 'proxy2', 'proxy3', 'storage1',
+                          'storage3-z2']))
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
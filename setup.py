@@ -11,7 +11,8 @@ try:
 except ImportError:
     install_requires.append("fabric")
 
-data_files = [('/etc/swift-setup', ['etc/swift-setup.conf-sample']),
+data_files = [('/etc/swift-setup', ['etc/swift-setup.conf-sample',
+                                   'etc/rings.inventory-sample']),
               ('/etc/swift-setup/hosts', ['etc/hosts/generic',
                                           'etc/hosts/admin',
                                           'etc/hosts/proxy',
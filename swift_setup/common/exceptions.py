@@ -63,3 +63,10 @@ class UploadTemplatesError(ResponseError):
     Raised when something goes wrong uploading templates
     """
     pass
+
+
+class RingBuilderError(ResponseError):
+    """
+    Raised when something goes wrong managing the ring builders.
+    """
+    pass
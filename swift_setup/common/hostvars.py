@@ -0,0 +1,205 @@
+""" See COPYING for license information """
+
+import os
+import ast
+import operator
+from swift_setup.common.exceptions import ConfigFileError, ConfigSyncError
+from swift_setup.common.placeholders import PLACEHOLDER_RE
+
+
+"Marker of the lines printed by FACTS_COMMAND"
+FACT_MARKER = '__SWIFT_SETUP_FACT__'
+
+"""
+Shell command that prints the hardware facts of a system, one per line
+as "MARKER name value". nic_queues is the highest number of rx queues
+of the physical interfaces and drives the number of disks other than
+the one holding the root filesystem.
+"""
+FACTS_COMMAND = '; '.join([
+    'echo "%(m)s cores $(nproc)"',
+    'echo "%(m)s mem_kb $(awk \'/^MemTotal:/ {print $2}\' /proc/meminfo)"',
+    'q=$(for n in /sys/class/net/*; do [ -e $n/device ] && '
+    'ls -d $n/queues/rx-* 2>/dev/null | wc -l; done | sort -n | '
+    'tail -n 1); echo "%(m)s nic_queues ${q:-1}"',
+    'r=$(basename $(df -P / | awk \'NR==2 {print $1}\') | '
+    'sed \'s/p\\?[0-9]*$//\'); echo "%(m)s drives $(ls -d /sys/block/sd* '
+    '/sys/block/vd* /sys/block/xvd* /sys/block/nvme* 2>/dev/null | '
+    'grep -vx "/sys/block/$r" | wc -l)"',
+]) % {'m': FACT_MARKER}
+
+"Operators and functions allowed on the formulas"
+_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+_FUNCTIONS = {'min': min, 'max': max, 'int': int, 'round': round}
+
+
+def host_var_names(conf):
+    """
+    Returns the names of the variables that are rendered on each host,
+    that is every key of the host_vars and host_vars:<type> sections
+
+    :param conf: Dictionary of all config sections (see readconf)
+    """
+    names = set()
+    for section, values in conf.items():
+        if section == 'host_vars' or section.startswith('host_vars:'):
+            names.update(values.keys())
+    return names
+
+
+def read_formulas(conf, sys_type):
+    """
+    Returns the formulas of the host variables for the given node type.
+    The host_vars:<type> section overrides the formulas of host_vars.
+
+    :param conf: Dictionary of all config sections (see readconf)
+    :param sys_type: Node type (admin, proxy, storage, saio, generic)
+    """
+    formulas = dict(conf.get('host_vars', {}))
+    formulas.update(conf.get('host_vars:%s' % sys_type, {}))
+    return formulas
+
+
+def parse_facts(output):
+    """
+    Parses the output of FACTS_COMMAND into a dictionary of name to
+    integer value. mem_mb is added for convenience.
+
+    :param output: Output of FACTS_COMMAND
+    """
+    facts = {}
+    for line in output.splitlines():
+        parts = line.strip().split()
+        if len(parts) == 3 and parts[0] == FACT_MARKER and \
+                parts[2].isdigit():
+            facts[parts[1]] = int(parts[2])
+    if 'mem_kb' in facts:
+        facts['mem_mb'] = facts['mem_kb'] // 1024
+    return facts
+
+
+def _evaluate(node, names):
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body, names)
+    if isinstance(node, ast.Num):
+        return node.n
+    if isinstance(node, ast.Name) and node.id in names:
+        return names[node.id]
+    if isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+        return _OPERATORS[type(node.op)](_evaluate(node.left, names),
+                                         _evaluate(node.right, names))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _OPERATORS:
+        return _OPERATORS[type(node.op)](_evaluate(node.operand, names))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and \
+            node.func.id in _FUNCTIONS and not node.keywords and \
+            not node.starargs and not node.kwargs:
+        return _FUNCTIONS[node.func.id](*[_evaluate(a, names)
+                                          for a in node.args])
+    if isinstance(node, ast.Name):
+        raise NameError(node.id)
+    raise ValueError(ast.dump(node))
+
+
+def evaluate(formula, names):
+    """
+    Evaluates an arithmetic formula such as "max(2, cores / 2)". Only
+    numbers, the given names, + - * / // ** and min, max, int and
+    round are allowed.
+
+    :param formula: Formula as found in the config file
+    :param names: Dictionary of name to value usable on the formula
+    """
+    return _evaluate(ast.parse(formula.strip(), mode='eval'), names)
+
+
+def derive_values(formulas, facts):
+    """
+    Returns the value of every host variable for a system, rounded to
+    an integer and as a string ready to be rendered
+
+    :param formulas: Dictionary of variable name to formula
+    :param facts: Hardware facts of the system (see parse_facts)
+    """
+    values = {}
+    for name, formula in sorted(formulas.items()):
+        try:
+            values[name] = str(int(round(evaluate(formula, facts))))
+        except NameError as e:
+            status = 500
+            msg = ('Host variable %s uses an unknown fact %s (facts: %s)'
+                   % (name, e, ', '.join(sorted(facts))))
+            raise ConfigSyncError(status, msg)
+        except (SyntaxError, ValueError, TypeError,
+                ZeroDivisionError) as e:
+            status = 500
+            msg = 'Invalid formula for host variable %s [%s]' % (name,
+                                                                 formula)
+            raise ConfigFileError(status, msg)
+    return values
+
+
+def host_var_files(root, trees, names):
+    """
+    Returns the (tree, path, names) of the rendered files that still
+    hold any of the host variables, names being the ones found on it
+
+    :param root: Directory holding the rendered trees
+    :param trees: List of trees synced to the system
+    :param names: Names of the host variables (lower case)
+    """
+    found = []
+    for tree in trees:
+        base = os.path.join(root, tree)
+        for dirpath, dirs, files in os.walk(base):
+            dirs[:] = [d for d in dirs if d != '.git']
+            for name in sorted(files):
+                path = os.path.join(dirpath, name)
+                with open(path, 'rb') as f:
+                    body = f.read()
+                used = set()
+                for m in PLACEHOLDER_RE.finditer(body):
+                    if (m.group(1) or m.group(2)).lower() in names:
+                        used.add((m.group(1) or m.group(2)).lower())
+                if used:
+                    found.append((tree, os.path.relpath(path, base), used))
+    return sorted(found)
+
+
+def render_host_vars(body, values):
+    """
+    Returns body with the host variables replaced by their values
+
+    :param body: Contents of a rendered file
+    :param values: Dictionary of variable name (lower case) to value
+    """
+    def _sub(m):
+        return values.get((m.group(1) or m.group(2)).lower(), m.group(0))
+    return PLACEHOLDER_RE.sub(_sub, body)
+
+
+def substitute_command(root, files, values):
+    """
+    Returns the shell command that renders the host variables in place
+    on the checkout of a system, or None if there is nothing to render
+
+    :param root: Directory holding the trees (e.g: /root/local)
+    :param files: List of (tree, path, names) from host_var_files
+    :param values: Dictionary of variable name (lower case) to value
+    """
+    if not files or not values:
+        return None
+    exprs = []
+    for name, value in sorted(values.items()):
+        exprs.append("-e 's/[$]%s\\b/%s/g' -e 's/[$]{%s}/%s/g'"
+                     % (name.upper(), value, name.upper(), value))
+    paths = ['%s/%s/%s' % (root, tree, path) for tree, path, n in files]
+    return 'sed -i %s %s' % (' '.join(exprs), ' '.join(paths))
@@ -0,0 +1,152 @@
+""" See COPYING for license information """
+
+import os
+from hashlib import md5
+
+
+"Files that are never synced over to the systems"
+IGNORED = ('.git', '.ignore', '.initialized')
+
+"""
+Path prefixes (relative to /) of the synced files and the services
+that must be restarted when any of them changes. When several prefixes
+match a path, the longest one wins.
+"""
+SERVICE_MAP = [
+    ('etc/swift/', 'swift'),
+    ('etc/rsyncd.conf', 'rsync'),
+    ('etc/default/rsync', 'rsync'),
+    ('etc/sysctl.d/', 'procps'),
+    ('etc/ntp.conf', 'ntp'),
+    ('etc/exim4/', 'exim4'),
+    ('etc/aliases', 'aliases'),
+    ('etc/syslog-ng/', 'syslog-ng'),
+    ('etc/memcached.conf', 'memcached'),
+    ('etc/default/memcached', 'memcached'),
+    ('etc/snmp/', 'snmpd'),
+    ('etc/nginx/', 'nginx'),
+    ('etc/default/git-daemon', 'git-daemon'),
+    ('etc/swift/storage-agent.conf', 'storage-agent'),
+    ('etc/init.d/swift-storage-agent', 'storage-agent'),
+    ('usr/local/bin/swift-storage-agent', 'storage-agent'),
+    ('usr/local/bin/swift-drive-audit-nextgen', 'storage-agent'),
+    ('usr/local/bin/drive_mount_check.py', 'storage-agent'),
+]
+
+"Services always restarted the first time configs are applied to a system"
+FIRST_INSTALL_SERVICES = ['procps', 'ntp', 'exim4', 'aliases', 'syslog-ng',
+                          'swift']
+
+"Commands used to restart each of the services above"
+RESTART_CMDS = {
+    'swift': 'swift-init all restart',
+    'rsync': 'service rsync restart',
+    'procps': 'service procps restart',
+    'ntp': 'service ntp restart',
+    'exim4': 'service exim4 restart',
+    'aliases': 'newaliases',
+    'syslog-ng': 'service syslog-ng restart',
+    'memcached': 'service memcached restart',
+    'snmpd': 'service snmpd restart',
+    'nginx': 'service nginx restart',
+    'git-daemon': 'service git-daemon restart',
+    'storage-agent': 'service swift-storage-agent restart',
+}
+
+
+def manifest_command(root, trees):
+    """
+    Returns the shell command that generates the manifest of the given
+    trees on a remote system. The output format is the one of md5sum,
+    with every path prefixed by the tree it belongs to.
+
+    :param root: Directory holding the trees (e.g: /root/local)
+    :param trees: List of trees in the order they are synced
+    """
+    cmds = []
+    for tree in trees:
+        cmds.append("find %s -type f ! -path '*/.git/*' ! -name .ignore "
+                    "-print0 | sort -z | xargs -0 -r md5sum" % tree)
+    return 'cd %s && { %s; }' % (root, '; '.join(cmds))
+
+
+def generate_manifest(root, trees):
+    """
+    Python version of manifest_command, used on local template trees
+
+    :param root: Directory holding the trees
+    :param trees: List of trees in the order they are synced
+    """
+    lines = []
+    for tree in trees:
+        base = os.path.join(root, tree)
+        paths = []
+        for dirpath, dirs, files in os.walk(base):
+            dirs[:] = [d for d in dirs if d not in IGNORED]
+            for name in files:
+                if name not in IGNORED:
+                    paths.append(os.path.join(dirpath, name))
+        for path in sorted(paths):
+            with open(path, 'rb') as f:
+                digest = md5(f.read()).hexdigest()
+            lines.append('%s  %s' % (digest, os.path.relpath(path, root)))
+    return '\n'.join(lines)
+
+
+def parse_manifest(text):
+    """
+    Parses a manifest into a dictionary of destination path (relative
+    to /) to a tuple of (md5, tree). Trees synced later override the
+    files of the earlier ones, just like the rsync calls do.
+
+    :param text: Manifest contents
+    """
+    manifest = {}
+    for line in text.splitlines():
+        parts = line.strip().split(None, 1)
+        if len(parts) != 2 or len(parts[0]) != 32:
+            continue
+        path = parts[1].lstrip('./')
+        if '/' not in path:
+            continue
+        tree, dest = path.split('/', 1)
+        manifest[dest] = (parts[0], tree)
+    return manifest
+
+
+def changed_files(old, new):
+    """
+    Returns the files of the new manifest that are not in the old one
+    or whose content has changed, grouped by tree
+
+    :param old: Parsed manifest that was last applied
+    :param new: Parsed manifest about to be applied
+    """
+    changes = {}
+    for dest, (digest, tree) in new.items():
+        if old.get(dest, (None, None))[0] != digest:
+            changes.setdefault(tree, []).append(dest)
+    for tree in changes:
+        changes[tree].sort()
+    return changes
+
+
+def services_for(paths):
+    """
+    Maps changed paths to the services that need a restart. Each path
+    goes to the service of the longest matching prefix only, so that
+    etc/swift/storage-agent.conf restarts the storage agent and not
+    every swift service as etc/swift/ would.
+
+    :param paths: List of paths relative to /
+    """
+    services = set()
+    for path in paths:
+        match = None
+        for prefix, service in SERVICE_MAP:
+            if path.startswith(prefix) and \
+                    (match is None or len(prefix) > len(match[0])):
+                match = (prefix, service)
+        if match:
+            services.add(match[1])
+    return sorted(services)
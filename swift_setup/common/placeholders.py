@@ -0,0 +1,156 @@
+""" See COPYING for license information """
+
+import os
+import re
+import json
+from hashlib import md5
+from swift_setup.common.exceptions import TemplateFileError
+
+
+"$NAME or ${NAME} with NAME in upper case, like the config keys"
+PLACEHOLDER_RE = re.compile(
+    r'\$(?:\{([A-Z][A-Z0-9_]*)\}|([A-Z][A-Z0-9_]*)(?![A-Za-z0-9_]))')
+
+
+def is_script(path, head):
+    """
+    Shell scripts use $NAME for their own variables, so only the names
+    found in the config are taken as placeholders in them
+
+    :param path: File location
+    :param head: First bytes of the file
+    """
+    return (head.startswith('#!') or path.endswith('.sh') or
+            '/init.d/' in path)
+
+
+class PlaceholderIndex(object):
+    """
+    Index of every $PLACEHOLDER found on the template tree, with the
+    file, variable and offset of each occurrence, along with the md5 of
+    every file. The index is kept on disk and only files whose size or
+    mtime have changed are scanned again.
+
+    :param tmpl_dir: Template directory location
+    :param index_file: Where the index is persisted
+    """
+
+    def __init__(self, tmpl_dir, index_file):
+        self.tmpl_dir = tmpl_dir
+        self.index_file = index_file
+        self.files = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                data = json.load(f)
+            if data.get('tmpl_dir') == self.tmpl_dir:
+                self.files = data.get('files', {})
+        except (IOError, ValueError):
+            self.files = {}
+
+    def save(self):
+        tmp = self.index_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'tmpl_dir': self.tmpl_dir, 'files': self.files},
+                          f, sort_keys=True)
+            os.rename(tmp, self.index_file)
+        except (IOError, OSError) as e:
+            status = 500
+            msg = '%s (file: %s)' % (e.strerror, self.index_file)
+            raise TemplateFileError(status, msg)
+
+    def _scan_file(self, path):
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except IOError as e:
+            status = 500
+            msg = '%s (file: %s)' % (e.strerror, path)
+            raise TemplateFileError(status, msg)
+
+        digest = md5(body).hexdigest()
+        if '\0' in body:
+            return [], False, digest
+        found = []
+        for m in PLACEHOLDER_RE.finditer(body):
+            found.append([m.group(1) or m.group(2), m.start(), m.end()])
+        return found, is_script(path, body[:2]), digest
+
+    def scan(self):
+        """
+        Walks the template tree and (re)indexes new or modified files.
+        Returns the number of files that had to be scanned.
+        """
+        seen = {}
+        scanned = 0
+        for root, dirs, files in os.walk(self.tmpl_dir):
+            dirs[:] = [d for d in dirs if d != '.git']
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, self.tmpl_dir)
+                st = os.stat(path)
+                entry = self.files.get(rel)
+                if not entry or entry['mtime'] != st.st_mtime or \
+                        entry['size'] != st.st_size:
+                    found, script, digest = self._scan_file(path)
+                    entry = {'mtime': st.st_mtime, 'size': st.st_size,
+                             'md5': digest, 'script': script,
+                             'vars': found}
+                    scanned += 1
+                seen[rel] = entry
+        self.files = seen
+        self.save()
+        return scanned
+
+    def templated(self, conf_vals, ignore=()):
+        """
+        Returns the files that need rendering, as a dictionary of file
+        to the list of (name, start, end) occurrences to be replaced.
+        Raises TemplateFileError listing every variable that is not in
+        the config, so nothing gets rendered half way.
+
+        :param conf_vals: Dictionary of all config values (lower case keys)
+        :param ignore: Upper case names that are not placeholders
+        """
+        templates = {}
+        missing = []
+        for rel in sorted(self.files.keys()):
+            entry = self.files[rel]
+            subs = []
+            for name, start, end in entry['vars']:
+                if name.lower() in conf_vals:
+                    subs.append((name, start, end))
+                elif not entry['script'] and name not in ignore:
+                    missing.append('%s (%s:%d)' % (name, rel, start))
+            if subs:
+                templates[rel] = subs
+
+        if missing:
+            status = 500
+            msg = ('Variables missing from the config file: %s'
+                   % ', '.join(missing))
+            raise TemplateFileError(status, msg)
+        return templates
+
+
+def render(body, subs, conf_vals):
+    """
+    Returns body with the given occurrences replaced by their values
+
+    :param body: Template contents
+    :param subs: List of (name, start, end) occurrences
+    :param conf_vals: Dictionary of all config values (lower case keys)
+    """
+    pieces = []
+    last = 0
+    for name, start, end in sorted(subs, key=lambda x: x[1]):
+        pieces.append(body[last:start])
+        pieces.append(conf_vals[name.lower()])
+        last = end
+    pieces.append(body[last:])
+    return ''.join(pieces)
@@ -2,17 +2,26 @@
 
 import sys
 import os
-from string import Template
+import json
+import shutil
+from hashlib import md5
 from swift_setup.common.exceptions import ConfigFileError, \
     ResponseError, TemplateFileError
 from swift_setup.common.utils import readconf
+from swift_setup.common.placeholders import PlaceholderIndex, render
+from swift_setup.common.hostvars import host_var_names
+from multiprocessing.dummy import Pool as ThreadPool
 
 
 class TemplateGen(object):
     """
     This class is used for generation of the template files that
     will be used by fabric to push files to the servers that will
-    be deploying
+    be deploying. The templates under base_dir/templates are never
+    modified, they are rendered into a separate output tree instead.
+    A render cache keyed on the template hash and the values of the
+    variables it uses allows only files whose inputs have changed to
+    be rendered again.
 
     :param conf_file: The configuration file location
     :param base_dir: Base location where config, templates, host files
@@ -23,107 +32,131 @@ class TemplateGen(object):
         self.conf = readconf(conf_file)
         self.base_dir = base_dir
         self.tmpl_dir = base_dir + '/templates'
+        self.out_dir = self.conf.get('templating', {}).get(
+            'output_dir', base_dir + '/rendered')
+        self.index_file = base_dir + '/templates.index'
+        self.cache_file = base_dir + '/render.cache'
 
         if not os.path.isdir(self.tmpl_dir):
             status = 404
             msg = 'Template directory not found [%s]' % self.tmpl_dir
             raise ResponseError(status, msg)
 
-    def _update_files(self, templates):
+    def _conf_vals(self):
         conf_vals = {}
-        for v in self.conf.values():
-            conf_vals.update(v)
-
-        for template in templates.keys():
-            subs = {}
-            for val in templates[template]:
-                subs[val] = conf_vals[val.lower()]
-
-            try:
-                fh = open(template, 'r')
+        for section, v in self.conf.items():
+            if not section.startswith('host_vars'):
+                conf_vals.update(v)
+        "Host variables are rendered on each system at deploy time"
+        for name in host_var_names(self.conf):
+            conf_vals.pop(name, None)
+        return conf_vals
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_cache(self, cache):
+        tmp = self.cache_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(cache, f, sort_keys=True)
+            os.rename(tmp, self.cache_file)
+        except (IOError, OSError) as e:
+            status = 500
+            msg = '%s (file: %s)' % (e.strerror, self.cache_file)
+            raise TemplateFileError(status, msg)
+
+    def _cache_key(self, entry, subs, conf_vals):
+        """
+        Key of a rendered file: the template hash plus the values of
+        the variables that are substituted in it
+        """
+        names = sorted(set([name for name, start, end in subs]))
+        h = md5(entry['md5'])
+        for name in names:
+            h.update('\0%s=%s' % (name, conf_vals[name.lower()]))
+        return h.hexdigest()
+
+    def _render_file(self, args):
+        rel, subs, conf_vals = args
+        template = os.path.join(self.tmpl_dir, rel)
+        output = os.path.join(self.out_dir, rel)
+        try:
+            with open(template, 'rb') as fh:
                 body = fh.read()
-                fh.close()
-            except Exception as e:
-                status = 500
-                msg = '%s (file: %s)' % (e.args[1], template)
-                raise TemplateFileError(status, msg)
-
-            s = Template(body)
-            new_body = s.safe_substitute(subs)
-
+            if subs:
+                body = render(body, subs, conf_vals)
+            if not os.path.isdir(os.path.dirname(output)):
+                try:
+                    os.makedirs(os.path.dirname(output))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(output)):
+                        raise
+            with open(output + '.tmp', 'wb') as fh:
+                fh.write(body)
+            shutil.copymode(template, output + '.tmp')
+            os.rename(output + '.tmp', output)
+        except (IOError, OSError) as e:
+            status = 500
+            msg = '%s (file: %s)' % (e.strerror, template)
+            raise TemplateFileError(status, msg)
+        return rel
+
+    def _update_files(self):
+        """
+        Scans the template tree for placeholders (only new or modified
+        files are read) and renders, in parallel, every file whose
+        template or variable values have changed since the last run.
+        Returns the number of files rendered and left untouched.
+        """
+        conf_vals = self._conf_vals()
+        ignore = conf_vals.get('ignore_vars', '').split() + \
+            [name.upper() for name in host_var_names(self.conf)]
+        workers = int(conf_vals.get('render_workers', 8))
+
+        index = PlaceholderIndex(self.tmpl_dir, self.index_file)
+        index.scan()
+        templates = index.templated(conf_vals, ignore)
+
+        cache = self._load_cache()
+        new_cache = {}
+        jobs = []
+        for rel, entry in index.files.items():
+            subs = templates.get(rel, [])
+            key = self._cache_key(entry, subs, conf_vals)
+            new_cache[rel] = key
+            if cache.get(rel) != key or \
+                    not os.path.isfile(os.path.join(self.out_dir, rel)):
+                jobs.append((rel, subs, conf_vals))
+
+        "Files that are gone from the templates"
+        for rel in cache.keys():
+            if rel not in new_cache and \
+                    os.path.isfile(os.path.join(self.out_dir, rel)):
+                os.remove(os.path.join(self.out_dir, rel))
+
+        if jobs:
+            pool = ThreadPool(max(1, min(workers, len(jobs))))
             try:
-                fh = open(template, 'w')
-                fh.write(new_body)
-                fh.close()
-            except Exception as e:
-                status = 500
-                msg = '%s (file: %s)' % (e.args[1], template)
-                raise TemplateFileError(status, msg)
-
-    def _update_admin(self):
-        location = self.tmpl_dir + '/admin/etc/'
-        templates = {
-            location + 'swift/dispersion.conf': ('KEYSTONE_IP',
-                                                 'KEYSTONE_PORT',
-                                                 'KEYSTONE_AUTH_PROTO',
-                                                 'DIS_TENANT',
-                                                 'DIS_USER',
-                                                 'DIS_KEY',
-                                                 'DIS_COVERAGE')
-        }
-        self._update_files(templates)
-
-    def _update_proxy(self):
-        location = self.tmpl_dir + '/proxy/etc/'
-        templates = {
-            location + 'memcached.conf': ('MEMCACHE_MAXMEM',
-                                          'SIM_CONNECTIONS'),
-            location + 'swift/memcache.conf': ('MEMCACHE_SERVER_LIST', ),
-            location + 'swift/proxy-server.conf': ('PIPELINE',
-                                                   'KEYSTONE_IP',
-                                                   'KEYSTONE_PORT',
-                                                   'KEYSTONE_AUTH_PROTO',
-                                                   'KEYSTONE_AUTH_PORT',
-                                                   'KEYSTONE_ADMIN_TENANT',
-                                                   'KEYSTONE_ADMIN_USER',
-                                                   'KEYSTONE_ADMIN_KEY',
-                                                   'AUTHTOKEN_FACTORY')
-        }
-        self._update_files(templates)
-
-    def _update_storage(self):
-        usr_location = self.tmpl_dir + '/storage/usr/local/bin/'
-        templates = {
-            usr_location + 'drive_mount_check.py': ('OUTGOING_DOMAIN',
-                                                    'EMAIL_ADDR')
-        }
-        self._update_files(templates)
-
-    def _update_common(self):
-        location = self.tmpl_dir + '/common/etc/'
-        templates = {
-            location + 'cron.d/swift_ring_check': ('ADMIN_IP', ),
-            location + 'swift/swift.conf': ('SWIFT_HASH', ),
-            location + 'syslog-ng/conf.d/swift-ng.conf': ('SYSLOG_IP', ),
-            location + 'aliases': ('EMAIL_ADDR', 'PAGER_ADDR'),
-            location + 'exim4/update-exim4.conf.conf': ('OUTGOING_DOMAIN',
-                                                        'SMARTHOST',
-                                                        'RELAY_NET')
-        }
-        self._update_files(templates)
+                pool.map(self._render_file, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        self._save_cache(new_cache)
+        return len(jobs), len(new_cache) - len(jobs)
 
     def template_setup(self):
         """
-        Used to modify the templates files that have placeholders
-        with the information found in the config file
+        Renders the templates with the information found in the config
+        file into the output tree. It can be run again at any time, only
+        the files affected by changes are rendered again. Returns the
+        number of files rendered and the number left untouched.
         """
-        if os.path.isfile(self.tmpl_dir + '/.initialized'):
-            return False
-        else:
-            self._update_common()
-            self._update_admin()
-            self._update_proxy()
-            self._update_storage()
-            f = open(self.tmpl_dir + '/.initialized', 'w')
-            f.close()
-        return True
+        rendered, unchanged = self._update_files()
+        f = open(self.out_dir + '/.initialized', 'w')
+        f.close()
+        return rendered, unchanged
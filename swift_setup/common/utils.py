@@ -2,7 +2,8 @@
 
 import sys
 import os
-from swift_setup.common.exceptions import ConfigFileError
+import re
+from swift_setup.common.exceptions import ConfigFileError, HostListError
 from ConfigParser import ConfigParser
 
 
@@ -24,6 +25,8 @@ def readconf(conf_file, section=None):
     if section:
         if c.has_section(section):
             conf = dict(c.items('common') + c.items(section))
+        else:
+            conf = dict(c.items('common'))
     else:
         conf = {}
         for s in c.sections():
@@ -48,16 +51,47 @@ def generate_hosts_list(base_dir, host_group):
                             host_list.append(line)
         else:
             status = 404
-            msg = "Host group file not found (%s)" % dsh_file
+            msg = "Host group file not found (%s)" % host_file
             raise HostListError(status, msg)
     except:
         status = 404
-        msg = "Problem reading host group file (%s)" % dsh_file
+        msg = "Problem reading host group file (%s)" % host_file
         raise HostListError(status, msg)
 
     if host_list:
         return host_list
     else:
         status = 204
-        msg = "Host group file has no content (%s)" % dsh_file
+        msg = "Host group file has no content (%s)" % host_file
         raise HostListError(status, msg)
+
+
+def generate_zone_map(base_dir, host_list, max_zones=5):
+    '''
+    Maps every host in host_list to its swift zone. The zone host
+    group files (zone1 .. zoneN) are used first and then the zone
+    is guessed from the hostname (e.g: storage1-z3.swift). Hosts
+    that cannot be placed (e.g: proxies) are left out of the map.
+
+    :param base_dir: Base location of the swift-setup files
+    :param host_list: List of hosts that will be mapped
+    :param max_zones: Number of zone group files to look for
+    '''
+    zone_map = {}
+    for num in range(1, max_zones + 1):
+        zone = 'zone%d' % num
+        if not os.path.isfile(base_dir + '/hosts/' + zone):
+            continue
+        for host in generate_hosts_list(base_dir, zone):
+            zone_map.setdefault(host, zone)
+
+    zone_re = re.compile(r'-z(\d+)\b')
+    hosts_zone = {}
+    for host in host_list:
+        if host in zone_map:
+            hosts_zone[host] = zone_map[host]
+            continue
+        m = zone_re.search(host)
+        if m:
+            hosts_zone[host] = 'zone%s' % m.group(1)
+    return hosts_zone
@@ -0,0 +1,337 @@
+""" See COPYING for license information """
+
+import os
+import urllib2
+from hashlib import md5
+from swift_setup.common.utils import readconf
+from swift_setup.common.hostvars import host_var_names, host_var_files
+from swift_setup.node.scheduler import DeployScheduler
+from swift_setup.ring.distribute import RING_FILES, MANIFEST
+from fabric.api import env, hide, settings, sudo
+from fabric.network import disconnect_all
+
+
+"Markers of the sections printed by AUDIT_COMMAND"
+RINGS_MARKER = '__SWIFT_SETUP_AUDIT_RINGS__'
+ETC_MARKER = '__SWIFT_SETUP_AUDIT_ETC__'
+HEAD_MARKER = '__SWIFT_SETUP_AUDIT_HEAD__'
+LOCAL_MARKER = '__SWIFT_SETUP_AUDIT_LOCAL__'
+DIRTY_MARKER = '__SWIFT_SETUP_AUDIT_DIRTY__'
+
+"""
+Shell command that prints, in one round trip, the md5 of the rings, of
+every other file of /etc/swift, the commit of the /root/local checkout,
+the blob of every file it tracks (its pristine content, whatever the
+host variables rendered in place) and the files that differ from it
+"""
+AUDIT_COMMAND = '; '.join([
+    'echo %s' % RINGS_MARKER,
+    'cd /etc/swift && md5sum %s 2>/dev/null' % ' '.join(RING_FILES),
+    'echo %s' % ETC_MARKER,
+    "find /etc/swift -type f ! -name '*.ring.gz' ! -path '/etc/swift/rings/*'"
+    " ! -path '/etc/swift/backups/*' -print0 | sort -z | "
+    "xargs -0 -r md5sum",
+    'echo %s' % HEAD_MARKER,
+    'cd /root/local 2>/dev/null && git rev-parse --short HEAD 2>/dev/null',
+    'echo %s' % LOCAL_MARKER,
+    'cd /root/local 2>/dev/null && git ls-files -s 2>/dev/null',
+    'echo %s' % DIRTY_MARKER,
+    'cd /root/local 2>/dev/null && git status --porcelain 2>/dev/null',
+    'true',
+])
+
+"Parts of the audit report, in the order they are shown"
+SECTIONS = [('rings', 'Rings'), ('etc', '/etc/swift'),
+            ('local', '/root/local')]
+
+
+def parse_audit(output):
+    """
+    Parses the output of AUDIT_COMMAND into a dictionary with the rings
+    and etc dictionaries of path to md5, the local dictionary of path
+    to git blob, the head commit and the dirty list of the paths of the
+    checkout that differ from it
+
+    :param output: Output of AUDIT_COMMAND
+    """
+    markers = {RINGS_MARKER: 'rings', ETC_MARKER: 'etc',
+               HEAD_MARKER: 'head', LOCAL_MARKER: 'local',
+               DIRTY_MARKER: 'dirty'}
+    result = {'rings': {}, 'etc': {}, 'local': {}, 'head': None,
+              'dirty': []}
+    current = None
+    for raw in output.splitlines():
+        line = raw.strip()
+        if line in markers:
+            current = markers[line]
+            continue
+        if current == 'head':
+            if line:
+                result['head'] = line
+            continue
+        if current == 'local':
+            "mode blob stage<TAB>path"
+            meta = line.split('\t', 1)
+            if len(meta) == 2 and len(meta[0].split()) == 3:
+                result['local'][meta[1]] = meta[0].split()[1]
+            continue
+        if current == 'dirty':
+            "XY path"
+            raw = raw.rstrip()
+            if len(raw) > 3:
+                result['dirty'].append(raw[3:].split(' -> ')[-1])
+            continue
+        parts = line.split(None, 1)
+        if current and len(parts) == 2 and len(parts[0]) == 32:
+            path = parts[1]
+            if path.startswith('./'):
+                path = path[2:]
+            elif path.startswith('/etc/swift/'):
+                path = path[len('/etc/swift/'):]
+            result[current][path] = parts[0]
+    return result
+
+
+def ring_version(rings):
+    """
+    Returns the version of a set of rings, named like swift-ring-pull
+    and swift-setup push do (md5 of their ring.md5sum), or None if any
+    of the rings is missing
+
+    :param rings: Dictionary of ring file to md5
+    """
+    if [r for r in RING_FILES if r not in rings]:
+        return None
+    body = ''.join(['%s  %s\n' % (rings[r], r) for r in RING_FILES])
+    return md5(body).hexdigest()[:12]
+
+
+def files_version(files):
+    """
+    Returns a short digest of a dictionary of path to md5
+
+    :param files: Dictionary of path to md5
+    """
+    body = ''.join(['%s  %s\n' % (files[p], p) for p in sorted(files)])
+    return md5(body).hexdigest()[:12]
+
+
+def version_of(section, result):
+    "Returns the version of a section of a host audit"
+    if section == 'rings':
+        return ring_version(result['rings']) or 'incomplete'
+    version = files_version(result[section])
+    if section == 'local' and result['head']:
+        version = '%s@%s' % (result['head'], version)
+    return version
+
+
+def diff_files(base, other):
+    """
+    Returns the files that differ between two dictionaries of path to
+    md5 as (changed, missing from other, only in other)
+    """
+    changed = sorted([p for p in base if p in other and base[p] != other[p]])
+    missing = sorted([p for p in base if p not in other])
+    extra = sorted([p for p in other if p not in base])
+    return changed, missing, extra
+
+
+def group_hosts(results, section):
+    """
+    Groups the hosts by the version of a section. Returns a list of
+    (version, hosts) with the most common version first.
+
+    :param results: Dictionary of host to parsed audit
+    :param section: rings, etc or local
+    """
+    groups = {}
+    for host in sorted(results):
+        groups.setdefault(version_of(section, results[host]),
+                          []).append(host)
+    return sorted(groups.items(), key=lambda g: (-len(g[1]), g[0]))
+
+
+def _hosts_list(hosts, limit):
+    if limit and len(hosts) > limit:
+        return '%s (+%d)' % (', '.join(hosts[:limit]), len(hosts) - limit)
+    return ', '.join(hosts)
+
+
+def format_audit(results, unreachable, published=None, limit=5):
+    """
+    Returns the lines of the drift report: for the rings, /etc/swift and
+    /root/local, the hosts grouped by version, each group other than the
+    reference one with the files that differ from it. The reference is
+    the published rings for the rings and the largest group otherwise.
+
+    :param results: Dictionary of host to parsed audit
+    :param unreachable: Hosts that could not be audited
+    :param published: Rings published by the admin system (file to md5)
+    :param limit: Hosts listed per group (0 for all of them)
+    """
+    lines = []
+    drift = False
+    for section, title in SECTIONS:
+        groups = group_hosts(results, section)
+        if not groups:
+            continue
+        ref_version = groups[0][0]
+        ref = results[groups[0][1][0]][section]
+        if section == 'rings' and published:
+            ref_version = ring_version(published)
+            ref = published
+            title += ' (published %s)' % ref_version
+        lines.append('%s: %d version(s)' % (title, len(groups)))
+        for version, hosts in groups:
+            tag = ' *' if version == ref_version else ''
+            lines.append('  %-20s %5d host(s)%s  %s'
+                         % (version, len(hosts), tag,
+                            _hosts_list(hosts, limit)))
+            if version == ref_version:
+                continue
+            drift = True
+            changed, missing, extra = diff_files(ref,
+                                                 results[hosts[0]][section])
+            for label, paths in (('differs', changed), ('missing', missing),
+                                 ('extra', extra)):
+                if paths:
+                    lines.append('  %-20s %s: %s'
+                                 % ('', label, _hosts_list(paths, limit)))
+    if unreachable:
+        drift = True
+        lines.append('Unreachable: %d host(s)  %s'
+                     % (len(unreachable), _hosts_list(sorted(unreachable),
+                                                      limit)))
+    return lines, drift
+
+
+def _audit_host():
+    """
+    Gathers the audit of the current host. This is what each of the
+    audit worker processes will run.
+    """
+    with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+                  warn_only=True):
+        output = sudo(AUDIT_COMMAND)
+    return parse_audit(output)
+
+
+class ClusterAudit(object):
+    """
+    Collects the ring md5s, the md5 of every file of /etc/swift and the
+    state of the /root/local checkout from many hosts at once (a single
+    command per host), so one can tell which hosts run which ring and
+    config version. Files holding host variables are expected to differ
+    and are not compared.
+
+    :param conf_file: The configuration file location
+    """
+
+    def __init__(self, conf_file):
+        "Info for common section"
+        self.conf = readconf(conf_file, 'common')
+        self.user = self.conf.get('ssh_user', 'swiftops')
+        self.key = self.conf.get('ssh_key', '/home/swiftops/.ssh/id_rsa')
+
+        "Info for swift section"
+        self.conf = readconf(conf_file, 'swift_common')
+        self.admin_ip = self.conf.get('admin_ip', '172.16.0.254')
+
+        "Info for rings section"
+        self.conf = readconf(conf_file, 'rings')
+        self.ring_dir = self.conf.get('builder_dir', '/srv/ring')
+
+        "Info for templating section"
+        self.conf = readconf(conf_file, 'templating')
+        self.tmpl_dir = self.conf.get('output_dir', os.path.dirname(
+            conf_file) + '/rendered')
+
+        "Info for host_vars sections"
+        self.host_conf = readconf(conf_file)
+
+        "Info for audit section"
+        self.conf = readconf(conf_file, 'audit')
+        self.concurrency = max(1, int(self.conf.get('concurrency', 100)))
+        self.timeout = int(self.conf.get('timeout', 10))
+
+    def _host_templated(self):
+        """
+        Returns the paths of the checkout (tree/path) and of /etc/swift
+        that hold host variables, which are rendered in place on every
+        host and so legitimately differ between hosts
+        """
+        names = host_var_names(self.host_conf)
+        if not names or not os.path.isdir(self.tmpl_dir):
+            return set(), set()
+        trees = [d for d in sorted(os.listdir(self.tmpl_dir))
+                 if not d.startswith('.') and
+                 os.path.isdir(os.path.join(self.tmpl_dir, d))]
+        local = set()
+        etc = set()
+        for tree, path, used in host_var_files(self.tmpl_dir, trees, names):
+            local.add('%s/%s' % (tree, path))
+            if path.startswith('etc/swift/'):
+                etc.add(path[len('etc/swift/'):])
+        return local, etc
+
+    def published(self):
+        """
+        Returns the rings published by the admin system as a dictionary
+        of ring file to md5, read from the local ring directory when
+        run on the admin system or else fetched from its nginx
+        """
+        path = os.path.join(self.ring_dir, MANIFEST)
+        try:
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    body = f.read()
+            else:
+                body = urllib2.urlopen('http://%s/ring/%s' % (
+                    self.admin_ip, MANIFEST), timeout=self.timeout).read()
+        except (IOError, urllib2.URLError):
+            return None
+        rings = {}
+        for line in body.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1] in RING_FILES:
+                rings[parts[1]] = parts[0]
+        return rings or None
+
+    def run(self, host_list):
+        """
+        Audits all the hosts. Returns a dictionary of host to parsed
+        audit (see parse_audit) and the list of unreachable hosts.
+
+        :param host_list: Hosts to audit
+        """
+        env.user = self.user
+        env.key_filename = self.key
+        env.timeout = self.timeout
+        env.warn_only = True
+        env.parallel = False
+        scheduler = DeployScheduler(self.concurrency, self.concurrency)
+        statuses = scheduler.run(_audit_host, host_list)
+        disconnect_all()
+
+        """
+        Host templated files are left out of /etc/swift, and the checkout
+        is compared on its pristine content plus the files changed by
+        hand (anything dirty that is not host templated)
+        """
+        local_templated, etc_templated = self._host_templated()
+        results = {}
+        unreachable = []
+        for host in host_list:
+            result = scheduler.results.get(host)
+            if statuses.get(host) and result and (result['rings'] or
+                                                  result['etc']):
+                for path in etc_templated:
+                    result['etc'].pop(path, None)
+                for path in result['dirty']:
+                    if path not in local_templated:
+                        result['local'][path] = 'modified'
+                results[host] = result
+            else:
+                unreachable.append(host)
+        return results, unreachable
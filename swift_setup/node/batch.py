@@ -0,0 +1,144 @@
+""" See COPYING for license information """
+
+import os
+import tempfile
+from swift_setup.common.exceptions import ResponseError
+from swift_setup.node.report import recorder, sudo, run, put
+
+
+STEP_MARKER = '__SWIFT_SETUP_STEP__'
+OUT_MARKER = '__SWIFT_SETUP_OUT__'
+
+
+def upload(body, remote_path, mode=0644):
+    """
+    Writes body to a file on the current host (with sudo)
+
+    :param body: File contents
+    :param remote_path: File location on the host
+    :param mode: File mode
+    """
+    fd, local = tempfile.mkstemp(prefix='swift-setup.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(body)
+        return put(local, remote_path, use_sudo=True, mode=mode)
+    finally:
+        os.remove(local)
+
+
+class RemoteScript(object):
+    """
+    Compiles the steps of a deploy phase into a single remote shell
+    program, so that the whole phase costs one ssh exec instead of one
+    round trip per command. Every step reports its own exit status
+    back along with the time it took, which is then used to point
+    errors at the exact step that has failed.
+
+    :param phase: Name of the deploy phase (used on error messages)
+    :param use_sudo: Run the program with sudo (default) or run
+    """
+
+    def __init__(self, phase, use_sudo=True):
+        self.phase = phase
+        self.use_sudo = use_sudo
+        self.steps = []
+
+    def add(self, name, cmd, check=None, fatal=False,
+            error=ResponseError, status=500, msg=None):
+        """
+        Appends a step to the program
+
+        :param name: Short name of the step
+        :param cmd: Shell command to be executed
+        :param check: Optional command, cmd is only run when it fails
+                      (e.g: check='test -e /srv/node' cmd='mkdir ...')
+        :param fatal: Stop the program and raise error when it fails
+        :param error: ResponseError subclass raised for fatal steps
+        :param status: Status used when raising the error
+        :param msg: Message used when raising the error
+        """
+        self.steps.append({'name': name, 'cmd': cmd, 'check': check,
+                           'fatal': fatal, 'error': error,
+                           'status': status, 'msg': msg})
+        return self
+
+    def compile(self):
+        """
+        Returns the shell program for all steps added so far. The output
+        of each step goes to a temp file rather than a pipe, so that a
+        daemon started by a step and keeping its stdout or stderr open
+        does not leave the program waiting for the pipe to close. Steps
+        still run in a subshell, as they did within $( ).
+        """
+        lines = ['__log=$(mktemp /tmp/swift-setup.XXXXXX) || exit 1',
+                 'trap \'rm -f "$__log"\' EXIT']
+        for idx, step in enumerate(self.steps):
+            cmd = step['cmd']
+            if step['check']:
+                cmd = '%s || { %s; }' % (step['check'], cmd)
+            lines.append('__t=$(date +%s%N)')
+            lines.append('( %s ) </dev/null >"$__log" 2>&1; __rc=$?' % cmd)
+            lines.append('echo "%s %d $__rc $(( ($(date +%%s%%N) - __t) '
+                         '/ 1000000 ))"' % (STEP_MARKER, idx))
+            lines.append('if [ $__rc -ne 0 ]; then '
+                         'tail -n 5 "$__log" | '
+                         'sed "s/^/%s %d /"; fi' % (OUT_MARKER, idx))
+            if step['fatal']:
+                lines.append('if [ $__rc -ne 0 ]; then exit $__rc; fi')
+        lines.append('exit 0')
+        return '\n'.join(lines)
+
+    def _parse(self, output):
+        records = []
+        for step in self.steps:
+            records.append({'phase': self.phase, 'step': step['name'],
+                            'command': step['cmd'], 'status': None,
+                            'duration': 0.0, 'output': []})
+
+        for line in output.splitlines():
+            parts = line.strip().split(' ', 2)
+            if len(parts) < 3 or not parts[1].isdigit():
+                continue
+            idx = int(parts[1])
+            if idx >= len(records):
+                continue
+            if parts[0] == STEP_MARKER:
+                values = parts[2].split()
+                records[idx]['status'] = int(values[0])
+                if len(values) > 1 and values[1].isdigit():
+                    records[idx]['duration'] = int(values[1]) / 1000.0
+            elif parts[0] == OUT_MARKER:
+                records[idx]['output'].append(parts[2])
+        return records
+
+    def run(self):
+        """
+        Runs the program on the current host and returns a list with
+        one status record per step. Steps that were never reached have
+        a status of None. The error of the first fatal step that has
+        failed is raised.
+        """
+        if not self.steps:
+            return []
+
+        runner = sudo if self.use_sudo else run
+        result = runner(self.compile())
+        records = self._parse(result)
+        for record in records:
+            if record['status'] is not None:
+                recorder.record('step', '%s: %s' % (record['step'],
+                                                    record['command']),
+                                record['status'], record['duration'])
+
+        for step, record in zip(self.steps, records):
+            if not step['fatal'] or record['status'] == 0:
+                continue
+            if record['status'] is None and not result.failed:
+                continue
+            msg = step['msg'] or ('Step "%s" of %s has failed'
+                                  % (step['name'], self.phase))
+            if record['output']:
+                msg = '%s (%s)' % (msg, ' | '.join(record['output']))
+            raise step['error'](step['status'], msg)
+        return records
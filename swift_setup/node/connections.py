@@ -0,0 +1,100 @@
+""" See COPYING for license information """
+
+import time
+from fabric.api import env
+from fabric.state import connections
+
+
+class SessionPool(object):
+    """
+    Keeps track of the ssh sessions used during a deploy. Fabric already
+    multiplexes every command over the channels of a single paramiko
+    transport per host, as long as the connection is kept in its cache.
+    The pool makes sure that session is opened once, kept alive for the
+    whole deploy and reused by every phase, and it counts the handshakes
+    done and the phases that found the session already open.
+
+    :param keepalive: Seconds between ssh keepalive packets, so that
+                      idle sessions survive long running phases
+    """
+
+    def __init__(self, keepalive=30):
+        self.keepalive = keepalive
+        self.handshakes = 0
+        self.handshake_time = 0.0
+        self.reuses = 0
+        self._installed = False
+
+    def install(self):
+        """
+        Hooks into fabric's connection cache to time every new session
+        """
+        if self._installed:
+            return
+        env.keepalive = self.keepalive
+        orig_connect = connections.connect
+
+        def _connect(key):
+            start = time.time()
+            try:
+                return orig_connect(key)
+            finally:
+                self.handshakes += 1
+                self.handshake_time += time.time() - start
+
+        connections.connect = _connect
+        self._installed = True
+
+    def session(self, phase=None):
+        """
+        Makes sure there is an open session for the current host before
+        a phase starts. Returns True if an existing one was reused.
+
+        :param phase: Name of the phase about to start
+        """
+        self.install()
+        host = env.host_string
+        if host in connections and connections[host].get_transport() \
+                and connections[host].get_transport().is_active():
+            self.reuses += 1
+            return True
+        if host in connections:
+            del connections[host]
+        connections[host]
+        return False
+
+    def stats(self):
+        """
+        Returns the session counters for this pool
+        """
+        return {'handshakes': self.handshakes,
+                'handshake_time': self.handshake_time,
+                'reuses': self.reuses}
+
+
+def merge_session_stats(stats_list):
+    """
+    Merges the session counters reported by each deploy worker (one per
+    host) into a single summary. No time saved is derived from the
+    reuses: a phase finding the session open does not mean a handshake
+    was avoided, fabric would have reused its cached connection anyway.
+    What the pool guarantees is one handshake per host, reported as the
+    handshakes per host.
+
+    :param stats_list: List of dictionaries returned by SessionPool.stats
+    """
+    summary = {'handshakes': 0, 'handshake_time': 0.0, 'reuses': 0,
+               'hosts': 0, 'max_handshakes': 0}
+    for stats in stats_list:
+        if not stats:
+            continue
+        summary['hosts'] += 1
+        summary['max_handshakes'] = max(summary['max_handshakes'],
+                                        stats.get('handshakes', 0))
+        for key in ('handshakes', 'handshake_time', 'reuses'):
+            summary[key] += stats.get(key, 0)
+
+    summary['per_host'] = 0.0
+    if summary['hosts']:
+        summary['per_host'] = float(summary['handshakes']) / summary['hosts']
+    return summary
@@ -1,12 +1,33 @@
 """ See COPYING for license information """
 
 import os
+import time
 from sys import exit
+from pipes import quote
+from hashlib import md5
 from swift_setup.common.exceptions import ConfigFileError, \
     ResponseError, UploadTemplatesError, ConfigSyncError
-from swift_setup.common.utils import readconf
+from swift_setup.common.utils import readconf, generate_zone_map
+from swift_setup.common.manifest import manifest_command, parse_manifest, \
+    changed_files, services_for, generate_manifest, RESTART_CMDS, \
+    FIRST_INSTALL_SERVICES
+from swift_setup.node.scheduler import DeployScheduler
+from swift_setup.node.batch import RemoteScript, upload
+from swift_setup.node.connections import SessionPool, merge_session_stats
+from swift_setup.common.hostvars import FACTS_COMMAND, host_var_names, \
+    read_formulas, parse_facts, derive_values, host_var_files, \
+    render_host_vars, substitute_command
+from swift_setup.node.journal import DeployJournal, tree_fingerprint
+from swift_setup.node.pkgcache import PackageCache
+from swift_setup.node.irqtune import IrqTuner
+from swift_setup.node.drives import DriveProvisioner
+from swift_setup.node.drivebench import DriveBenchmark
+from swift_setup.node.plan import host_estimate, wall_estimate, \
+    format_host_plan, format_duration
 from fabric.api import *
 from fabric.network import *
+from swift_setup.node.report import recorder, sudo, run, put, \
+    write_report, merge_reports, summarize
 
 
 class DeployNode(object):
@@ -16,8 +37,10 @@ class DeployNode(object):
     :param conf_file: The configuration file location
     """
 
-    def __init__(self, conf_file):
+    def __init__(self, conf_file, resume=False):
+        self.conf_file = conf_file
         self.base_dir = os.path.dirname(conf_file)
+        self.resume = resume
 
         "Info for common section"
         self.conf = readconf(conf_file, 'common')
@@ -35,17 +58,103 @@ class DeployNode(object):
         self.repo_base = self.conf.get('repository_base', '/srv/git')
         self.repo_name = self.conf.get('repository_name',
                                        'swift-cluster-configs')
+        self.repo_branch = self.conf.get('repository_branch', 'master')
+        self.config_sync = self.conf.get('config_sync', 'clone')
+        self.bundle_dir = self.conf.get('bundle_dir',
+                                        '/var/www/nginx-default/configs')
+        if self.config_sync not in ('clone', 'shallow', 'fetch', 'bundle'):
+            status = 500
+            msg = 'Invalid config_sync mode [%s]' % self.config_sync
+            raise ConfigFileError(status, msg)
 
         "Info for swift section"
         self.conf = readconf(conf_file, 'swift_common')
         self.admin_ip = self.conf.get('admin_ip', '172.16.0.254')
 
+        "Info for templating section"
+        self.conf = readconf(conf_file, 'templating')
+        self.tmpl_dir = self.conf.get('output_dir',
+                                      self.base_dir + '/rendered')
+
+        "Info for host_vars sections"
+        self.host_conf = readconf(conf_file)
+        self.host_vars = host_var_names(self.host_conf)
+        self.host_files = {}
+
+        "Info for deploy section"
+        self.conf = readconf(conf_file, 'deploy')
+        self.concurrency = int(self.conf.get('concurrency', 5))
+        self.zone_concurrency = int(self.conf.get('zone_concurrency', 1))
+        self.wave_size = int(self.conf.get('wave_size', 0))
+        self.sessions = SessionPool(int(self.conf.get('ssh_keepalive', 30)))
+        self.journal_dir = self.conf.get('journal_dir',
+                                         self.base_dir + '/journal')
+        self.journal = None
+        self.state_dir = self.conf.get('state_dir', '/var/lib/swift-setup')
+        self.reboot = self.conf.get('reboot', 'first')
+        self.report_dir = self.conf.get('report_dir',
+                                        self.base_dir + '/reports')
+        self.report_path = None
+
+        "Info for package_cache section"
+        self.conf = readconf(conf_file, 'package_cache')
+        self.pkg_cache = None
+        if self.conf.get('enabled', 'false').lower() in ('true', 'yes', '1'):
+            self.pkg_cache = PackageCache(
+                self.admin_ip,
+                self.conf.get('cache_dir', '/srv/debs'),
+                self.conf.get('url_path', '/debs'),
+                self.conf.get('upstream', ''),
+                self.conf.get('pin_priority', 500))
+
+        "Info for drives section"
+        self.conf = readconf(conf_file, 'drives')
+        self.drives = None
+        if self.conf.get('enabled', 'false').lower() in ('true', 'yes', '1'):
+            self.drives = DriveProvisioner(
+                self.conf.get('workers', 8),
+                self.conf.get('naming', 'auto'),
+                self.conf.get('mount_root', '/srv/node'),
+                self.conf.get('inode_size', 512),
+                self.conf.get('data_options', 'su=64k,sw=1'),
+                self.conf.get('log_options', ''),
+                self.conf.get('mount_options',
+                              'defaults,noatime,nodiratime,nobarrier,'
+                              'logbufs=8'),
+                self.conf.get('exclude', ''),
+                self.conf.get('force', 'false').lower() in ('true', 'yes',
+                                                            '1'))
+
+        "Info for drive_bench section"
+        self.conf = readconf(conf_file, 'drive_bench')
+        self.drive_bench = None
+        if self.conf.get('enabled', 'false').lower() in ('true', 'yes', '1'):
+            self.drive_bench = DriveBenchmark(
+                self.report_dir,
+                self.drives.mount_root if self.drives else '/srv/node',
+                self.conf.get('size', '1G'),
+                self.conf.get('runtime', 10),
+                self.conf.get('outlier_ratio', 0.7),
+                self.conf.get('base_weight', 'capacity'))
+
+        "Info for irq_tuning section"
+        self.conf = readconf(conf_file, 'irq_tuning')
+        self.irq_tuner = None
+        if self.conf.get('enabled', 'false').lower() in ('true', 'yes', '1'):
+            self.irq_tuner = IrqTuner(self.conf.get('reserved_cpus', ''),
+                                      self.conf.get('interfaces', ''))
+
         "Some Fabric environmental variables"
         env.user = self.user
         env.key_filename = self.key
         env.warn_only = True
-        env.parallel = True
-        env.pool_size = 5
+        env.parallel = False
+
+        "Order in which queued services are restarted, swift goes last"
+        self.restart_order = ['procps', 'ntp', 'exim4', 'aliases',
+                              'syslog-ng', 'snmpd', 'memcached', 'rsync',
+                              'nginx', 'git-daemon', 'storage-agent',
+                              'swift']
 
         "Keyring packages that might be needed"
         self.keyrings = ['ubuntu-cloud-keyring']
@@ -58,34 +167,125 @@ class DeployNode(object):
                               'nmon', 'strace', 'iotop', 'debsums',
                               'python-pip', 'snmpd', 'snmp', 'bsd-mailx',
                               'xfsprogs', 'ntp', 'snmp-mibs-downloader',
-                              'exim4', 'screen']
+                              'exim4', 'screen', 'parted']
 
         if not os.path.isfile(self.key):
             status = 404
             msg = 'SSH private key could not be located [%s]' % self.key
             raise ResponseError(status, msg)
 
-    def _sync_files(self, sys_type='generic'):
+    def _sync_trees(self, sys_type='generic'):
         """
-        Syncing repo files to admin /
+        Returns the repo trees synced to / for a system type, in the
+        order they are synced
         """
-        sys_path = {'admin': '/root/local/admin/',
-                    'proxy': '/root/local/proxy/',
-                    'storage': '/root/local/storage/',
-                    'generic': '/root/local/common/'}
-
         if sys_type == 'generic':
-            sudo('rsync -aq0c --exclude=".git" --exclude=".ignore" %s /'
-                 % (sys_path[sys_type]))
+            return ['common']
         elif sys_type == 'saio':
-            for x in ['generic', 'proxy', 'storage']:
-                sudo('rsync -aq0c --exclude=".git" --exclude=".ignore" %s /'
-                     % (sys_path[x]))
-        else:
-            sudo('rsync -aq0c --exclude=".git" --exclude=".ignore" %s /'
-                 % (sys_path['generic']))
-            sudo('rsync -aq0c --exclude=".git" --exclude=".ignore" %s /'
-                 % (sys_path[sys_type]))
+            return ['common', 'proxy', 'storage']
+        return ['common', sys_type]
+
+    def _sync_files(self, sys_type='generic', script=None):
+        """
+        Syncing repo files to admin /
+
+        :param script: RemoteScript the rsync steps are added to. When
+                       not provided the steps are run right away
+        """
+        sync = script or RemoteScript('sync_files')
+        for tree in self._sync_trees(sys_type):
+            path = '/root/local/%s/' % tree
+            sync.add('rsync %s' % path,
+                     'rsync -aq0c --exclude=".git" --exclude=".ignore" %s /'
+                     % path)
+        if script is None:
+            sync.run()
+
+    def _apply_configs(self, sys_type='generic'):
+        """
+        Compares the manifest of the freshly pulled repo against the one
+        last applied on the system, copies over only the files that have
+        changed and queues the restart of the services affected by them.
+        Nothing gets restarted by a deploy that changes nothing.
+        """
+        trees = self._sync_trees(sys_type)
+        applied = '%s/applied.%s.manifest' % (self.state_dir,
+                                              '-'.join(trees))
+        pending = self.state_dir + '/pending_restarts'
+        split = '__SWIFT_SETUP_APPLIED__'
+
+        output = sudo('%s; echo %s; cat %s 2>/dev/null; true'
+                      % (manifest_command('/root/local', trees), split,
+                         applied))
+        if split not in output:
+            status = 500
+            msg = 'Unable to generate the manifest of /root/local'
+            raise ConfigSyncError(status, msg)
+        new_text, old_text = output.split(split, 1)
+        new = parse_manifest(new_text)
+        old = parse_manifest(old_text)
+
+        changes = changed_files(old, new)
+        paths = []
+        for files in changes.values():
+            paths.extend(files)
+        services = services_for(paths)
+        if not old:
+            services = sorted(set(services + FIRST_INSTALL_SERVICES))
+
+        script = RemoteScript('apply_configs')
+        script.add('mkdir state', 'mkdir -p %s' % self.state_dir)
+        for tree in trees:
+            if tree not in changes:
+                continue
+            "The list is uploaded, the paths never go through the shell"
+            file_list = '/tmp/swift-setup.%s.files' % tree
+            upload(''.join(['%s\n' % path for path in changes[tree]]),
+                   file_list)
+            script.add('rsync %s' % tree,
+                       'rsync -aq --files-from=%s /root/local/%s/ /'
+                       % (file_list, tree), fatal=True,
+                       error=ConfigSyncError,
+                       msg='Unable to sync changed files of %s' % tree)
+        if services:
+            script.add('queue restarts',
+                       "printf '%%s\\n' %s >> %s"
+                       % (' '.join([quote(s) for s in services]), pending))
+        script.add('save manifest',
+                   '%s > %s' % (manifest_command('/root/local', trees),
+                                applied), fatal=True, error=ConfigSyncError,
+                   msg='Unable to save the applied manifest')
+        script.run()
+        print ("\t[%s] %d changed file(s), restart queued for: %s"
+               % (env.host_string, len(paths), ' '.join(services) or 'none'))
+
+    def _host_var_files(self, sys_type):
+        """
+        Returns the rendered files of a system type that still hold host
+        variables, as returned by host_var_files
+        """
+        if sys_type not in self.host_files:
+            self.host_files[sys_type] = host_var_files(
+                self.tmpl_dir, self._sync_trees(sys_type), self.host_vars)
+        return self.host_files[sys_type]
+
+    def _host_values(self, sys_type, facts):
+        """
+        Derives the values of the host variables of the current system
+        from its hardware facts, using the formulas of the host_vars
+        and host_vars:<type> sections
+        """
+        formulas = read_formulas(self.host_conf, sys_type)
+        used = set()
+        for tree, path, names in self._host_var_files(sys_type):
+            used.update(names)
+        missing = sorted(used - set(formulas))
+        if missing:
+            status = 500
+            msg = ('No formula for host variable(s) %s on %s systems'
+                   % (', '.join(missing), sys_type))
+            raise ConfigFileError(status, msg)
+        return derive_values(dict((n, formulas[n]) for n in used), facts)
 
     def _setup_swiftuser(self):
         """
@@ -93,26 +293,79 @@ class DeployNode(object):
         could later on be changed from system setup to another due to
         some ubuntu changes as it has happened before with mlocate
         """
-        if run('id swift', quiet=True).failed:
-            sudo('groupadd -g 400 swift')
-            sudo('useradd -u 400 -g swift -G adm -M -s /bin/false swift')
+        script = RemoteScript('setup_swiftuser')
+        script.add('swift user',
+                   'groupadd -g 400 swift && '
+                   'useradd -u 400 -g swift -G adm -M -s /bin/false swift',
+                   check='id swift')
+        script.run()
 
     def _pull_configs(self, sys_type):
         """
-        This function will git clone the repo on the admin box
-        and then sync it over to the root
-        """
-        if sudo('test -d /root/local').succeeded:
-            sudo('mv -f /root/local /root/local.old')
-
-        sudo('git clone git://%s/%s /root/local' % (self.admin_ip,
-                                                    self.repo_name))
-        if sudo('test -d /root/local/common').failed:
-            status = 404
-            msg = 'Directory was not found! (/root/local/common)'
-            raise ConfigSyncError(status, msg)
-
-        self._sync_files(sys_type)
+        This function will get the repo from the admin box into
+        /root/local and then sync it over to the root. Depending on
+        the config_sync mode it does:
+
+            clone   - full git clone (previous checkout kept as local.old)
+            shallow - git clone with a depth of 1
+            fetch   - fetch only the new objects into the existing
+                      checkout (shallow clone if there is none)
+            bundle  - same as fetch but from the git bundle served by the
+                      admin nginx, which spares the admin git-daemon
+        """
+        source = 'git://%s/%s' % (self.admin_ip, self.repo_name)
+        depth = '--depth 1 '
+        script = RemoteScript('pull_configs')
+
+        if self.config_sync == 'bundle':
+            bundle = '/tmp/%s.bundle' % self.repo_name
+            url = 'http://%s/%s/%s.bundle' % (
+                self.admin_ip, os.path.basename(self.bundle_dir.rstrip('/')),
+                self.repo_name)
+            script.add('download bundle',
+                       'curl -sfS -o %s %s' % (bundle, url),
+                       fatal=True, error=ConfigSyncError, status=404,
+                       msg='Unable to download config bundle (%s)' % url)
+            source = bundle
+            depth = ''
+
+        if self.config_sync == 'clone':
+            script.add('move old checkout',
+                       'mv -f /root/local /root/local.old',
+                       check='test ! -d /root/local')
+            script.add('git clone', 'git clone %s /root/local' % source)
+        elif self.config_sync == 'shallow':
+            script.add('remove old checkout', 'rm -rf /root/local')
+            script.add('git clone',
+                       'git clone -q %s%s /root/local' % (depth, source))
+        else:
+            script.add('git fetch',
+                       'if [ -d /root/local/.git ]; then cd /root/local && '
+                       'git fetch -q %s%s %s && '
+                       'git reset -q --hard FETCH_HEAD && git clean -qfd; '
+                       'else rm -rf /root/local && '
+                       'git clone -q %s%s /root/local; fi'
+                       % (depth, source, self.repo_branch, depth, source),
+                       fatal=True, error=ConfigSyncError, status=500,
+                       msg='Unable to update /root/local from %s' % source)
+        script.add('check checkout', 'test -d /root/local/common',
+                   fatal=True, error=ConfigSyncError, status=404,
+                   msg='Directory was not found! (/root/local/common)')
+
+        files = self._host_var_files(sys_type)
+        if files:
+            facts = parse_facts(sudo(FACTS_COMMAND))
+            values = self._host_values(sys_type, facts)
+            print ("\t[%s] %s -> %s"
+                   % (env.host_string,
+                      ' '.join(['%s=%s' % f for f in sorted(facts.items())]),
+                      ' '.join(['%s=%s' % v for v in sorted(values.items())])))
+            script.add('render host vars',
+                       substitute_command('/root/local', files, values),
+                       fatal=True, error=ConfigSyncError,
+                       msg='Unable to render the host variables')
+        script.run()
+        self._apply_configs(sys_type)
 
     def _set_onhold(self, sys_type=''):
         """
@@ -125,60 +378,100 @@ class DeployNode(object):
             p = self.swift_storage.split() + self.swift_others.split()
 
         pkgs = self.swift_generic.split() + p
+        script = RemoteScript('set_onhold')
         for name in pkgs:
-            sudo('echo "%s hold" | dpkg --set-selections' % name)
+            script.add('hold %s' % name,
+                       'echo "%s hold" | dpkg --set-selections' % name)
+        script.run()
 
-    def _final_install_touches(self, sys_type=''):
+    def _setup_drives(self):
         """
-        Creates directories, sets ownerships, restart services .. etc
+        Partitions, formats, mounts and adds to fstab the data drives
         """
-        if sudo('test -e /var/cache/swift').failed:
-            sudo('mkdir -p /var/cache/swift')
-        sudo('chown -R swift.swift /var/cache/swift')
-
-        if sudo(test -e /var/log/swift).failed:
-            sudo('mkdir -p /var/log/swift')
-
-        if sudo('test -e /var/log/swift/stats').failed:
-            sudo('mkdir -p /var/log/swift/stats')
-        sudo('chown -R swift.swift /var/log/swift/stats')
+        drives, results = self.drives.provision()
+        for drive in drives:
+            result = results.get(drive['label'])
+            if drive['action'] == 'skip':
+                print ("\t[%s] %s: skipped, %s"
+                       % (env.host_string, drive['name'], drive['reason']))
+            elif result:
+                print ("\t[%s] %s (%s): %s in %.1fs"
+                       % (env.host_string, drive['label'], drive['name'],
+                          result['action'], result['duration']))
 
-        if sys_type == 'proxy':
-            if sudo('test -e /var/log/swift/hourly').failed:
-                sudo('mkdir -p /var/log/swift/hourly')
-
-        sudo('chown -R swift.swift /etc/swift')
-        sudo('rm -f /etc/swift/*.dpkg-dist')
-        sudo('newaliases')
+    def _bench_drives(self):
+        """
+        Benchmarks the data drives and prints the recommended weights
+        """
+        drives = self.drive_bench.run(env.host_string)
+        for d in drives:
+            print ("\t[%s] %-8s seq w/r %6.1f/%6.1f MB/s  rand w/r "
+                   "%6.0f/%6.0f iops  %6.2f ms  weight %8.2f%s"
+                   % (env.host_string, d['label'], d.get('seq_write', 0),
+                      d.get('seq_read', 0), d.get('rand_write', 0),
+                      d.get('rand_read', 0), d.get('latency', 0),
+                      d['weight'], d['flagged'] and '  SLOW (%s)'
+                      % ', '.join(d['flagged']) or ''))
 
-        if sys_type == 'storage' or sys_type == 'saio':
-            if sudo('test -e /srv/node').failed:
-                sudo('mkdir -p /srv/node')
-            sudo('chown swift.swift /srv/node/*')
+    def _irq_tuning(self):
+        """
+        Pins the NIC queue interrupts to cpus and sets the RPS/XPS masks
+        """
+        plan = self.irq_tuner.tune()
+        for iface in sorted(plan):
+            print ("\t[%s] %s: %s" % (env.host_string, iface, ' '.join(
+                ['%s=%s' % v for v in plan[iface]['vectors']])))
 
+    def _final_install_touches(self, sys_type=''):
         """
-        Restart/Start some processes
+        Creates directories, sets ownerships, restart services .. etc
         """
-        sudo('service procps restart')
-        sudo('service ntp start')
-        sudo('service exim4 restart')
-        sudo('service syslog-ng restart')
+        script = RemoteScript('final_install_touches')
+        dirs = ['/var/cache/swift', '/var/log/swift', '/var/log/swift/stats']
+        if sys_type == 'proxy':
+            dirs.append('/var/log/swift/hourly')
         if sys_type == 'storage' or sys_type == 'saio':
-            sudo('service rsync restart')
+            dirs.append('/srv/node')
+        for path in dirs:
+            script.add('mkdir %s' % path, 'mkdir -p %s' % path,
+                       check='test -e %s' % path)
+
+        script.add('chown cache', 'chown -R swift.swift /var/cache/swift')
+        script.add('chown stats', 'chown -R swift.swift /var/log/swift/stats')
+        script.add('chown etc', 'chown -R swift.swift /etc/swift')
+        script.add('remove dpkg-dist', 'rm -f /etc/swift/*.dpkg-dist')
+        if sys_type == 'storage' or sys_type == 'saio':
+            script.add('chown node', 'chown swift.swift /srv/node/*')
+            script.add('enable storage agent',
+                       'update-rc.d swift-storage-agent defaults',
+                       check='ls /etc/rc2.d/S*swift-storage-agent')
 
         """
-        Bring up swift
+        Restart/Start the processes whose configs have changed
         """
-        if not sys_type == '':
-            sudo('swift-init all restart')
+        pending = self.state_dir + '/pending_restarts'
+        installed = self.state_dir + '/installed'
+        queued = sudo('cat %s 2>/dev/null; true' % pending).split()
+        for service in self.restart_order:
+            if service not in queued:
+                continue
+            if service == 'swift' and sys_type == '':
+                continue
+            script.add('restart %s' % service, RESTART_CMDS[service])
+        script.add('clear restarts', 'rm -f %s' % pending)
+
+        first = sudo('test -e %s' % installed).failed
+        script.add('mark installed', 'touch %s' % installed)
+        script.run()
 
         """
         Reboot system
         """
-        if sudo('reboot').failed:
-            status = 500
-            msg = 'Error trying to reboot system'
-            raise ResponseError(status, msg)
+        if self.reboot == 'always' or (self.reboot == 'first' and first):
+            if sudo('reboot').failed:
+                status = 500
+                msg = 'Error trying to reboot system'
+                raise ResponseError(status, msg)
 
     def _swift_install(self, sys_type='generic'):
         """
@@ -231,30 +524,43 @@ class DeployNode(object):
         Really just a wrapper function to identify task
         """
         with settings(hide('running', 'stdout', 'stderr', 'warnings')):
-            self._pull_configs('proxy')
-            self._swift_install('proxy')
-            self._set_onhold('proxy')
-            self._final_install_touches('proxy')
+            self._phase('proxy_pull_configs', self._pull_configs, 'proxy')
+            self._phase('proxy_swift_install', self._swift_install, 'proxy')
+            self._phase('proxy_set_onhold', self._set_onhold, 'proxy')
+            if self.irq_tuner:
+                self._phase('proxy_irq_tuning', self._irq_tuning)
+            self._phase('proxy_final_install_touches',
+                        self._final_install_touches, 'proxy')
 
     def _swift_storage_setup(self):
         """
         Really just a wrapper function to identify task
         """
         with settings(hide('running', 'stdout', 'stderr', 'warnings')):
-            self._pull_configs('storage')
-            self._swift_install('storage')
-            self._set_onhold('storage')
-            self._final_install_touches('storage')
+            self._phase('storage_pull_configs', self._pull_configs,
+                        'storage')
+            self._phase('storage_swift_install', self._swift_install,
+                        'storage')
+            self._phase('storage_set_onhold', self._set_onhold, 'storage')
+            if self.drives:
+                self._phase('storage_drives', self._setup_drives)
+            if self.drive_bench:
+                self._phase('storage_drive_bench', self._bench_drives)
+            if self.irq_tuner:
+                self._phase('storage_irq_tuning', self._irq_tuning)
+            self._phase('storage_final_install_touches',
+                        self._final_install_touches, 'storage')
 
     def _swift_generic_setup(self):
         """
         Really just a wrapper function to identify task
         """
         with settings(hide('running', 'stdout', 'stderr', 'warnings')):
-            self._pull_configs('generic')
-            self._swift_install()
-            self._set_onhold('generic')
-            self._final_install_touches()
+            self._phase('generic_pull_configs', self._pull_configs, 'generic')
+            self._phase('generic_swift_install', self._swift_install)
+            self._phase('generic_set_onhold', self._set_onhold, 'generic')
+            self._phase('generic_final_install_touches',
+                        self._final_install_touches)
 
     def _swift_saio_setup(self):
         """
@@ -263,122 +569,400 @@ class DeployNode(object):
         self._swift_storage_setup()
         self._swift_proxy_setup()
 
+    def _admin_repo(self, remote_path):
+        """
+        Pushes the templates to the admin system and initializes
+        the git repository with them
+        """
+        sudo('mkdir -p %s' % remote_path)
+        local_path = self.tmpl_dir + '/*'
+        if put(local_path, remote_path,
+               use_sudo=True, mirror_local_mode=True).failed:
+            status = 500
+            msg = '''
+                  Uploading template files to remote admin system has
+                  failed. [remote path: %s]
+                  ''' % remote_path
+            disconnect_all()
+            raise UploadTemplatesError(status, msg)
+        """
+        Let's change the ownership of the pushed templates
+        """
+        sudo('chown -R root.root %s' % remote_path)
+
+        """
+        Initialize git repo
+        """
+        git_dir = remote_path + ".git"
+        sudo('git --git-dir=%s --work-tree=%s init'
+             % (git_dir, remote_path))
+        sudo('git --git-dir=%s --work-tree=%s add .'
+             % (git_dir, remote_path))
+        sudo('git --git-dir=%s --work-tree=%s commit -qam "initial"'
+             % (git_dir, remote_path))
+        if sudo('test -e %s' % git_dir).failed:
+            status = 500
+            msg = 'Issue initializing git repo on admin setup'
+            raise ResponseError(status, msg)
+
+    def _admin_checkout(self, remote_path):
+        """
+        Clones the admin git repository into /root/local
+        """
+        if sudo('test -e /root/local').succeeded:
+            sudo('mv -f /root/local /root/local.old')
+        sudo('git clone -q file:///%s /root/local' % (remote_path,))
+
+    def _admin_bundle(self, remote_path):
+        """
+        Publishes the config repo as a git bundle under the nginx root,
+        and installs a post-commit hook that keeps it up to date, so the
+        nodes can pull it as a static file
+        """
+        git_dir = remote_path + '.git'
+        bundle = '%s/%s.bundle' % (self.bundle_dir.rstrip('/'),
+                                   self.repo_name)
+        bundle_cmd = ('git --git-dir=%s bundle create %s.tmp --all && '
+                      'mv -f %s.tmp %s' % (git_dir, bundle, bundle, bundle))
+        hook = git_dir + '/hooks/post-commit'
+
+        script = RemoteScript('admin_bundle')
+        script.add('mkdir bundle dir', 'mkdir -p %s' % self.bundle_dir)
+        script.add('create bundle', bundle_cmd, fatal=True,
+                   error=ConfigSyncError,
+                   msg='Unable to create config bundle (%s)' % bundle)
+        script.add('post-commit hook',
+                   "printf '#!/bin/sh\\n%s >/dev/null 2>&1\\n' > %s && "
+                   "chmod 755 %s" % (bundle_cmd, hook, hook))
+        script.run()
+
+    def _admin_services(self):
+        """
+        Restarting some services
+        """
+        if sudo('service git-daemon start').failed:
+            status = 500
+            msg = 'Error restarting git-daemon'
+            raise ResponseError(status, msg)
+        if sudo('service nginx restart').failed:
+            status = 500
+            msg = 'Error restarting nginx'
+            raise ResponseError(status, msg)
+
+    def _admin_reboot(self):
+        """
+        Reboot system
+        """
+        if sudo('reboot').failed:
+            status = 500
+            msg = 'Error trying to reboot system'
+            raise ResponseError(status, msg)
+        else:
+            print "\nRebooting ... Please wait until it's back online"
+            print "to proceed with any other deploys\n"
+            print "Also verify that all required services"
+            print "are running on the admin system after the reboot"
+
     def _admin_setup(self):
         """
         This function will take care of setting up the admin
-        system with what is needed
+        system with what is needed. When resuming a deploy, a repository
+        left behind by a previous run is not a reason to abort.
         """
         admin_pkgs = ['rsync', 'dsh', 'git', 'git-core', 'nginx',
                       'subversion', 'git-daemon-sysvinit', 'expect']
+        remote_path = self.repo_base + '/' + self.repo_name + '/'
 
         with settings(hide('running', 'stdout', 'stderr', 'warnings')):
-            sudo('apt-get install %s %s ' % (self.apt_opts,
-                                             ' '.join(admin_pkgs)))
-            if sudo('test -e %s'
-                    % (self.repo_base + '/' + self.repo_name)).failed:
-                sudo('mkdir -p %s' % (self.repo_base + '/' + self.repo_name))
-                local_path = self.tmpl_dir + '/*'
-                remote_path = self.repo_base + '/' + self.repo_name + '/'
-                if put(local_path, remote_path,
-                       use_sudo=True, mirror_local_mode=True).failed:
-                    status = 500
-                    msg = '''
-                          Uploading template files to remote admin system has
-                          failed. [remote path: %s]
-                          ''' % remote_path
-                    disconnect_all()
-                    raise UploadTemplatesError(status, msg)
-                """
-                Let's change the ownership of the pushed templates
-                """
-                sudo('chown -R root.root %s' % remote_path)
-
-                """
-                Initialize git repo
-                """
-                git_dir = remote_path + ".git"
-                sudo('git --git-dir=%s --work-tree=%s init'
-                     % (git_dir, remote_path))
-                sudo('git --git-dir=%s --work-tree=%s add .'
-                     % (git_dir, remote_path))
-                sudo('git --git-dir=%s --work-tree=%s commit -qam "initial"'
-                     % (git_dir, remote_path))
-                if sudo('test -e %s' % git_dir).failed:
-                    status = 500
-                    msg = 'Issue initializing git repo on admin setup'
-                    raise ResponseError(status, msg)
-
-                if sudo('test -e /root/local').succeeded:
-                    sudo('mv -f /root/local /root/local.old')
-                    sudo('git clone -q file:///%s /root/local'
-                         % (remote_path,))
-                else:
-                    sudo('git clone -q file:///%s /root/local'
-                         % (remote_path,))
-
-                """
-                Syncing repo files to admin /
-                """
-                self._sync_files('admin')
-
-                """
-                Install swift packages for admin system
-                """
-                self._swift_install('admin')
-
-                """
-                Restarting some services
-                """
-                if sudo('service git-daemon start').failed:
-                    status = 500
-                    msg = 'Error restarting git-daemon'
-                    raise ResponseError(status, msg)
-                if sudo('service nginx restart').failed:
-                    status = 500
-                    msg = 'Error restarting nginx'
-                    raise ResponseError(status, msg)
-                """
-                Reboot system
-                """
-                if sudo('reboot').failed:
-                    status = 500
-                    msg = 'Error trying to reboot system'
-                    raise ResponseError(status, msg)
-                else:
-                    print "\nRebooting ... Please wait until it's back online"
-                    print "to proceed with any other deploys\n"
-                    print "Also verify that all required services"
-                    print "are running on the admin system after the reboot"
-            else:
+            self._phase('admin_packages', sudo,
+                        'apt-get install %s %s ' % (self.apt_opts,
+                                                    ' '.join(admin_pkgs)))
+            if not self.resume and sudo('test -e %s'
+                                        % remote_path).succeeded:
                 status = 500
                 msg = 'System has been setup previously ... Aborting'
                 raise ResponseError(status, msg)
 
-    def deploy_me(self, type, platform, host_list):
-        """
-        This function is used to deploy the node type requested. It will
-        use some helper function to accomplish this.
-        """
+            self._phase('admin_repo', self._admin_repo, remote_path)
+            self._phase('admin_checkout', self._admin_checkout, remote_path)
+            if self.config_sync == 'bundle':
+                self._phase('admin_bundle', self._admin_bundle, remote_path)
+            self._phase('admin_sync_files', self._sync_files, 'admin')
+            self._phase('admin_swift_install', self._swift_install, 'admin')
+            if self.pkg_cache:
+                self._phase('admin_package_cache', self.pkg_cache.prefetch,
+                            self._cluster_packages())
+            self._phase('admin_services', self._admin_services)
+            self._phase('admin_reboot', self._admin_reboot)
+
+    def _cluster_packages(self):
+        """
+        Union of all packages installed by any of the node types
+        """
+        return (self.keyrings + self.general_tools +
+                self.swift_generic.split() + self.swift_proxy.split() +
+                self.swift_storage.split() + self.swift_others.split())
+
+    def _phase(self, name, func, *args):
+        """
+        Runs one deploy phase on the current host and records the
+        outcome on the journal. When resuming, phases already completed
+        with the same config and templates are skipped.
+        """
+        host = env.host_string
+        if self.resume and self.journal.is_done(host, name):
+            print "\t[%s] Skipping %s (already done)" % (host, name)
+            return
+        recorder.phase = name
+        start = time.time()
+        try:
+            func(*args)
+        except:
+            recorder.record('phase', name, 1, time.time() - start)
+            self.journal.mark(host, name, 'failed', time.time() - start)
+            raise
+        recorder.record('phase', name, 0, time.time() - start)
+        self.journal.mark(host, name, 'done', time.time() - start)
+
+    def _deploy_host(self, type):
+        """
+        Runs the common setup followed by the role setup on a single
+        host, so that the scheduler can roll hosts through the whole
+        deploy one slot at a time. Both phases share the same ssh session.
+        The timing records of the host are written to its own part of the
+        report, even when the deploy fails.
+        """
+        recorder.reset()
+        try:
+            self.sessions.session('common_setup')
+            if self.pkg_cache and type != 'admin':
+                self._phase('package_cache_client',
+                            self.pkg_cache.point_node)
+            self._phase('common_setup', self._common_setup)
+
+            self.sessions.session('%s_setup' % type)
+            if type == 'admin':
+                self._admin_setup()
+            elif type == 'generic':
+                self._swift_generic_setup()
+            elif type == 'proxy':
+                self._swift_proxy_setup()
+            elif type == 'storage':
+                self._swift_storage_setup()
+            elif type == 'saio':
+                self._swift_saio_setup()
+        finally:
+            if self.report_path:
+                write_report('%s.%s' % (self.report_path,
+                                        env.host_string.replace('/', '_')),
+                             recorder.records)
+
+        return {'sessions': self.sessions.stats()}
+
+    def _phase_names(self, type):
+        """
+        Returns the names of the phases a deploy of the given type runs
+        """
+        role_phases = ['pull_configs', 'swift_install', 'set_onhold',
+                       'final_install_touches']
+        phases = []
+        if self.pkg_cache and type != 'admin':
+            phases.append('package_cache_client')
+        phases.append('common_setup')
 
-        self.tmpl_dir = self.base_dir + '/templates'
+        if type == 'admin':
+            phases += ['admin_packages', 'admin_repo', 'admin_checkout']
+            if self.config_sync == 'bundle':
+                phases.append('admin_bundle')
+            phases += ['admin_sync_files', 'admin_swift_install']
+            if self.pkg_cache:
+                phases.append('admin_package_cache')
+            phases += ['admin_services', 'admin_reboot']
+        elif type == 'saio':
+            for role in ['storage', 'proxy']:
+                phases += ['%s_%s' % (role, p) for p in role_phases]
+        else:
+            phases += ['%s_%s' % (type, p) for p in role_phases]
+        if 'storage_set_onhold' in phases:
+            idx = phases.index('storage_set_onhold') + 1
+            if self.drive_bench:
+                phases.insert(idx, 'storage_drive_bench')
+            if self.drives:
+                phases.insert(idx, 'storage_drives')
+        if self.irq_tuner:
+            for role in ['storage', 'proxy']:
+                if '%s_final_install_touches' % role in phases:
+                    phases.insert(phases.index(
+                        '%s_final_install_touches' % role),
+                        '%s_irq_tuning' % role)
+        return phases
+
+    def _plan_host(self, type, manifest, durations):
+        """
+        Gathers the state of the current host in a single round trip
+        and works out what a deploy of the given type would do to it.
+        Nothing is changed on the host.
+
+        :param manifest: Parsed manifest of the local template trees
+        :param durations: Phase timings recorded by previous runs
+        """
+        host = env.host_string
+        pkgs = self.keyrings + self.general_tools + \
+            self.swift_generic.split()
+        if type in ('proxy', 'saio'):
+            pkgs += self.swift_proxy.split() + self.swift_others.split()
+        if type in ('storage', 'saio'):
+            pkgs += self.swift_storage.split() + self.swift_others.split()
+        pkgs = sorted(set(pkgs))
+        trees = self._sync_trees(type)
+        applied = '%s/applied.%s.manifest' % (self.state_dir, '-'.join(trees))
+        installed = self.state_dir + '/installed'
+
+        with settings(hide('running', 'stdout', 'stderr', 'warnings')):
+            output = sudo("echo __PKGS__; "
+                          "dpkg-query -W -f='${Package} ${Status}\\n' "
+                          "%s 2>/dev/null; echo __UPGRADES__; "
+                          "apt-get -s upgrade 2>/dev/null | grep -c '^Inst'; "
+                          "echo __APPLIED__; cat %s 2>/dev/null; "
+                          "echo __INSTALLED__; test -e %s && echo yes; "
+                          "echo __FACTS__; %s; true"
+                          % (' '.join(pkgs), applied, installed,
+                             FACTS_COMMAND))
+
+        sections = {}
+        current = None
+        for line in output.splitlines():
+            line = line.strip()
+            if line.startswith('__') and line.endswith('__'):
+                current = line.strip('_')
+                sections[current] = []
+            elif current:
+                sections[current].append(line)
+
+        present = set()
+        for line in sections.get('PKGS', []):
+            parts = line.split()
+            if parts and parts[-1] == 'installed':
+                present.add(parts[0])
+        missing = [p for p in pkgs if p not in present]
+
+        upgrades = 0
+        if sections.get('UPGRADES') and sections['UPGRADES'][0].isdigit():
+            upgrades = int(sections['UPGRADES'][0])
+
+        files = self._host_var_files(type)
+        if files and type != 'admin':
+            values = self._host_values(
+                type, parse_facts('\n'.join(sections.get('FACTS', []))))
+            manifest = dict(manifest)
+            for tree, path, names in files:
+                with open(os.path.join(self.tmpl_dir, tree, path)) as f:
+                    body = render_host_vars(f.read(), values)
+                manifest[path] = (md5(body).hexdigest(), tree)
+
+        old = parse_manifest('\n'.join(sections.get('APPLIED', [])))
+        first = 'yes' not in sections.get('INSTALLED', [])
+        changed = []
+        if type != 'admin':
+            for files in changed_files(old, manifest).values():
+                changed.extend(files)
+        changed.sort()
+        services = services_for(changed)
+        if not old:
+            services = sorted(set(services + FIRST_INSTALL_SERVICES))
+
+        phases = [p for p in self._phase_names(type)
+                  if not (self.resume and self.journal.is_done(host, p))]
+        reboot = self.reboot == 'always' or \
+            (self.reboot == 'first' and first) or type == 'admin'
+        return {'missing': missing, 'upgrades': upgrades,
+                'changed': changed, 'services': services,
+                'reboot': reboot, 'phases': phases,
+                'estimate': host_estimate(phases, durations, reboot)}
+
+    def _prepare(self):
+        """
+        Checks that the templates have been rendered and opens
+        the deploy journal
+        """
         if not os.path.isfile(self.tmpl_dir + '/.initialized'):
             print "\tTemplates have not yet been initialized. Please first"
             print "\tmake proper changes to the swift-setup.conf file and than"
             print "\trun swift-setup init with sudo or as root user\n\n"
             return False
 
-        execute(self._common_setup, hosts=host_list)
+        self.journal = DeployJournal(self.journal_dir,
+                                     tree_fingerprint(self.conf_file,
+                                                      self.tmpl_dir))
+        return True
 
-        if type == 'admin':
-            execute(self._admin_setup, hosts=host_list)
-        elif type == 'generic':
-            execute(self._swift_generic_setup, hosts=host_list)
-        elif type == 'proxy':
-            execute(self._swift_proxy_setup, hosts=host_list)
-        elif type == 'storage':
-            execute(self._swift_storage_setup, hosts=host_list)
-        elif type == 'saio':
-            execute(self._swift_saio_setup, hosts=host_list)
+    def plan_me(self, type, host_list):
+        """
+        Dry-run of deploy_me. State is gathered from all hosts in
+        parallel and the actions a deploy would take on each of them
+        are printed along with a time estimate based on previous runs.
+        """
+        if not self._prepare():
+            return False
 
+        manifest = parse_manifest(generate_manifest(self.tmpl_dir,
+                                                    self._sync_trees(type)))
+        durations = self.journal.durations()
+        scheduler = DeployScheduler(self.concurrency, self.concurrency, 0)
+        statuses = scheduler.run(self._plan_host, host_list, type, manifest,
+                                 durations)
         disconnect_all()
+
+        print "\n\tDeploy plan (%s)\n" % type
+        estimates = []
+        for host in host_list:
+            plan = scheduler.results.get(host)
+            if not statuses.get(host) or not plan:
+                print "%s\n    unreachable, no plan available" % host
+                continue
+            estimates.append(plan['estimate'])
+            print '\n'.join(format_host_plan(host, plan))
+
+        failed = len(host_list) - len(estimates)
+        print ("\n\t%d host(s) planned, %d unreachable, estimated "
+               "duration ~%s with a concurrency of %d"
+               % (len(estimates), failed,
+                  format_duration(wall_estimate(estimates, self.concurrency)),
+                  self.concurrency))
+        return failed == 0
+
+    def deploy_me(self, type, platform, host_list):
+        """
+        This function is used to deploy the node type requested. It will
+        use some helper function to accomplish this.
+        """
+        if not self._prepare():
+            return False
+
+        self.report_path = '%s/deploy-%s-%s.jsonl' % (
+            self.report_dir, type, time.strftime('%Y%m%d%H%M%S'))
+
+        scheduler = DeployScheduler(self.concurrency, self.zone_concurrency,
+                                    self.wave_size,
+                                    generate_zone_map(self.base_dir,
+                                                      host_list))
+        statuses = scheduler.run(self._deploy_host, host_list, type)
+
+        disconnect_all()
+        sessions = merge_session_stats([r.get('sessions') for r in
+                                        scheduler.results.values() if r])
+        print ("\n\tSSH sessions: %d handshake(s) in %.1fs for %d host(s), "
+               "%.1f per host (max %d), %d phase(s) reused an open session"
+               % (sessions['handshakes'], sessions['handshake_time'],
+                  sessions['hosts'], sessions['per_host'],
+                  sessions['max_handshakes'], sessions['reuses']))
+
+        records = merge_reports(self.report_path, host_list)
+        print "\n\tDeploy report: %s\n" % self.report_path
+        print '\n'.join(['\t' + line for line in summarize(records)])
+
+        failed = sorted([h for h in host_list if not statuses.get(h)])
+        if failed:
+            print "\n\tDeploy has failed on: %s" % (' '.join(failed))
+            return False
         return True
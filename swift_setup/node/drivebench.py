@@ -0,0 +1,259 @@
+""" See COPYING for license information """
+
+import os
+import json
+import time
+from swift_setup.common.exceptions import DiskSetupError
+from swift_setup.node.batch import RemoteScript, upload
+from swift_setup.node.report import sudo
+
+
+"Markers of the lines printed by the benchmark script"
+BENCH_MARKER = '__SWIFT_SETUP_BENCH__'
+BENCH_END_MARKER = '__SWIFT_SETUP_BENCH_END__'
+
+"""
+fio jobs run on every drive one after the other: name, rw mode and block
+size. Higher is better for every metric but latency.
+"""
+JOBS = [
+    ('seq_write', 'write', '1M'),
+    ('seq_read', 'read', '1M'),
+    ('rand_write', 'randwrite', '4k'),
+    ('rand_read', 'randread', '4k'),
+]
+METRICS = ['seq_write', 'seq_read', 'rand_write', 'rand_read', 'latency']
+
+
+def bench_script(labels, mount_root='/srv/node', size='1G', runtime=10):
+    """
+    Returns the bash script that runs the fio jobs on all the given
+    drives at the same time. The fio report of every drive is printed
+    between its markers along with the drive capacity in KB.
+
+    :param labels: Labels of the drives mounted under mount_root
+    :param mount_root: Where the drives are mounted
+    :param size: Size of the test file written on every drive
+    :param runtime: Seconds each of the jobs runs for
+    """
+    root = mount_root.rstrip('/')
+    jobs = ' '.join(['--name=%s --rw=%s --bs=%s --stonewall' % job
+                     for job in JOBS])
+    lines = [
+        '#!/bin/bash',
+        '# Data drive benchmark (swift-setup)',
+        'bench() {',
+        '    label=$1; f=%s/$label/.swift-setup-bench' % root,
+        '    out=/tmp/swift-setup-bench.$label.json',
+        '    fio --output-format=json --output=$out --filename=$f '
+        '--size=%s --direct=1 --ioengine=libaio --iodepth=16 '
+        '--runtime=%d --time_based %s >/dev/null 2>&1'
+        % (size, int(runtime), jobs),
+        '    rc=$?',
+        '    rm -f $f',
+        '    echo "%s $label $rc $(df -P -k %s/$label | '
+        'awk \'NR==2 {print $2}\')"' % (BENCH_MARKER, root),
+        '    [ $rc -eq 0 ] && cat $out',
+        '    echo',
+        '    echo "%s $label"' % BENCH_END_MARKER,
+        '}',
+    ]
+    for label in labels:
+        lines.append('bench %s > /tmp/swift-setup-bench.%s.out &'
+                     % (label, label))
+    lines.append('wait')
+    for label in labels:
+        lines.append('cat /tmp/swift-setup-bench.%s.out' % label)
+    lines.append('exit 0')
+    return '\n'.join(lines) + '\n'
+
+
+def _job_metrics(job):
+    """
+    Returns the (MB/s, iops, mean latency in ms) of a fio job report,
+    for both the fio 2 (usec) and fio 3 (nsec) latency formats
+    """
+    section = job['write'] if job['jobname'].endswith('write') else \
+        job['read']
+    if 'clat_ns' in section:
+        latency = section['clat_ns'].get('mean', 0) / 1000000.0
+    else:
+        latency = section.get('clat', {}).get('mean', 0) / 1000.0
+    return section.get('bw', 0) / 1024.0, section.get('iops', 0), latency
+
+
+def parse_bench(output):
+    """
+    Parses the output of bench_script into a dictionary of label to
+    the drive metrics: status, capacity (GB), seq_write and seq_read
+    (MB/s), rand_write and rand_read (iops) and latency (mean ms of the
+    random jobs)
+
+    :param output: Output of bench_script
+    """
+    results = {}
+    label = None
+    body = []
+    for line in output.splitlines():
+        parts = line.strip().split()
+        if len(parts) >= 3 and parts[0] == BENCH_MARKER:
+            label = parts[1]
+            body = []
+            results[label] = {'status': int(parts[2]) if parts[2].isdigit()
+                              else 1, 'capacity': 0.0}
+            if len(parts) > 3 and parts[3].isdigit():
+                results[label]['capacity'] = int(parts[3]) / 1048576.0
+        elif len(parts) == 2 and parts[0] == BENCH_END_MARKER and label:
+            result = results[label]
+            try:
+                report = json.loads('\n'.join(body))
+            except ValueError:
+                report = None
+                if result['status'] == 0:
+                    result['status'] = 1
+            if report:
+                latencies = []
+                for job in report.get('jobs', []):
+                    mbs, iops, latency = _job_metrics(job)
+                    if job['jobname'].startswith('seq'):
+                        result[job['jobname']] = round(mbs, 1)
+                    else:
+                        result[job['jobname']] = round(iops, 1)
+                        latencies.append(latency)
+                if latencies:
+                    result['latency'] = round(
+                        sum(latencies) / len(latencies), 3)
+            label = None
+        elif label:
+            body.append(line)
+    return results
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return 0
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def recommend_weights(results, ratio=0.7, base_weight='capacity'):
+    """
+    Compares every drive against the median of its siblings. The score
+    of a drive is its worst metric relative to that median (1.0 being
+    as good as the median). Drives scoring below ratio are flagged and
+    get their weight scaled down by their score.
+
+    Returns a list of dictionaries with the label, metrics, score,
+    flagged metrics and recommended weight of every benchmarked drive.
+
+    :param results: Dictionary of label to metrics from parse_bench
+    :param ratio: Score below which a drive is flagged as an outlier
+    :param base_weight: Weight of a healthy drive, a number or capacity
+                        (the drive capacity in GB)
+    """
+    good = dict((l, r) for l, r in results.items() if r['status'] == 0)
+    medians = {}
+    for metric in METRICS:
+        medians[metric] = _median([r[metric] for r in good.values()
+                                   if r.get(metric)])
+
+    drives = []
+    for label in sorted(good):
+        r = good[label]
+        scores = {}
+        for metric in METRICS:
+            if not r.get(metric) or not medians[metric]:
+                continue
+            if metric == 'latency':
+                scores[metric] = medians[metric] / r[metric]
+            else:
+                scores[metric] = r[metric] / medians[metric]
+        score = min(scores.values()) if scores else 1.0
+        flagged = sorted([m for m, s in scores.items() if s < ratio])
+
+        if base_weight == 'capacity':
+            weight = r['capacity']
+        else:
+            weight = float(base_weight)
+        if flagged:
+            weight *= score
+        drive = dict(r)
+        drive.update(label=label, score=round(score, 2), flagged=flagged,
+                     weight=round(weight, 2))
+        drives.append(drive)
+    return drives
+
+
+class DriveBenchmark(object):
+    """
+    Benchmarks all the data drives of a storage node at the same time
+    with sequential and random read/write fio jobs, flags the drives
+    much slower than their siblings and recommends their ring weights.
+    The results of every host are saved as JSON under report_dir.
+
+    :param report_dir: Local directory where the results are saved
+    :param mount_root: Where the drives are mounted
+    :param size: Size of the test file written on every drive
+    :param runtime: Seconds each of the fio jobs runs for
+    :param ratio: Score below which a drive is flagged as an outlier
+    :param base_weight: Weight of a healthy drive, a number or capacity
+    """
+
+    def __init__(self, report_dir, mount_root='/srv/node', size='1G',
+                 runtime=10, ratio=0.7, base_weight='capacity'):
+        self.report_dir = report_dir
+        self.mount_root = mount_root.rstrip('/')
+        self.size = size
+        self.runtime = int(runtime)
+        self.ratio = float(ratio)
+        self.base_weight = base_weight
+
+    def run(self, host):
+        """
+        Benchmarks the drives of the current host and returns the list
+        of drives with their recommended weights
+
+        :param host: Name of the current host (used for the results file)
+        """
+        labels = sudo("for d in %s/*; do mountpoint -q $d && "
+                      "basename $d; done; true" % self.mount_root).split()
+        if not labels:
+            return []
+
+        script = RemoteScript('drive_bench_setup')
+        script.add('install fio',
+                   'export DEBIAN_FRONTEND=noninteractive; '
+                   'apt-get install -y -qq fio', check='which fio',
+                   fatal=True, error=DiskSetupError,
+                   msg='Unable to install fio')
+        script.run()
+
+        path = '/tmp/swift-setup-bench.sh'
+        upload(bench_script(labels, self.mount_root, self.size,
+                            self.runtime), path, 0700)
+        results = parse_bench(sudo('bash %s' % path))
+
+        drives = recommend_weights(results, self.ratio, self.base_weight)
+        failed = [l for l in labels if results.get(l, {}).get('status')]
+        self.save(host, drives, failed)
+        return drives
+
+    def save(self, host, drives, failed):
+        """
+        Saves the results of a host as report_dir/drive-bench/HOST.json
+        """
+        path = os.path.join(self.report_dir, 'drive-bench',
+                            '%s.json' % host.replace('/', '_'))
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        with open(path, 'w') as f:
+            json.dump({'host': host, 'time': time.time(), 'drives': drives,
+                       'failed': failed}, f, indent=1, sort_keys=True)
+        return path
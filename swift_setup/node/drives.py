@@ -0,0 +1,347 @@
+""" See COPYING for license information """
+
+import re
+from swift_setup.common.exceptions import DiskSetupError
+from swift_setup.node.batch import RemoteScript, upload
+from swift_setup.node.report import recorder, sudo
+
+
+"Markers of the lines printed by DISCOVER_SCRIPT and the drive script"
+DISK_MARKER = '__SWIFT_SETUP_DISK__'
+DRIVE_MARKER = '__SWIFT_SETUP_DRIVE__'
+DRIVE_OUT_MARKER = '__SWIFT_SETUP_DRIVE_OUT__'
+
+"""
+Script that prints one line per disk (other than the ones the root
+filesystem lives on, resolved through LVM and md) with its SCSI
+address, size, partitions, partition table, the signatures found on it
+or any of its partitions, its LVM and md membership, the label and
+filesystem of its first partition and where it is mounted
+"""
+DISCOVER_SCRIPT = '''#!/bin/bash
+# Data drive discovery (swift-setup)
+root=$(lsblk -nrso NAME,TYPE "$(findmnt -nvo SOURCE /)" 2>/dev/null | \\
+    awk '$2 == "disk" {print $1}')
+if [ -z "$root" ]; then
+    root=$(basename $(df -P / | awk 'NR==2 {print $1}') | \\
+        sed 's/p\\?[0-9]*$//')
+fi
+pvs=$(pvs --noheadings -o pv_name 2>/dev/null)
+md=$(sed 's/\\[[0-9]*\\]//g; s/([A-Z])//g' /proc/mdstat 2>/dev/null)
+member() {
+    for x in $2; do
+        case ${x#/dev/} in
+            $1|$1[0-9]*|${1}p[0-9]*) echo 1; return;;
+        esac
+    done
+    echo 0
+}
+for d in /sys/block/sd* /sys/block/vd* /sys/block/xvd* /sys/block/nvme*; do
+    [ -e $d/device ] || continue
+    n=$(basename $d)
+    for r in $root; do [ "$n" = "$r" ] && continue 2; done
+    p=$(ls $d | grep "^$n" | head -n 1)
+    echo "%s name=$n hctl=$(basename $(readlink -f $d/device))" \\
+        "size=$(cat $d/size) rm=$(cat $d/removable) part=$p" \\
+        "parts=$(ls $d | grep -c "^$n")" \\
+        "pt=$(blkid -p -o value -s PTTYPE /dev/$n 2>/dev/null)" \\
+        "sigs=$(lsblk -nro FSTYPE /dev/$n 2>/dev/null | grep -v '^$' | \\
+            sort -u | paste -sd, -)" \\
+        "wipe=$(wipefs -n -p /dev/$n 2>/dev/null | grep -vc '^#')" \\
+        "pv=$(member $n "$pvs") md=$(member $n "$md")" \\
+        "label=$(blkid -o value -s LABEL /dev/${p:-$n} 2>/dev/null)" \\
+        "fs=$(blkid -o value -s TYPE /dev/${p:-$n} 2>/dev/null)" \\
+        "mnt=$(lsblk -nro MOUNTPOINT /dev/$n 2>/dev/null | grep -v '^$' | \\
+            head -n 1)"
+done
+''' % DISK_MARKER
+
+HCTL_RE = re.compile(r'^(\d+):(\d+):(\d+):(\d+)$')
+
+
+def parse_disks(output):
+    """
+    Parses the output of DISCOVER_SCRIPT into a list of dictionaries
+    with the name, hctl, size (sectors), rm, part, parts, pt, sigs,
+    wipe, pv, md, label, fs and mnt of every disk
+
+    :param output: Output of DISCOVER_SCRIPT
+    """
+    disks = []
+    for line in output.splitlines():
+        parts = line.split()
+        if not parts or parts[0] != DISK_MARKER:
+            continue
+        disk = {}
+        for token in parts[1:]:
+            if '=' in token:
+                key, value = token.split('=', 1)
+                disk[key] = value
+        if disk.get('name'):
+            disks.append(disk)
+    return disks
+
+
+def _partition(dev):
+    if dev[-1].isdigit():
+        return dev + 'p1'
+    return dev + '1'
+
+
+def plan_drives(disks, naming='auto', mount_root='/srv/node', exclude=(),
+                force=False):
+    """
+    Works out what has to be done on each data drive. Returns a list of
+    dictionaries with the label, dev, part, hctl and action (format,
+    mount or skip) of every drive, plus the reason of the skipped ones.
+
+    Drives labelled cXuY are named after their controller (scsi host,
+    numbered in order) and unit (scsi target) and reached through the
+    /dev/cXuYp udev symlinks, other drives keep their kernel name. A
+    drive that already holds a labelled xfs filesystem keeps its label
+    and is only mounted. Only blank drives (no partition, partition
+    table or signature on the drive or any of its partitions) are
+    formatted, others are left alone unless force is set. Drives used
+    by LVM or md, or mounted outside mount_root, are always left alone.
+
+    :param disks: List of disks as returned by parse_disks
+    :param naming: auto (cXuY when the scsi address is known), cxuy or
+                   name (kernel name)
+    :param mount_root: Where the drives are mounted
+    :param exclude: Kernel names of drives to be ignored
+    :param force: Format drives holding data
+    """
+    hosts = sorted(set([int(HCTL_RE.match(d['hctl']).group(1))
+                        for d in disks if HCTL_RE.match(d.get('hctl', ''))]))
+    drives = []
+    for disk in sorted(disks, key=lambda d: d['name']):
+        name = disk['name']
+        m = HCTL_RE.match(disk.get('hctl', ''))
+        drive = {'name': name, 'hctl': None, 'action': 'format',
+                 'reason': ''}
+        if m and naming != 'name' and name.startswith('sd'):
+            host, bus, target, lun = [int(x) for x in m.groups()]
+            drive['label'] = 'c%du%d' % (hosts.index(host), target)
+            drive['hctl'] = disk['hctl']
+            drive['dev'] = '/dev/%sp' % drive['label']
+            drive['part'] = drive['dev'] + '1'
+        else:
+            drive['label'] = name
+            drive['dev'] = '/dev/' + name
+            drive['part'] = _partition(drive['dev'])
+
+        mnt = disk.get('mnt', '')
+        if name in exclude:
+            drive.update(action='skip', reason='excluded')
+        elif disk.get('rm') == '1' or disk.get('size', '0') == '0':
+            drive.update(action='skip', reason='removable or empty')
+        elif mnt and not mnt.startswith(mount_root.rstrip('/') + '/'):
+            drive.update(action='skip', reason='mounted on %s' % mnt)
+        elif disk.get('pv') == '1' or disk.get('md') == '1':
+            drive.update(action='skip', reason='used by %s' % (
+                'LVM' if disk.get('pv') == '1' else 'md'))
+        elif disk.get('fs') == 'xfs' and disk.get('label'):
+            drive.update(action='mount', label=disk['label'])
+        elif not force:
+            found = []
+            if disk.get('pt'):
+                found.append('%s partition table' % disk['pt'])
+            if disk.get('parts', '0') not in ('', '0'):
+                found.append('%s partition(s)' % disk['parts'])
+            if disk.get('sigs'):
+                found.append(disk['sigs'])
+            elif disk.get('wipe', '0') not in ('', '0'):
+                found.append('%s signature(s)' % disk['wipe'])
+            if found:
+                drive.update(action='skip',
+                             reason='holds data (%s)' % ', '.join(found))
+        drives.append(drive)
+    return drives
+
+
+def udev_rules(drives):
+    """
+    Returns the udev rules giving the cXuY drives their /dev/cXuYp
+    symlinks, so a hot swapped drive keeps its name
+
+    :param drives: List of drives as returned by plan_drives
+    """
+    lines = ['# Swift data drives (swift-setup)']
+    for drive in drives:
+        if drive['hctl'] and drive['action'] != 'skip':
+            lines.append('KERNELS=="%s", KERNEL=="sd*", SYMLINK+="%sp%%n"'
+                         % (drive['hctl'], drive['label']))
+    return '\n'.join(lines) + '\n'
+
+
+def provision_script(drives, workers=8, mount_root='/srv/node',
+                     mkfs_opts='-i size=512', mount_opts='defaults',
+                     fstab='/etc/fstab'):
+    """
+    Returns the bash script that partitions, formats, mounts and adds to
+    fstab all drives at the same time, at most workers at a time. Every
+    drive reports its status, time taken and action.
+
+    :param drives: List of drives as returned by plan_drives
+    :param workers: Number of drives provisioned at the same time
+    :param mount_root: Where the drives are mounted
+    :param mkfs_opts: Options given to mkfs.xfs
+    :param mount_opts: Mount options written to fstab
+    :param fstab: fstab location
+    """
+    root = mount_root.rstrip('/')
+    lines = [
+        '#!/bin/bash',
+        '# Data drive provisioning (swift-setup)',
+        'provision() {',
+        '    label=$1; dev=$2; part=$3; action=$4',
+        '    log=/tmp/swift-setup-drive.$label.log',
+        '    start=$(date +%s%N)',
+        '    {',
+        '        if [ "$action" = "format" ]; then',
+        '            parted -s -a optimal $dev mklabel gpt '
+        'mkpart primary xfs 0% 100% &&',
+        '            udevadm settle &&',
+        '            for i in 1 2 3 4 5; do [ -b $part ] && break; '
+        'sleep 1; done &&',
+        '            mkfs.xfs -f -q %s -L $label $part' % mkfs_opts,
+        '        fi &&',
+        '        mkdir -p %s/$label &&' % root,
+        '        { grep -q " %s/$label " %s || echo "LABEL=$label '
+        '%s/$label xfs %s 0 0" >> %s; } &&' % (root, fstab, root,
+                                               mount_opts, fstab),
+        '        { mountpoint -q %s/$label || mount %s/$label; } &&'
+        % (root, root),
+        '        chown swift:swift %s/$label' % root,
+        '    } > $log 2>&1',
+        '    rc=$?',
+        '    echo "%s $label $rc $(( ($(date +%%s%%N) - start) / 1000000 )) '
+        '$action"' % DRIVE_MARKER,
+        '    if [ $rc -ne 0 ]; then tail -n 3 $log | '
+        'sed "s/^/%s $label /"; fi' % DRIVE_OUT_MARKER,
+        '}',
+        'export -f provision',
+        'xargs -P %d -L 1 bash -c \'provision "$@"\' _ <<EOF' % workers,
+    ]
+    for drive in drives:
+        if drive['action'] != 'skip':
+            lines.append('%s %s %s %s' % (drive['label'], drive['dev'],
+                                          drive['part'], drive['action']))
+    lines += ['EOF', 'exit 0']
+    return '\n'.join(lines) + '\n'
+
+
+def parse_results(output):
+    """
+    Parses the output of the drive script into a dictionary of label to
+    a dictionary with the status, duration, action and output lines
+
+    :param output: Output of provision_script
+    """
+    results = {}
+    for line in output.splitlines():
+        parts = line.strip().split(' ', 2)
+        if len(parts) < 3:
+            continue
+        if parts[0] == DRIVE_MARKER:
+            values = parts[2].split()
+            if len(values) == 3 and values[0].isdigit() and \
+                    values[1].isdigit():
+                results.setdefault(parts[1], {'output': []}).update(
+                    status=int(values[0]),
+                    duration=int(values[1]) / 1000.0, action=values[2])
+        elif parts[0] == DRIVE_OUT_MARKER:
+            results.setdefault(parts[1], {'output': []})['output'].append(
+                parts[2])
+    return results
+
+
+class DriveProvisioner(object):
+    """
+    Provisions the data drives of a storage node. Drives are discovered,
+    given udev rules for stable cXuYp names, then partitioned, formatted
+    with xfs, added to fstab and mounted, all drives concurrently with
+    at most workers at a time. Drives that are already set up are only
+    checked, so it is safe to run on every deploy.
+
+    :param workers: Number of drives provisioned at the same time
+    :param naming: auto, cxuy or name (see plan_drives)
+    :param mount_root: Where the drives are mounted
+    :param inode_size: xfs inode size
+    :param data_opts: xfs data section options (mkfs.xfs -d)
+    :param log_opts: xfs log section options (mkfs.xfs -l)
+    :param mount_opts: Mount options written to fstab
+    :param exclude: Kernel names of drives to be ignored
+    :param force: Format drives that hold a foreign filesystem
+    """
+
+    def __init__(self, workers=8, naming='auto', mount_root='/srv/node',
+                 inode_size=512, data_opts='su=64k,sw=1', log_opts='',
+                 mount_opts='defaults,noatime,nodiratime,nobarrier,logbufs=8',
+                 exclude='', force=False):
+        self.workers = int(workers)
+        self.naming = naming
+        self.mount_root = mount_root
+        self.mkfs_opts = '-i size=%d' % int(inode_size)
+        if data_opts:
+            self.mkfs_opts += ' -d %s' % data_opts
+        if log_opts:
+            self.mkfs_opts += ' -l %s' % log_opts
+        self.mount_opts = mount_opts
+        self.exclude = exclude.split()
+        self.force = force
+        self.rules_file = '/etc/udev/rules.d/10_swift.rules'
+
+    def plan(self):
+        """
+        Discovers the drives of the current host and returns the plan
+        """
+        path = '/tmp/swift-setup-discover.sh'
+        upload(DISCOVER_SCRIPT, path, 0700)
+        return plan_drives(parse_disks(sudo('bash %s' % path)),
+                           self.naming, self.mount_root, self.exclude,
+                           self.force)
+
+    def provision(self):
+        """
+        Provisions every drive of the current host. Returns the plan
+        and the results per label, raising DiskSetupError if any of
+        the drives has failed.
+        """
+        drives = self.plan()
+        todo = [d for d in drives if d['action'] != 'skip']
+        if not todo:
+            return drives, {}
+
+        if [d for d in todo if d['hctl']]:
+            upload(udev_rules(drives), self.rules_file, 0644)
+            script = RemoteScript('drive_udev_rules')
+            script.add('udev trigger',
+                       'udevadm control --reload-rules && '
+                       'udevadm trigger --subsystem-match=block && '
+                       'udevadm settle', fatal=True, error=DiskSetupError,
+                       msg='Unable to load the drive udev rules')
+            script.run()
+
+        path = '/tmp/swift-setup-drives.sh'
+        upload(provision_script(drives, self.workers, self.mount_root,
+                                self.mkfs_opts, self.mount_opts), path, 0700)
+        results = parse_results(sudo('bash %s' % path))
+        for drive in todo:
+            result = results.get(drive['label'])
+            if result and 'status' in result:
+                recorder.record('drive', '%s %s' % (drive['action'],
+                                                    drive['label']),
+                                result['status'], result['duration'])
+
+        failed = []
+        for drive in todo:
+            result = results.get(drive['label'], {})
+            if result.get('status') != 0:
+                failed.append('%s (%s)' % (drive['label'], ' | '.join(
+                    result.get('output', [])) or 'no status'))
+        if failed:
+            status = 500
+            msg = 'Drive setup has failed on: %s' % ', '.join(failed)
+            raise DiskSetupError(status, msg)
+        return drives, results
@@ -0,0 +1,270 @@
+""" See COPYING for license information """
+
+import re
+from swift_setup.node.batch import RemoteScript, upload
+from swift_setup.node.report import sudo
+
+
+"Markers of the sections printed by GATHER_COMMAND"
+NIC_MARKER = '__SWIFT_SETUP_NIC__'
+INTERRUPTS_MARKER = '__SWIFT_SETUP_INTERRUPTS__'
+
+"""
+Shell command that prints, in one round trip, the rx/tx queue count of
+every physical interface followed by /proc/interrupts
+"""
+GATHER_COMMAND = (
+    'for n in /sys/class/net/*; do [ -e $n/device ] && '
+    'echo "%s $(basename $n) $(ls -d $n/queues/rx-* 2>/dev/null | wc -l) '
+    '$(ls -d $n/queues/tx-* 2>/dev/null | wc -l)"; done; '
+    'echo %s; cat /proc/interrupts' % (NIC_MARKER, INTERRUPTS_MARKER))
+
+"""
+Names given to the queue vectors of an interface by the usual drivers
+(e.g: eth0-TxRx-0, eth0-rx-1, eth0:v2-Rx, eth0-3). The first group is
+the queue index.
+"""
+QUEUE_PATTERNS = [
+    r'^%s-(?:TxRx|txrx|rx|tx|Rx|Tx|fp|input|output)[-.](\d+)$',
+    r'^%s:v(\d+)-(?:TxRx|Rx|Tx)$',
+    r'^%s-(\d+)$',
+]
+
+
+def parse_cpu_list(text):
+    """
+    Parses a cpu list such as "0-3,8,10-11" into a sorted list of cpus
+
+    :param text: cpu list in the format used by the kernel
+    """
+    cpus = set()
+    for part in text.replace(' ', '').split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def cpu_mask(cpus):
+    """
+    Returns the hex mask of a list of cpus in the format taken by
+    /proc/irq/N/smp_affinity, rps_cpus and xps_cpus (comma separated
+    groups of 32 bits)
+
+    :param cpus: List of cpu numbers
+    """
+    value = 0
+    for cpu in cpus:
+        value |= 1 << cpu
+    groups = []
+    while True:
+        groups.insert(0, '%08x' % (value & 0xffffffff))
+        value >>= 32
+        if not value:
+            break
+    groups[0] = groups[0].lstrip('0') or '0'
+    return ','.join(groups)
+
+
+def parse_interrupts(text):
+    """
+    Parses the contents of /proc/interrupts. Returns the number of cpus
+    and a list of (irq, name, counts) for every numbered interrupt.
+
+    :param text: Contents of /proc/interrupts
+    """
+    lines = text.splitlines()
+    while lines and not lines[0].strip():
+        lines.pop(0)
+    if not lines:
+        return 0, []
+    ncpus = len([c for c in lines[0].split() if c.startswith('CPU')])
+
+    irqs = []
+    for line in lines[1:]:
+        if ':' not in line:
+            continue
+        irq, rest = line.split(':', 1)
+        if not irq.strip().isdigit():
+            continue
+        fields = rest.split()
+        counts = []
+        for field in fields[:ncpus]:
+            if not field.isdigit():
+                break
+            counts.append(int(field))
+        name = fields[-1] if len(fields) > len(counts) else ''
+        irqs.append((int(irq.strip()), name, counts))
+    return ncpus, irqs
+
+
+def parse_gather(output):
+    """
+    Parses the output of GATHER_COMMAND into a dictionary of interface
+    to (rx queues, tx queues) and the contents of /proc/interrupts
+
+    :param output: Output of GATHER_COMMAND
+    """
+    nics = {}
+    interrupts = ''
+    if INTERRUPTS_MARKER in output:
+        output, interrupts = output.split(INTERRUPTS_MARKER, 1)
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 4 and parts[0] == NIC_MARKER and \
+                parts[2].isdigit() and parts[3].isdigit():
+            nics[parts[1]] = (int(parts[2]), int(parts[3]))
+    return nics, interrupts
+
+
+def queue_vectors(irqs, iface):
+    """
+    Returns the (queue, irq, name) of the queue vectors of an interface
+
+    :param irqs: List of (irq, name, counts) from parse_interrupts
+    :param iface: Interface name
+    """
+    patterns = [re.compile(p % re.escape(iface)) for p in QUEUE_PATTERNS]
+    vectors = []
+    for irq, name, counts in irqs:
+        for pattern in patterns:
+            m = pattern.match(name)
+            if m:
+                vectors.append((int(m.group(1)), irq, name))
+                break
+    return sorted(vectors)
+
+
+def plan_affinity(nics, ncpus, irqs, reserved=(), interfaces=None):
+    """
+    Works out the queue to cpu mapping of every multi-queue interface.
+    The cpus not reserved for the swift workers are split in as many
+    groups as the interface has queues. The vectors of queue N are
+    pinned to the first cpu of group N, whose cpus are also used as the
+    RPS mask of rx-N (only when there are fewer queues than cpus) and
+    the XPS mask of tx-N.
+
+    Returns a dictionary of interface to a dictionary with the vectors
+    ((name, mask) list), rps and xps ((queue, mask) lists).
+
+    :param nics: Dictionary of interface to (rx queues, tx queues)
+    :param ncpus: Number of cpus of the system
+    :param irqs: List of (irq, name, counts) from parse_interrupts
+    :param reserved: cpus kept free of network interrupts
+    :param interfaces: Interfaces to tune (all multi-queue ones if None)
+    """
+    cpus = [c for c in range(ncpus) if c not in reserved]
+    if not cpus:
+        cpus = range(ncpus)
+
+    plan = {}
+    for iface in sorted(nics):
+        if interfaces and iface not in interfaces:
+            continue
+        rx, tx = nics[iface]
+        vectors = queue_vectors(irqs, iface)
+        queues = max([rx, tx] + [q + 1 for q, irq, name in vectors])
+        if queues < 2 or not vectors:
+            continue
+
+        groups = [[] for i in range(min(queues, len(cpus)))]
+        for idx, cpu in enumerate(cpus):
+            groups[idx % len(groups)].append(cpu)
+
+        def group(queue):
+            return groups[queue % len(groups)]
+
+        plan[iface] = {
+            'vectors': [(name, cpu_mask(group(q)[:1]))
+                        for q, irq, name in vectors],
+            'rps': [(q, cpu_mask(group(q)) if queues < len(cpus) else '0')
+                    for q in range(rx)],
+            'xps': [(q, cpu_mask(group(q))) for q in range(tx)],
+        }
+    return plan
+
+
+def affinity_script(plan):
+    """
+    Returns the shell script applying a plan. Vectors are looked up by
+    name when the script runs, since irq numbers may change after a
+    reboot, so the same script is run again at boot time.
+
+    :param plan: Plan as returned by plan_affinity
+    """
+    lines = ['#!/bin/sh',
+             '# NIC queue irq affinity and RPS/XPS masks (swift-setup)',
+             'set_irq() {',
+             '    for irq in $(awk -v n="$1" \'$NF == n {sub(":", "", $1); '
+             'print $1}\' /proc/interrupts); do',
+             '        echo $2 > /proc/irq/$irq/smp_affinity',
+             '    done',
+             '}',
+             'set_queue() {',
+             '    [ -e $1 ] && echo $2 > $1',
+             '}']
+    for iface in sorted(plan):
+        for name, mask in plan[iface]['vectors']:
+            lines.append('set_irq %s %s' % (name, mask))
+        for kind, sysfs in (('rps', 'rx-%d/rps_cpus'),
+                            ('xps', 'tx-%d/xps_cpus')):
+            for queue, mask in plan[iface][kind]:
+                lines.append('set_queue /sys/class/net/%s/queues/%s %s'
+                             % (iface, sysfs % queue, mask))
+    lines.append('exit 0')
+    return '\n'.join(lines) + '\n'
+
+
+class IrqTuner(object):
+    """
+    Spreads the interrupts of the multi-queue NICs of a system over its
+    cpus, keeping off the cpus reserved for the swift workers, and sets
+    the matching RPS/XPS masks. irqbalance is stopped and the generated
+    script is installed so rc.local applies it again at boot time.
+
+    :param reserved: cpu list (e.g: 0-3) kept free of network interrupts
+    :param interfaces: Interfaces to tune (default: every multi-queue one)
+    :param script_path: Where the script is installed on the system
+    """
+
+    def __init__(self, reserved='', interfaces='',
+                 script_path='/usr/local/sbin/swift-irq-affinity'):
+        self.reserved = parse_cpu_list(reserved)
+        self.interfaces = interfaces.split()
+        self.script_path = script_path
+
+    def plan(self, output):
+        """
+        Returns the plan for the output of GATHER_COMMAND
+
+        :param output: Output of GATHER_COMMAND
+        """
+        nics, interrupts = parse_gather(output)
+        ncpus, irqs = parse_interrupts(interrupts)
+        return plan_affinity(nics, ncpus, irqs, self.reserved,
+                             self.interfaces)
+
+    def tune(self):
+        """
+        Gathers the NIC layout of the current host and applies the plan
+        """
+        plan = self.plan(sudo(GATHER_COMMAND))
+        if not plan:
+            return plan
+
+        upload(affinity_script(plan), self.script_path, 0755)
+
+        script = RemoteScript('irq_tuning')
+        script.add('stop irqbalance', 'service irqbalance stop',
+                   check='! pgrep -x irqbalance >/dev/null')
+        script.add('disable irqbalance',
+                   "sed -i 's/^ENABLED=.*/ENABLED=0/' /etc/default/irqbalance",
+                   check='test ! -e /etc/default/irqbalance')
+        script.add('apply affinity', self.script_path, fatal=True,
+                   msg='Unable to apply the NIC irq affinity')
+        script.run()
+        return plan
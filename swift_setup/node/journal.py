@@ -0,0 +1,110 @@
+""" See COPYING for license information """
+
+import os
+import json
+import time
+from hashlib import md5
+from swift_setup.common.exceptions import ResponseError
+
+
+def tree_fingerprint(conf_file, tmpl_dir):
+    """
+    Returns a hash of the configuration file and every file found
+    under the template tree. Any change to either makes the phases
+    recorded with an older fingerprint stale.
+
+    :param conf_file: The configuration file location
+    :param tmpl_dir: The template directory location
+    """
+    h = md5()
+    with open(conf_file, 'rb') as f:
+        h.update(f.read())
+
+    for root, dirs, files in os.walk(tmpl_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            h.update(os.path.relpath(path, tmpl_dir))
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+class DeployJournal(object):
+    """
+    Local journal of the deploy phases completed on every host. Each
+    host has its own file, so the scheduler workers never write to the
+    same file at the same time.
+
+    :param journal_dir: Directory where the journal files are kept
+    :param fingerprint: Hash of the config and template tree in use
+    """
+
+    def __init__(self, journal_dir, fingerprint):
+        self.journal_dir = journal_dir
+        self.fingerprint = fingerprint
+
+        if not os.path.isdir(self.journal_dir):
+            try:
+                os.makedirs(self.journal_dir)
+            except OSError as e:
+                status = 500
+                msg = ('Unable to create journal directory %s (%s)'
+                       % (self.journal_dir, e.strerror))
+                raise ResponseError(status, msg)
+
+    def _path(self, host):
+        return os.path.join(self.journal_dir,
+                            host.replace('/', '_') + '.json')
+
+    def load(self, host):
+        """
+        Returns the phases recorded for a host
+        """
+        try:
+            with open(self._path(host), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def is_done(self, host, phase):
+        """
+        True if the phase has been completed on the host with the same
+        config and templates that are in use now
+        """
+        entry = self.load(host).get(phase)
+        if not entry:
+            return False
+        return (entry.get('status') == 'done' and
+                entry.get('fingerprint') == self.fingerprint)
+
+    def mark(self, host, phase, status, duration=None):
+        """
+        Records the outcome of a phase for a host
+
+        :param status: done or failed
+        :param duration: Seconds the phase took to run
+        """
+        phases = self.load(host)
+        phases[phase] = {'status': status,
+                         'fingerprint': self.fingerprint,
+                         'duration': duration,
+                         'time': time.time()}
+        tmp = self._path(host) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(phases, f, indent=2, sort_keys=True)
+        os.rename(tmp, self._path(host))
+
+    def durations(self):
+        """
+        Returns the durations of every phase completed on any host
+        found on the journal, as a dictionary of phase to list of seconds
+        """
+        durations = {}
+        for name in os.listdir(self.journal_dir):
+            if not name.endswith('.json'):
+                continue
+            for phase, entry in self.load(name[:-5]).items():
+                if entry.get('status') == 'done' and entry.get('duration'):
+                    durations.setdefault(phase, []).append(entry['duration'])
+        return durations
@@ -0,0 +1,100 @@
+""" See COPYING for license information """
+
+import os
+from swift_setup.node.batch import RemoteScript
+
+
+class PackageCache(object):
+    """
+    Flat apt repository kept on the admin node and served by its nginx.
+    The admin downloads every package the cluster needs once (prefetch)
+    and the other nodes are pointed at it before their first apt run,
+    so the same .debs are no longer pulled from upstream by every node.
+
+    :param admin_ip: IP of the admin node serving the cache
+    :param cache_dir: Directory on the admin node holding the .debs
+    :param url_path: Path the cache is served under by nginx
+    :param upstream: Optional directory on the admin node with .debs to
+                     be used instead of the upstream mirrors (e.g: for
+                     test environments without network access)
+    :param priority: apt pin priority given to the cache, at 500 (the
+                     priority of the regular mirrors) apt still picks the
+                     highest version and only prefers the cache on a tie
+    """
+
+    def __init__(self, admin_ip, cache_dir='/srv/debs', url_path='/debs',
+                 upstream='', priority=500):
+        self.admin_ip = admin_ip
+        self.cache_dir = cache_dir.rstrip('/')
+        self.url_path = '/' + url_path.strip('/')
+        self.upstream = upstream.rstrip('/')
+        self.priority = int(priority)
+        self.sources_file = '/etc/apt/sources.list.d/swift-setup-cache.list'
+        self.prefs_file = '/etc/apt/preferences.d/swift-setup-cache'
+        self.nginx_file = '/etc/nginx/swift-setup.d/package-cache.conf'
+
+    def prefetch(self, packages):
+        """
+        Downloads the packages and all their dependencies into the cache,
+        (re)generates the repository index and has nginx serve cache_dir
+        under url_path (picked up by the nginx restart that follows).
+        Runs on the admin node.
+
+        :param packages: List of package names the cluster will install
+        """
+        pkgs = ' '.join(sorted(set(packages)))
+        script = RemoteScript('package_cache_prefetch')
+        script.add('mkdir cache', 'mkdir -p %s' % self.cache_dir,
+                   check='test -d %s' % self.cache_dir)
+        script.add('install dpkg-dev',
+                   'export DEBIAN_FRONTEND=noninteractive; '
+                   'apt-get install -y -qq dpkg-dev')
+
+        if self.upstream:
+            script.add('copy upstream debs',
+                       'cp -u %s/*.deb %s/' % (self.upstream, self.cache_dir),
+                       fatal=True,
+                       msg='No .deb files found under %s' % self.upstream)
+        else:
+            script.add('download packages',
+                       'cd %s && for p in $(apt-cache depends --recurse '
+                       '--no-recommends --no-suggests --no-conflicts '
+                       '--no-breaks --no-replaces --no-enhances %s | '
+                       'grep "^[a-z0-9]" | sort -u); do '
+                       'apt-get download -qq $p >/dev/null 2>&1; done; '
+                       'ls *.deb >/dev/null' % (self.cache_dir, pkgs),
+                       fatal=True,
+                       msg='Unable to download packages into the cache')
+
+        script.add('index cache',
+                   'cd %s && dpkg-scanpackages -m . /dev/null 2>/dev/null '
+                   '| gzip -9c > Packages.gz' % self.cache_dir,
+                   fatal=True, msg='Unable to index the package cache')
+        script.add('chown cache', 'chown -R root.root %s' % self.cache_dir)
+        script.add('nginx location',
+                   'mkdir -p %s && echo "location %s/ { alias %s/; '
+                   'autoindex on; }" > %s'
+                   % (os.path.dirname(self.nginx_file), self.url_path,
+                      self.cache_dir, self.nginx_file), fatal=True,
+                   msg='Unable to write %s' % self.nginx_file)
+        return script.run()
+
+    def point_node(self):
+        """
+        Points the current node at the admin package cache. With the
+        default priority, packages with the same version are taken from
+        the cache while anything missing or newer still comes from the
+        regular mirrors. A priority above 500 makes the cache win even
+        over newer upstream versions.
+        """
+        url = 'http://%s%s' % (self.admin_ip, self.url_path)
+        script = RemoteScript('package_cache_client')
+        script.add('sources list',
+                   'echo "deb [trusted=yes] %s ./" > %s'
+                   % (url, self.sources_file), fatal=True,
+                   msg='Unable to write %s' % self.sources_file)
+        script.add('preferences',
+                   'printf "Package: *\\nPin: origin %s\\n'
+                   'Pin-Priority: %d\\n" > %s'
+                   % (self.admin_ip, self.priority, self.prefs_file))
+        return script.run()
@@ -0,0 +1,126 @@
+""" See COPYING for license information """
+
+"""
+Seconds assumed for a phase that has never been timed on any host.
+The role phases are looked up by their suffix (e.g: proxy_swift_install
+uses swift_install).
+"""
+DEFAULT_ESTIMATES = {
+    'package_cache_client': 2,
+    'common_setup': 300,
+    'pull_configs': 15,
+    'swift_install': 120,
+    'set_onhold': 2,
+    'irq_tuning': 3,
+    'drives': 120,
+    'drive_bench': 60,
+    'final_install_touches': 30,
+    'admin_packages': 60,
+    'admin_repo': 30,
+    'admin_checkout': 5,
+    'admin_bundle': 5,
+    'admin_sync_files': 10,
+    'admin_swift_install': 120,
+    'admin_package_cache': 600,
+    'admin_services': 10,
+    'admin_reboot': 5,
+}
+
+"Seconds a reboot adds to a node before it is usable again"
+REBOOT_ESTIMATE = 180
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def phase_estimate(phase, durations):
+    """
+    Returns the estimated seconds for a phase, the median of the times
+    recorded by previous runs or the default if there is none
+
+    :param phase: Name of the phase
+    :param durations: Dictionary of phase to list of recorded seconds
+    """
+    median = _median(durations.get(phase, []))
+    if median is not None:
+        return median
+    if phase in DEFAULT_ESTIMATES:
+        return DEFAULT_ESTIMATES[phase]
+    for suffix, seconds in DEFAULT_ESTIMATES.items():
+        if phase.endswith('_' + suffix):
+            return seconds
+    return 0
+
+
+def host_estimate(phases, durations, reboot=False):
+    """
+    Returns the estimated seconds for a host to run the given phases
+
+    :param phases: Phases that will run on the host
+    :param durations: Dictionary of phase to list of recorded seconds
+    :param reboot: Whether the host will be rebooted
+    """
+    seconds = sum([phase_estimate(p, durations) for p in phases])
+    if reboot:
+        seconds += REBOOT_ESTIMATE
+    return seconds
+
+
+def wall_estimate(host_seconds, concurrency):
+    """
+    Returns a rough wall clock estimate for the whole deploy, assuming
+    hosts roll through the available slots
+
+    :param host_seconds: List of per host estimates
+    :param concurrency: Number of hosts deployed at the same time
+    """
+    if not host_seconds:
+        return 0
+    slots = max(1, min(concurrency, len(host_seconds)))
+    return max(max(host_seconds), sum(host_seconds) / float(slots))
+
+
+def format_duration(seconds):
+    """
+    Returns seconds as a short human readable string
+    """
+    seconds = int(seconds)
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%dh%02dm' % (seconds // 3600, (seconds % 3600) // 60)
+
+
+def format_host_plan(host, plan):
+    """
+    Returns the lines printed for a single host of a deploy plan
+
+    :param host: Hostname
+    :param plan: Dictionary returned by DeployNode._plan_host
+    """
+    lines = ['%s (~%s)' % (host, format_duration(plan['estimate']))]
+    if plan['missing']:
+        lines.append('    install: %s' % ' '.join(plan['missing']))
+    if plan['upgrades']:
+        lines.append('    upgrade: %d package(s)' % plan['upgrades'])
+    if plan['changed']:
+        lines.append('    files:   %d changed' % len(plan['changed']))
+        for path in plan['changed'][:10]:
+            lines.append('             /%s' % path)
+        if len(plan['changed']) > 10:
+            lines.append('             ... %d more'
+                         % (len(plan['changed']) - 10))
+    if plan['services']:
+        lines.append('    restart: %s' % ' '.join(plan['services']))
+    if plan['reboot']:
+        lines.append('    reboot')
+    lines.append('    phases:  %s' % (' '.join(plan['phases']) or 'none'))
+    return lines
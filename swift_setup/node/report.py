@@ -0,0 +1,168 @@
+""" See COPYING for license information """
+
+import os
+import json
+import time
+from glob import glob
+from fabric import api
+from fabric.api import env
+
+
+class DeployRecorder(object):
+    """
+    Keeps the timing records of every phase and remote command run by
+    a deploy worker. Each record holds the host, phase, command, exit
+    status, bytes transferred and duration.
+    """
+
+    def __init__(self):
+        self.phase = None
+        self.records = []
+
+    def reset(self):
+        self.phase = None
+        self.records = []
+
+    def record(self, kind, command, status, duration, nbytes=0, phase=None):
+        """
+        Appends a record for the current host
+
+        :param kind: phase, command, step or put
+        :param command: The command, step or phase name
+        :param status: Exit status (0 is success)
+        :param duration: Seconds it took
+        :param nbytes: Bytes transferred
+        """
+        self.records.append({'host': env.host_string,
+                             'phase': phase or self.phase,
+                             'type': kind,
+                             'command': command.strip(),
+                             'status': status,
+                             'bytes': nbytes,
+                             'duration': round(duration, 4),
+                             'time': time.time()})
+
+    def _remote(self, func, command, *args, **kwargs):
+        start = time.time()
+        result = func(command, *args, **kwargs)
+        self.record('command', command, result.return_code,
+                    time.time() - start, len(command) + len(result))
+        return result
+
+    def sudo(self, command, *args, **kwargs):
+        return self._remote(api.sudo, command, *args, **kwargs)
+
+    def run(self, command, *args, **kwargs):
+        return self._remote(api.run, command, *args, **kwargs)
+
+    def put(self, local_path, remote_path, *args, **kwargs):
+        start = time.time()
+        result = api.put(local_path, remote_path, *args, **kwargs)
+        nbytes = 0
+        for path in glob(local_path):
+            if os.path.isfile(path):
+                nbytes += os.path.getsize(path)
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    nbytes += os.path.getsize(os.path.join(root, name))
+        self.record('put', '%s -> %s' % (local_path, remote_path),
+                    0 if result.succeeded else 1, time.time() - start,
+                    nbytes)
+        return result
+
+
+"""
+One recorder per process. The scheduler runs each host on its own
+worker process, so the records of a worker always belong to one host.
+"""
+recorder = DeployRecorder()
+sudo = recorder.sudo
+run = recorder.run
+put = recorder.put
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0
+    idx = int(round((pct / 100.0) * (len(values) - 1)))
+    return values[idx]
+
+
+def write_report(path, records):
+    """
+    Writes the records as JSON lines
+
+    :param path: Report file location
+    :param records: List of records gathered from all hosts
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            "Another worker may have just created it"
+            if not os.path.isdir(dirname):
+                raise
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def merge_reports(path, hosts):
+    """
+    Merges the per host reports written by the deploy workers into a
+    single report and returns all records
+
+    :param path: Report file location, host reports are path.HOST
+    :param hosts: List of hosts that were deployed
+    """
+    records = []
+    for host in hosts:
+        part = '%s.%s' % (path, host.replace('/', '_'))
+        if not os.path.isfile(part):
+            continue
+        with open(part, 'r') as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+        os.remove(part)
+    write_report(path, records)
+    return records
+
+
+def summarize(records, slowest=5):
+    """
+    Returns the lines of a summary with the p50/p95/max duration of
+    every phase and the slowest hosts
+
+    :param records: List of records gathered from all hosts
+    :param slowest: Number of slowest hosts to list
+    """
+    phases = {}
+    order = []
+    hosts = {}
+    for r in records:
+        if r['type'] != 'phase':
+            continue
+        if r['command'] not in phases:
+            phases[r['command']] = []
+            order.append(r['command'])
+        phases[r['command']].append(r['duration'])
+        hosts[r['host']] = hosts.get(r['host'], 0) + r['duration']
+
+    lines = ['%-32s %6s %9s %9s %9s'
+             % ('phase', 'hosts', 'p50', 'p95', 'max')]
+    for phase in order:
+        values = phases[phase]
+        lines.append('%-32s %6d %8.1fs %8.1fs %8.1fs'
+                     % (phase, len(values), _percentile(values, 50),
+                        _percentile(values, 95), max(values)))
+
+    if hosts:
+        lines.append('')
+        lines.append('slowest hosts:')
+        ranked = sorted(hosts.items(), key=lambda x: x[1], reverse=True)
+        for host, seconds in ranked[:slowest]:
+            lines.append('  %-30s %8.1fs' % (host, seconds))
+    return lines
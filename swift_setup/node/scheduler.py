@@ -0,0 +1,157 @@
+""" See COPYING for license information """
+
+import time
+from multiprocessing import Process, Queue
+from Queue import Empty
+from swift_setup.common.exceptions import ResponseError
+from fabric.api import env, execute
+from fabric.network import disconnect_all
+
+
+def _run_host_task(task, host, results, args):
+    """
+    Runs a fabric task against a single host. This is what each
+    of the scheduler worker processes will run.
+    """
+    env.parallel = False
+    status = False
+    value = None
+    try:
+        value = execute(task, *args, hosts=[host]).get(host)
+        status = True
+    except ResponseError as e:
+        print "\n\t[%s] %s" % (host, e)
+    except (Exception, SystemExit) as e:
+        print "\n\t[%s] Deploy task has failed (%s)" % (host, e)
+    finally:
+        disconnect_all()
+    results.put((host, status, value))
+
+
+class DeployScheduler(object):
+    """
+    Rolling deploy scheduler. Hosts are split into waves and within a
+    wave a new host is started as soon as a slot frees up, as long as
+    the number of hosts in flight for its zone stays under the cap.
+    Hosts missing from the zone map (proxies, hosts without a zone)
+    are each taken as a zone of their own, so the cap never applies
+    to them and only concurrency limits them.
+
+    :param concurrency: Maximum number of hosts being deployed at once
+    :param zone_concurrency: Maximum number of hosts per zone in flight
+    :param wave_size: Number of hosts per wave (0 means a single wave)
+    :param zone_map: Dictionary mapping each host to its zone
+    """
+
+    def __init__(self, concurrency=5, zone_concurrency=1, wave_size=0,
+                 zone_map=None):
+        self.concurrency = max(1, int(concurrency))
+        self.zone_concurrency = max(1, int(zone_concurrency))
+        self.wave_size = max(0, int(wave_size))
+        self.zone_map = zone_map or {}
+        self.poll_interval = 0.2
+        self.waves = []
+        self.results = {}
+
+    def _zone(self, host):
+        if host in self.zone_map:
+            return self.zone_map[host]
+        return 'host:%s' % host
+
+    def _split_waves(self, host_list):
+        """
+        Splits the host list into waves. Hosts are interleaved by zone
+        so that every wave touches as many zones as possible instead
+        of draining one zone at a time.
+        """
+        zones = {}
+        order = []
+        for host in host_list:
+            zone = self._zone(host)
+            if zone not in zones:
+                zones[zone] = []
+                order.append(zone)
+            zones[zone].append(host)
+
+        interleaved = []
+        while any(zones.values()):
+            for zone in order:
+                if zones[zone]:
+                    interleaved.append(zones[zone].pop(0))
+
+        if not self.wave_size:
+            return [interleaved]
+        return [interleaved[i:i + self.wave_size]
+                for i in range(0, len(interleaved), self.wave_size)]
+
+    def _next_host(self, pending, in_flight):
+        """
+        Returns the first pending host whose zone has a free slot
+        """
+        for host in pending:
+            zone = self._zone(host)
+            busy = len([h for h in in_flight if self._zone(h) == zone])
+            if busy < self.zone_concurrency:
+                return host
+        return None
+
+    def _run_wave(self, task, hosts, args):
+        pending = list(hosts)
+        in_flight = {}
+        results = Queue()
+        statuses = {}
+
+        while pending or in_flight:
+            while pending and len(in_flight) < self.concurrency:
+                host = self._next_host(pending, in_flight)
+                if host is None:
+                    break
+                pending.remove(host)
+                p = Process(target=_run_host_task,
+                            args=(task, host, results, args))
+                p.start()
+                in_flight[host] = p
+
+            try:
+                host, status, value = results.get(
+                    timeout=self.poll_interval)
+                statuses[host] = status
+                self.results[host] = value
+            except Empty:
+                pass
+
+            for host, p in in_flight.items():
+                if not p.is_alive() and host in statuses:
+                    p.join()
+                    del in_flight[host]
+                elif not p.is_alive() and p.exitcode != 0:
+                    "Worker died before reporting back"
+                    p.join()
+                    statuses[host] = False
+                    del in_flight[host]
+        return statuses
+
+    def run(self, task, host_list, *args):
+        """
+        Runs the task against all hosts in the list and returns a
+        dictionary with the deploy status of every host. Whatever the
+        task returns for a host is kept under the results attribute.
+
+        :param task: Fabric task (callable) to be executed
+        :param host_list: List of hosts to deploy
+        """
+        statuses = {}
+        waves = self._split_waves(host_list)
+        self.waves = []
+        self.results = {}
+        for num, hosts in enumerate(waves, 1):
+            start = time.time()
+            wave_status = self._run_wave(task, hosts, args)
+            elapsed = time.time() - start
+            failed = [h for h in hosts if not wave_status.get(h)]
+            self.waves.append({'wave': num, 'hosts': len(hosts),
+                               'failed': failed, 'seconds': elapsed})
+            print ("\n\tWave %d/%d: %d host(s) in %.1fs (%d failed)"
+                   % (num, len(waves), len(hosts), elapsed, len(failed)))
+            statuses.update(wave_status)
+        return statuses
@@ -0,0 +1,254 @@
+""" See COPYING for license information """
+
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import resource
+import tempfile
+from optparse import OptionParser
+from multiprocessing import Value
+from fabric import api
+from fabric.state import connections, output
+from fabric.network import normalize_to_string
+from swift_setup.common.hostvars import FACT_MARKER
+
+
+class SimResult(str):
+    """
+    Stand-in for the result of fabric's run/sudo/put
+    """
+
+    def __new__(cls, body, return_code):
+        obj = str.__new__(cls, body)
+        obj.return_code = return_code
+        obj.failed = return_code != 0
+        obj.succeeded = not obj.failed
+        return obj
+
+
+class SimTransport(object):
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+
+class SimClient(object):
+    """
+    Stand-in for a paramiko SSHClient kept in fabric's connection cache
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.transport = SimTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        if self.transport.active:
+            self.transport.active = False
+            self.executor.closed()
+
+
+class SimExecutor(object):
+    """
+    Replaces every remote operation done by the deploy engine with a
+    simulated one, so DeployNode.deploy_me can run against hosts that
+    do not exist. Each command sleeps for the configured latency, fails
+    at the given rate and returns output of the given size.
+
+    :param latency: Mean seconds per remote command (+/- 50% jitter)
+    :param handshake: Seconds an ssh handshake takes
+    :param failure_rate: Probability of a command failing (0.0 - 1.0)
+    :param output_size: Bytes of output returned by each command
+    """
+
+    marker_re = re.compile(r'echo "?(__[A-Z_]+__)( \d+)?')
+    facts = {'cores': 16, 'mem_kb': 65903232, 'nic_queues': 8, 'drives': 12}
+
+    def __init__(self, latency=0.05, handshake=0.2, failure_rate=0.0,
+                 output_size=256):
+        self.latency = latency
+        self.handshake = handshake
+        self.failure_rate = failure_rate
+        self.output_size = output_size
+        self.open = Value('i', 0)
+        self.peak = Value('i', 0)
+
+    def opened(self):
+        with self.open.get_lock():
+            self.open.value += 1
+            if self.open.value > self.peak.value:
+                self.peak.value = self.open.value
+
+    def closed(self):
+        with self.open.get_lock():
+            self.open.value -= 1
+
+    def connect(self, key):
+        time.sleep(self.handshake)
+        self.opened()
+        client = SimClient(self)
+        dict.__setitem__(connections, normalize_to_string(key), client)
+        return client
+
+    def command(self, command, *args, **kwargs):
+        if api.env.host_string not in connections:
+            connections[api.env.host_string]
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        failed = random.random() < self.failure_rate
+
+        lines = []
+        facts = []
+        if FACT_MARKER in command:
+            facts = ['%s %s %d' % (FACT_MARKER, name, value)
+                     for name, value in sorted(self.facts.items())]
+        if not failed:
+            for marker, idx in self.marker_re.findall(command):
+                if idx:
+                    lines.append('%s%s 0 %d' % (marker, idx,
+                                                self.latency * 1000))
+                elif marker == FACT_MARKER:
+                    lines.extend(facts)
+                    facts = []
+                else:
+                    lines.append(marker)
+        lines.append('x' * self.output_size)
+        return SimResult('\n'.join(lines), int(failed))
+
+    def put(self, local_path, remote_path, *args, **kwargs):
+        return self.command('put %s %s' % (local_path, remote_path))
+
+    def install(self):
+        """
+        Hooks the simulated operations into fabric
+        """
+        api.run = self.command
+        api.sudo = self.command
+        api.put = self.put
+        connections.connect = self.connect
+        for name in output.keys():
+            output[name] = False
+
+
+def _setup_base_dir(base_dir, tmpl_src):
+    """
+    Creates a throw away swift-setup base directory with the sample
+    config, a dummy ssh key and a rendered copy of the templates
+    """
+    from swift_setup.common.templating import TemplateGen
+
+    src_root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    key = os.path.join(base_dir, 'id_rsa')
+    open(key, 'w').close()
+
+    conf = os.path.join(base_dir, 'swift-setup.conf')
+    with open(os.path.join(src_root, 'etc/swift-setup.conf-sample')) as f:
+        body = f.read()
+    body = re.sub(r'(?m)^ssh_key = .*$', 'ssh_key = %s' % key, body)
+    with open(conf, 'w') as f:
+        f.write(body)
+
+    shutil.copytree(tmpl_src or os.path.join(src_root, 'templates'),
+                    os.path.join(base_dir, 'templates'))
+    TemplateGen(conf, base_dir).template_setup()
+    return conf
+
+
+def run_benchmark(hosts, concurrency, sys_type='storage', zones=5,
+                  executor=None, tmpl_src=None):
+    """
+    Deploys the given number of simulated hosts and returns the
+    measurements of the run
+
+    :param hosts: Number of simulated hosts
+    :param concurrency: Number of hosts deployed at the same time
+    :param sys_type: Node type deployed
+    :param zones: Number of zones the hosts are spread over
+    :param executor: SimExecutor used (default settings if None)
+    :param tmpl_src: Template tree used (the repo templates if None)
+    """
+    from swift_setup.node.deploy import DeployNode
+
+    executor = executor or SimExecutor()
+    executor.install()
+    base_dir = tempfile.mkdtemp(prefix='swift-setup-bench.')
+    host_list = ['%s%d-z%d.sim' % (sys_type, i, (i % zones) + 1)
+                 for i in range(hosts)]
+    try:
+        node = DeployNode(_setup_base_dir(base_dir, tmpl_src))
+        node.concurrency = concurrency
+        node.zone_concurrency = concurrency
+        node.reboot = 'never'
+
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        start = time.time()
+        try:
+            ok = node.deploy_me(sys_type, None, host_list)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {'hosts': hosts, 'concurrency': concurrency,
+            'seconds': elapsed, 'ok': ok,
+            'hosts_per_minute': hosts / elapsed * 60 if elapsed else 0,
+            'peak_rss_kb': maxrss,
+            'peak_connections': executor.peak.value}
+
+
+def main():
+    usage = '''
+    python -m swift_setup.node.simulate [options]
+        Runs the deploy engine against simulated hosts and reports
+        hosts/minute, peak memory and open connections for each of
+        the concurrency settings given
+    '''
+    p = OptionParser(usage=usage)
+    p.add_option('-n', '--hosts', type='int', default=100,
+                 help='Number of simulated hosts [default: %default]')
+    p.add_option('-c', '--concurrency', default='5,20,50',
+                 help='Comma separated concurrency settings '
+                      '[default: %default]')
+    p.add_option('-t', '--type', default='storage', dest='sys_type',
+                 help='Node type deployed [default: %default]')
+    p.add_option('-l', '--latency', type='float', default=0.05,
+                 help='Mean seconds per remote command [default: %default]')
+    p.add_option('-s', '--handshake', type='float', default=0.2,
+                 help='Seconds per ssh handshake [default: %default]')
+    p.add_option('-f', '--failure-rate', type='float', default=0.0,
+                 dest='failure_rate',
+                 help='Probability of a command failing [default: %default]')
+    p.add_option('-o', '--output-size', type='int', default=256,
+                 dest='output_size',
+                 help='Bytes of output per command [default: %default]')
+    options, args = p.parse_args()
+
+    print '%12s %8s %10s %12s %12s %8s' % ('concurrency', 'hosts',
+                                           'seconds', 'hosts/min',
+                                           'peak rss', 'conns')
+    for concurrency in [int(c) for c in options.concurrency.split(',')]:
+        executor = SimExecutor(options.latency, options.handshake,
+                               options.failure_rate, options.output_size)
+        r = run_benchmark(options.hosts, concurrency, options.sys_type,
+                          executor=executor)
+        print '%12d %8d %10.1f %12.1f %10dKB %8d' % (
+            r['concurrency'], r['hosts'], r['seconds'],
+            r['hosts_per_minute'], r['peak_rss_kb'], r['peak_connections'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+""" See COPYING for license information """
+
+import os
+import json
+import time
+import gzip
+import shutil
+import cPickle as pickle
+from swift_setup.common.exceptions import RingBuilderError
+
+try:
+    from swift.common.ring import RingBuilder
+except ImportError:
+    RingBuilder = None
+
+
+"Rings managed by swift-setup and the default port of their servers"
+RINGS = ['account', 'container', 'object']
+RING_PORTS = {'account': 6002, 'container': 6001, 'object': 6000}
+
+
+def format_dev(dev):
+    "Device in the swift-ring-builder search value format"
+    return 'r%dz%d-%s:%d/%s' % (dev.get('region', 1), dev['zone'],
+                                dev['ip'], dev['port'], dev['device'])
+
+
+class JsonBuilder(object):
+    """
+    Stand-in for the swift RingBuilder kept as JSON, so inventories and
+    rebalances can be tried out where swift is not installed. Its
+    rebalance is simpler than swift's, but like it, it only moves what
+    the weight changes need and at most one replica of a partition at
+    a time. Its rings are gzipped JSON, which swift cannot read.
+
+    :param part_power: Number of partitions as a power of 2
+    :param replicas: Number of replicas of every partition
+    :param min_part_hours: Hours before a partition can move again
+    """
+
+    def __init__(self, part_power, replicas, min_part_hours):
+        self.part_power = part_power
+        self.replicas = replicas
+        self.min_part_hours = min_part_hours
+        self.devs = []
+        self.devs_changed = False
+        self._replica2part2dev = None
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        builder = cls(data['part_power'], data['replicas'],
+                      data['min_part_hours'])
+        builder.devs = data['devs']
+        builder._replica2part2dev = data.get('replica2part2dev')
+        return builder
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'part_power': self.part_power,
+                       'replicas': self.replicas,
+                       'min_part_hours': self.min_part_hours,
+                       'devs': self.devs,
+                       'replica2part2dev': self._replica2part2dev}, f,
+                      sort_keys=True)
+
+    def add_dev(self, dev):
+        dev = dict(dev)
+        if dev.get('id') is None:
+            dev['id'] = len(self.devs)
+        while len(self.devs) <= dev['id']:
+            self.devs.append(None)
+        if self.devs[dev['id']] is not None:
+            status = 500
+            msg = 'Duplicate device id %d' % dev['id']
+            raise RingBuilderError(status, msg)
+        self.devs[dev['id']] = dev
+        self.devs_changed = True
+        return dev['id']
+
+    def set_dev_weight(self, dev_id, weight):
+        self.devs[dev_id]['weight'] = weight
+        self.devs_changed = True
+
+    def remove_dev(self, dev_id):
+        self.devs[dev_id] = None
+        self.devs_changed = True
+
+    def rebalance(self):
+        """
+        Keeps every partition replica on its device unless the device
+        is gone or already holds a replica of the partition, or the
+        replica shares a zone with another one while a free zone is
+        left. Those replicas go to the devices furthest below their
+        share, in a zone not holding the partition yet if possible.
+        Then, replicas are only moved off the devices above their share
+        onto the ones at least a whole replica below it (e.g: new
+        devices), one replica per partition, so that adding weight
+        moves what is needed to fill it and nothing else. Returns the
+        number of partitions moved and the balance.
+        """
+        devs = [d for d in self.devs if d is not None and d['weight'] > 0]
+        if not devs:
+            status = 500
+            msg = 'No device with a weight to rebalance'
+            raise RingBuilderError(status, msg)
+        parts = 2 ** self.part_power
+        total = sum([d['weight'] for d in devs])
+        want = dict((d['id'], parts * self.replicas * d['weight'] / total)
+                    for d in devs)
+        have = dict((d['id'], 0) for d in devs)
+        zone = dict((d['id'], (d.get('region', 1), d['zone'])) for d in devs)
+        nzones = len(set(zone.values()))
+
+        rows = self._replica2part2dev or \
+            [[None] * parts for r in range(self.replicas)]
+        rows = [list(row) for row in rows]
+        pending = []
+        for part in xrange(parts):
+            kept = set()
+            zones = set()
+            for row in rows:
+                dev = row[part]
+                if dev in want and dev not in kept and \
+                        (zone[dev] not in zones or len(zones) >= nzones):
+                    have[dev] += 1
+                    kept.add(dev)
+                    zones.add(zone[dev])
+                else:
+                    row[part] = None
+                    pending.append((part, row))
+
+        moved = set()
+        for part, row in pending:
+            used = [r[part] for r in rows if r[part] is not None]
+            zones = set([zone[d] for d in used])
+            dev = max(have, key=lambda d: (d not in used,
+                                           zone[d] not in zones,
+                                           want[d] - have[d]))
+            row[part] = dev
+            have[dev] += 1
+            moved.add(part)
+
+        "Weight changes, from the devices above their share only"
+        targets = [d for d in want if want[d] - have[d] >= 1]
+        for part in xrange(parts):
+            if not targets:
+                break
+            if part in moved:
+                continue
+            used = [row[part] for row in rows]
+            for row in rows:
+                src = row[part]
+                if have[src] <= want[src]:
+                    continue
+                others = set([zone[d] for d in used if d != src])
+                fits = [d for d in targets if d not in used and
+                        (zone[d] not in others or zone[src] in others)]
+                if not fits:
+                    continue
+                dev = max(fits, key=lambda d: want[d] - have[d])
+                row[part] = dev
+                have[src] -= 1
+                have[dev] += 1
+                moved.add(part)
+                if want[dev] - have[dev] < 1:
+                    targets.remove(dev)
+                break
+
+        self._replica2part2dev = rows
+        self.devs_changed = False
+        balance = max([abs(have[d] - want[d]) * 100.0 / want[d]
+                       for d in want])
+        return len(moved), balance
+
+    def save_ring(self, path):
+        f = gzip.open(path, 'wb')
+        try:
+            json.dump({'devs': self.devs,
+                       'replica2part2dev': self._replica2part2dev,
+                       'part_shift': 32 - self.part_power}, f)
+        finally:
+            f.close()
+
+
+def active_devs(builder):
+    """
+    Returns the devices of a builder, leaving out the ones removed but
+    still waiting for a rebalance
+
+    :param builder: RingBuilder or JsonBuilder
+    """
+    removed = set([d['id'] for d in getattr(builder, '_remove_devs', [])])
+    return [d for d in builder.devs
+            if d is not None and d['id'] not in removed]
+
+
+def load_builder(path):
+    """
+    Loads a builder file, either a swift one (pickled) or a JsonBuilder
+
+    :param path: Builder file location
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(1)
+        if head == '{':
+            return JsonBuilder.load(path)
+        if RingBuilder is None:
+            status = 500
+            msg = 'swift is needed to load the builder %s' % path
+            raise RingBuilderError(status, msg)
+        if hasattr(RingBuilder, 'load'):
+            return RingBuilder.load(path)
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+    except (IOError, OSError) as e:
+        status = 500
+        msg = '%s (file: %s)' % (e.strerror, path)
+        raise RingBuilderError(status, msg)
+    except (ValueError, KeyError, EOFError, pickle.UnpicklingError):
+        status = 500
+        msg = 'Unable to read the builder %s' % path
+        raise RingBuilderError(status, msg)
+
+    if hasattr(data, 'devs'):
+        return data
+    builder = RingBuilder(1, 1, 1)
+    builder.copy_from(data)
+    return builder
+
+
+def create_builder(builder_format, part_power, replicas, min_part_hours):
+    """
+    Returns a new empty builder
+
+    :param builder_format: swift or json (see JsonBuilder)
+    :param part_power: Number of partitions as a power of 2
+    :param replicas: Number of replicas of every partition
+    :param min_part_hours: Hours before a partition can move again
+    """
+    if builder_format == 'json':
+        return JsonBuilder(part_power, replicas, min_part_hours)
+    if RingBuilder is None:
+        status = 500
+        msg = 'swift is needed to create the ring builders'
+        raise RingBuilderError(status, msg)
+    return RingBuilder(part_power, replicas, min_part_hours)
+
+
+def save_builder(builder, path, backup_dir=None):
+    """
+    Saves a builder through a temporary file and a rename, so readers
+    never see half a builder. Like swift-ring-builder does, the previous
+    file is first copied to backup_dir as <time>.<name>.
+
+    :param builder: RingBuilder or JsonBuilder
+    :param path: Builder file location
+    :param backup_dir: Where the previous builder is copied to
+    """
+    tmp = path + '.tmp'
+    try:
+        if backup_dir and os.path.exists(path):
+            if not os.path.isdir(backup_dir):
+                os.makedirs(backup_dir)
+            shutil.copy2(path, os.path.join(backup_dir, '%d.%s' % (
+                time.time(), os.path.basename(path))))
+        if hasattr(builder, 'save'):
+            builder.save(tmp)
+        else:
+            with open(tmp, 'wb') as f:
+                pickle.dump(builder.to_dict(), f, protocol=2)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        status = 500
+        msg = '%s (file: %s)' % (e.strerror, path)
+        raise RingBuilderError(status, msg)
+
+
+def save_ring(builder, path):
+    """
+    Writes the ring of a rebalanced builder through a temporary file
+    and a rename
+
+    :param builder: RingBuilder or JsonBuilder
+    :param path: Ring file location (e.g: /srv/ring/object.ring.gz)
+    """
+    tmp = path + '.tmp'
+    try:
+        if hasattr(builder, 'get_ring'):
+            builder.get_ring().save(tmp)
+        else:
+            builder.save_ring(tmp)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        status = 500
+        msg = '%s (file: %s)' % (e.strerror, path)
+        raise RingBuilderError(status, msg)
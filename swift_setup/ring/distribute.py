@@ -0,0 +1,168 @@
+""" See COPYING for license information """
+
+import os
+from hashlib import md5
+from swift_setup.common.exceptions import RingBuilderError
+from swift_setup.common.utils import readconf
+from swift_setup.node.scheduler import DeployScheduler
+from fabric.api import env, hide, settings, sudo
+
+
+"Ring files published to the nodes, in the ring.md5sum order"
+RING_FILES = ['account.ring.gz', 'container.ring.gz', 'object.ring.gz']
+MANIFEST = 'ring.md5sum'
+PULL_COMMAND = '/usr/local/bin/swift-ring-pull'
+
+
+def file_md5(path):
+    digest = md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def publish(ring_dir):
+    """
+    Writes the ring.md5sum manifest the nodes pull the rings against.
+    The file is only replaced (through a rename) when a ring has
+    changed, so its ETag stays the same and the nodes keep getting a
+    304 for it. Returns the manifest version (as named by the nodes)
+    and whether it has changed.
+
+    :param ring_dir: Directory served as /ring by the admin nginx
+    """
+    lines = []
+    try:
+        for name in RING_FILES:
+            lines.append('%s  %s\n' % (file_md5(os.path.join(ring_dir,
+                                                             name)), name))
+        body = ''.join(lines)
+        path = os.path.join(ring_dir, MANIFEST)
+        old = None
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                old = f.read()
+        if body != old:
+            with open(path + '.tmp', 'w') as f:
+                f.write(body)
+            os.chmod(path + '.tmp', 0644)
+            os.rename(path + '.tmp', path)
+    except (IOError, OSError) as e:
+        status = 500
+        msg = '%s (file: %s)' % (e.strerror, e.filename)
+        raise RingBuilderError(status, msg)
+    return md5(body).hexdigest()[:12], body != old
+
+
+def parse_pull(output):
+    """
+    Parses the output of swift-ring-pull into (state, version, fetched
+    rings), or None if it has failed
+
+    :param output: Output of swift-ring-pull
+    """
+    for line in reversed(output.splitlines()):
+        parts = line.split()
+        if len(parts) == 4 and parts[0] == 'swift-ring-pull:' and \
+                parts[1] in ('current', 'updated'):
+            fetched = [] if parts[3] == '-' else parts[3].split(',')
+            return parts[1], parts[2], fetched
+    return None
+
+
+def _pull_rings(admin_ip):
+    """
+    Runs swift-ring-pull on the current host. This is what each of the
+    push worker processes will run.
+    """
+    with settings(hide('running', 'stdout', 'stderr'), warn_only=True):
+        result = sudo('%s %s' % (PULL_COMMAND, admin_ip))
+    return result.return_code, str(result)
+
+
+class RingPusher(object):
+    """
+    Publishes the rings of the admin system and has every node pull
+    them at once, at most concurrency nodes at a time. Nodes only
+    download the rings that have changed and swap them all together
+    (see swift-ring-pull).
+
+    :param conf_file: The configuration file location
+    """
+
+    def __init__(self, conf_file):
+        "Info for common section"
+        self.conf = readconf(conf_file, 'common')
+        self.user = self.conf.get('ssh_user', 'swiftops')
+        self.key = self.conf.get('ssh_key', '/home/swiftops/.ssh/id_rsa')
+
+        "Info for swift section"
+        self.conf = readconf(conf_file, 'swift_common')
+        self.admin_ip = self.conf.get('admin_ip', '172.16.0.254')
+
+        "Info for rings section"
+        self.conf = readconf(conf_file, 'rings')
+        self.ring_dir = self.conf.get('builder_dir', '/srv/ring')
+        self.concurrency = max(1, int(self.conf.get('push_concurrency',
+                                                    50)))
+
+    def push(self, host_list):
+        """
+        Returns the published version, whether it has changed and a
+        dictionary of host to (state, version, fetched) as returned by
+        parse_pull, or to the error output of the hosts that have failed
+
+        :param host_list: Hosts that pull the rings
+        """
+        version, changed = publish(self.ring_dir)
+        env.user = self.user
+        env.key_filename = self.key
+        env.warn_only = True
+        env.parallel = False
+        scheduler = DeployScheduler(self.concurrency, self.concurrency)
+        statuses = scheduler.run(_pull_rings, host_list, self.admin_ip)
+
+        hosts = {}
+        for host in host_list:
+            value = scheduler.results.get(host)
+            if not statuses.get(host) or value is None:
+                hosts[host] = 'unreachable'
+                continue
+            code, output = value
+            result = parse_pull(output) if code == 0 else None
+            if result is None:
+                lines = output.strip().splitlines()
+                hosts[host] = lines[-1] if lines else 'exit %d' % code
+            else:
+                hosts[host] = result
+        return version, changed, hosts
+
+
+def format_push(version, hosts):
+    """
+    Returns the lines summing up a push: hosts per ring version with
+    the number of them that were updated, then the failed hosts
+
+    :param version: Version published by the admin system
+    :param hosts: Dictionary of host to result as returned by push
+    """
+    versions = {}
+    failed = []
+    for host in sorted(hosts):
+        result = hosts[host]
+        if isinstance(result, tuple):
+            versions.setdefault(result[1], []).append(result)
+        else:
+            failed.append('%s (%s)' % (host, result))
+    lines = []
+    for ver in sorted(versions, key=lambda v: v != version):
+        results = versions[ver]
+        updated = len([r for r in results if r[0] == 'updated'])
+        lines.append('version %s%s: %d host(s), %d updated'
+                     % (ver, ' (published)' if ver == version else '',
+                        len(results), updated))
+    if failed:
+        lines.append('failed: %d host(s): %s' % (len(failed),
+                                                 ', '.join(failed)))
+    return lines
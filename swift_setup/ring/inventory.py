@@ -0,0 +1,199 @@
+""" See COPYING for license information """
+
+import os
+import re
+import json
+import socket
+from swift_setup.common.exceptions import HostListError
+from swift_setup.common.utils import generate_hosts_list, generate_zone_map
+from swift_setup.ring.builder import RINGS
+
+
+"cXuY or cXuY-Z, units Y to Z of controller X (see the drives section)"
+UNIT_RE = re.compile(r'^c(\d+)u(\d+)(?:-(\d+))?$')
+DEVICE_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+"Options of an inventory line"
+OPTIONS = ['zone', 'region', 'devices', 'weight', 'ip', 'replication_ip',
+           'rings', 'meta']
+
+
+def expand_devices(spec):
+    """
+    Expands a device list such as "c0u0-35,c1u0-11" or "sdb,sdc" into
+    the list of device names
+
+    :param spec: Comma separated device names or cXuY-Z unit ranges
+    """
+    devices = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        m = UNIT_RE.match(part)
+        if m and m.group(3):
+            first, last = int(m.group(2)), int(m.group(3))
+            if last < first:
+                raise ValueError(part)
+            devices += ['c%su%d' % (m.group(1), u)
+                        for u in range(first, last + 1)]
+        elif DEVICE_RE.match(part):
+            devices.append(part)
+        else:
+            raise ValueError(part)
+    return devices
+
+
+def read_bench_weights(report_dir, host):
+    """
+    Returns the weights recommended by the drive benchmark of a host as
+    a dictionary of label to weight, or None if it was not benchmarked
+
+    :param report_dir: Directory holding the drive-bench results
+    :param host: Host as found on the host group files
+    """
+    path = os.path.join(report_dir, 'drive-bench',
+                        '%s.json' % host.replace('/', '_'))
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return dict((d['label'], d['weight']) for d in data.get('drives', []))
+
+
+def parse_inventory(body):
+    """
+    Parses an inventory into a list of (line number, target, options).
+    Every line holds a host, or a host group as @group, followed by
+    key=value options. Blank lines and comments (#) are skipped.
+
+    :param body: Contents of the inventory file
+    """
+    entries = []
+    for num, line in enumerate(body.splitlines(), 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        options = {}
+        for token in parts[1:]:
+            key, sep, value = token.partition('=')
+            options[key] = value if sep else None
+        entries.append((num, parts[0], options))
+    return entries
+
+
+def _number(value, name, minimum=0):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('invalid %s [%s]' % (name, value))
+    if number < minimum:
+        raise ValueError('%s must be at least %d [%s]' % (name, minimum,
+                                                          value))
+    return number
+
+
+def read_inventory(path, base_dir, report_dir, resolve=None):
+    """
+    Reads an inventory file into the list of devices wanted on the
+    rings. Every device is a dictionary with the rings, host, region,
+    zone, ip, replication_ip, device, weight and meta.
+
+    Returns the devices and the list of problems found, every line is
+    checked so all of them are reported at once.
+
+    :param path: Inventory file location
+    :param base_dir: Base location of the swift-setup files (host groups)
+    :param report_dir: Directory holding the drive-bench results, used
+                       by weight=bench
+    :param resolve: Function returning the IP of a host
+    """
+    resolve = resolve or socket.gethostbyname
+    try:
+        with open(path, 'r') as f:
+            entries = parse_inventory(f.read())
+    except IOError as e:
+        return [], ['%s (file: %s)' % (e.strerror, path)]
+
+    devices = []
+    errors = []
+    seen = {}
+    for num, target, options in entries:
+        where = '%s:%d' % (os.path.basename(path), num)
+        try:
+            unknown = [k for k in options if k not in OPTIONS]
+            if unknown:
+                raise ValueError('unknown option(s) %s' % ', '.join(unknown))
+            for key in ('zone', 'devices', 'weight'):
+                if not options.get(key):
+                    raise ValueError('%s is required' % key)
+            names = expand_devices(options['devices'])
+            rings = (options.get('rings') or ','.join(RINGS)).split(',')
+            if [r for r in rings if r not in RINGS]:
+                raise ValueError('invalid rings [%s]' % options['rings'])
+            region = int(_number(options.get('region') or 1, 'region', 1))
+            if options['weight'] != 'bench':
+                weight = _number(options['weight'], 'weight')
+
+            if target.startswith('@'):
+                if options.get('ip') or options.get('replication_ip'):
+                    raise ValueError('ip options are only allowed for '
+                                     'a single host')
+                hosts = generate_hosts_list(base_dir, target[1:])
+            else:
+                hosts = [target]
+            if options['zone'] == 'auto':
+                zones = generate_zone_map(base_dir, hosts)
+            else:
+                zone = int(_number(options['zone'], 'zone'))
+                zones = dict((h, 'zone%d' % zone) for h in hosts)
+        except HostListError as e:
+            errors.append('%s: %s' % (where, e.reason))
+            continue
+        except ValueError as e:
+            errors.append('%s: %s' % (where, e))
+            continue
+
+        for host in hosts:
+            if host not in zones:
+                errors.append('%s: unable to guess the zone of %s'
+                              % (where, host))
+                continue
+            try:
+                ip = options.get('ip') or resolve(host)
+                replication_ip = options.get('replication_ip') or ip
+            except (socket.error, socket.herror, socket.gaierror):
+                errors.append('%s: unable to resolve %s' % (where, host))
+                continue
+
+            weights = None
+            if options['weight'] == 'bench':
+                weights = read_bench_weights(report_dir, host)
+                if weights is None:
+                    errors.append('%s: no drive-bench results for %s'
+                                  % (where, host))
+                    continue
+
+            for name in names:
+                if weights is not None:
+                    if name not in weights:
+                        errors.append('%s: %s/%s was not benchmarked'
+                                      % (where, host, name))
+                        continue
+                    weight = float(weights[name])
+                for ring in rings:
+                    key = (ring, ip, name)
+                    if key in seen:
+                        errors.append('%s: %s/%s already listed on %s for '
+                                      'the %s ring' % (where, host, name,
+                                                       seen[key], ring))
+                seen.update(((ring, ip, name), where) for ring in rings)
+                devices.append({'rings': rings, 'host': host,
+                                'region': region,
+                                'zone': int(zones[host][4:]), 'ip': ip,
+                                'replication_ip': replication_ip,
+                                'device': name, 'weight': weight,
+                                'meta': options.get('meta') or host})
+    return devices, errors
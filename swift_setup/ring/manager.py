@@ -0,0 +1,262 @@
+""" See COPYING for license information """
+
+import os
+from swift_setup.common.exceptions import RingBuilderError
+from swift_setup.common.utils import readconf
+from swift_setup.ring.builder import RINGS, RING_PORTS, active_devs, \
+    load_builder, create_builder, save_builder, format_dev
+from swift_setup.ring.inventory import read_inventory
+from swift_setup.ring.rebalance import parse_size, rebalance_rings
+
+
+def format_plan(plan, details=False):
+    """
+    Returns the lines describing a plan, one summary line per ring and,
+    when details is set, one line per change
+
+    :param plan: Plan as returned by RingManager.plan
+    :param details: List every change
+    """
+    lines = []
+    for ring in RINGS:
+        if ring not in plan:
+            continue
+        p = plan[ring]
+        lines.append('%-9s %5d to add, %5d weight changes, %5d to remove, '
+                     '%5d unchanged%s' % (ring, len(p['add']),
+                                          len(p['weight']),
+                                          len(p['remove']), p['unchanged'],
+                                          ' (new builder)' if p['new']
+                                          else ''))
+        if p['ignored']:
+            lines.append('%-9s %5d devices not in the inventory are left '
+                         'alone (see --prune)' % ('', len(p['ignored'])))
+        if not details:
+            continue
+        for dev in p['add']:
+            lines.append('    add    %s %.2f' % (format_dev(dev),
+                                                 dev['weight']))
+        for dev, weight in p['weight']:
+            lines.append('    weight %s %.2f -> %.2f' % (
+                format_dev(dev), dev['weight'], weight))
+        for dev in p['remove']:
+            lines.append('    remove %s' % format_dev(dev))
+    return lines
+
+
+class RingManager(object):
+    """
+    Applies a device inventory to the account, container and object
+    builders. Every builder is loaded once, gets all its adds, weight
+    changes and removes, and is saved once, instead of the load and
+    save of the whole builder done by each swift-ring-builder call.
+
+    :param conf_file: The configuration file location
+    """
+
+    def __init__(self, conf_file):
+        self.base_dir = os.path.dirname(conf_file)
+
+        "Info for deploy section"
+        self.conf = readconf(conf_file, 'deploy')
+        self.report_dir = self.conf.get('report_dir',
+                                        self.base_dir + '/reports')
+
+        "Info for rings section"
+        self.conf = readconf(conf_file, 'rings')
+        self.builder_dir = self.conf.get('builder_dir', '/srv/ring')
+        self.backup_dir = self.conf.get('backup_dir',
+                                        self.builder_dir + '/backups')
+        self.inventory = self.conf.get('inventory',
+                                       self.base_dir + '/rings.inventory')
+        self.builder_format = self.conf.get('builder_format', 'swift')
+        self.part_power = int(self.conf.get('part_power', 18))
+        self.replicas = int(self.conf.get('replicas', 3))
+        self.min_part_hours = int(self.conf.get('min_part_hours', 1))
+        self.ports = {}
+        for ring in RINGS:
+            self.ports[ring] = int(self.conf.get('%s_port' % ring,
+                                                 RING_PORTS[ring]))
+        self.max_movement = float(self.conf.get('max_movement', 10))
+        self.movement_action = self.conf.get('movement_action', 'refuse')
+        self.used = {}
+        try:
+            for ring in RINGS:
+                self.used[ring] = parse_size(self.conf.get('%s_used' % ring,
+                                                           0))
+        except ValueError as e:
+            status = 500
+            msg = 'Invalid %s_used size [%s]' % (ring, e)
+            raise RingBuilderError(status, msg)
+        if self.builder_format not in ('swift', 'json'):
+            status = 500
+            msg = 'Invalid builder_format [%s]' % self.builder_format
+            raise RingBuilderError(status, msg)
+        if self.movement_action not in ('refuse', 'warn'):
+            status = 500
+            msg = 'Invalid movement_action [%s]' % self.movement_action
+            raise RingBuilderError(status, msg)
+
+    def builder_path(self, ring):
+        return os.path.join(self.builder_dir, '%s.builder' % ring)
+
+    def ring_path(self, ring):
+        return os.path.join(self.builder_dir, '%s.ring.gz' % ring)
+
+    def _check_rings(self, rings):
+        if [r for r in rings if r not in RINGS]:
+            status = 500
+            msg = 'Invalid rings [%s]' % ', '.join(rings)
+            raise RingBuilderError(status, msg)
+
+    def read_inventory(self, path=None):
+        """
+        Returns the devices of the inventory, raising RingBuilderError
+        with every problem found on it
+
+        :param path: Inventory file location (default: inventory option)
+        """
+        devices, errors = read_inventory(path or self.inventory,
+                                         self.base_dir, self.report_dir)
+        if errors:
+            status = 500
+            msg = 'Invalid inventory: %s' % '; '.join(errors)
+            raise RingBuilderError(status, msg)
+        return devices
+
+    def plan(self, devices, rings=None, prune=False):
+        """
+        Loads the builders and works out the changes needed to match
+        the inventory, without touching them. Returns a dictionary of
+        ring to its builder, path, new (builder to be created), add
+        (devices), weight ((device, new weight) list), remove (devices),
+        unchanged (count) and ignored (devices not in the inventory).
+        Raises RingBuilderError listing every conflict, so no builder
+        is saved unless all of them can be changed.
+
+        :param devices: Devices as returned by read_inventory
+        :param rings: Rings to plan for (default: all of them)
+        :param prune: Remove the devices that are not in the inventory
+        """
+        rings = rings or RINGS
+        self._check_rings(rings)
+
+        plan = {}
+        errors = []
+        for ring in rings:
+            path = self.builder_path(ring)
+            new = not os.path.exists(path)
+            if new:
+                builder = create_builder(self.builder_format,
+                                         self.part_power, self.replicas,
+                                         self.min_part_hours)
+            else:
+                builder = load_builder(path)
+
+            current = {}
+            for dev in active_devs(builder):
+                current[(dev['ip'], dev['port'], dev['device'])] = dev
+
+            p = {'builder': builder, 'path': path, 'new': new, 'add': [],
+                 'weight': [], 'remove': [], 'unchanged': 0, 'ignored': []}
+            wanted = set()
+            for dev in devices:
+                if ring not in dev['rings']:
+                    continue
+                port = self.ports[ring]
+                key = (dev['ip'], port, dev['device'])
+                wanted.add(key)
+                old = current.get(key)
+                if old is None:
+                    p['add'].append({
+                        'region': dev['region'], 'zone': dev['zone'],
+                        'ip': dev['ip'], 'port': port,
+                        'replication_ip': dev['replication_ip'],
+                        'replication_port': port,
+                        'device': dev['device'], 'weight': dev['weight'],
+                        'meta': dev['meta']})
+                elif old['zone'] != dev['zone'] or \
+                        old.get('region', 1) != dev['region']:
+                    errors.append('%s: %s is on r%dz%d, moving it needs a '
+                                  'remove and a rebalance first'
+                                  % (ring, format_dev(old),
+                                     old.get('region', 1), old['zone']))
+                elif abs(old['weight'] - dev['weight']) > 0.005:
+                    p['weight'].append((old, dev['weight']))
+                else:
+                    p['unchanged'] += 1
+
+            for key in sorted(current):
+                if key not in wanted:
+                    if prune:
+                        p['remove'].append(current[key])
+                    else:
+                        p['ignored'].append(current[key])
+            plan[ring] = p
+
+        if errors:
+            status = 500
+            msg = 'Conflicts with the builders: %s' % '; '.join(errors)
+            raise RingBuilderError(status, msg)
+        return plan
+
+    def apply(self, plan):
+        """
+        Applies a plan to the builders loaded by plan and saves each of
+        the changed ones once. Returns the rings that were saved.
+
+        :param plan: Plan as returned by plan
+        """
+        saved = []
+        for ring in RINGS:
+            p = plan.get(ring)
+            if not p or not (p['new'] or p['add'] or p['weight'] or
+                             p['remove']):
+                continue
+            builder = p['builder']
+            next_id = len(builder.devs)
+            for dev in p['add']:
+                dev = dict(dev, id=next_id)
+                next_id += 1
+                builder.add_dev(dev)
+            for dev, weight in p['weight']:
+                builder.set_dev_weight(dev['id'], weight)
+            for dev in p['remove']:
+                builder.remove_dev(dev['id'])
+            save_builder(builder, p['path'], self.backup_dir)
+            saved.append(ring)
+        return saved
+
+    def rebalance(self, rings=None, dry_run=False, force=False):
+        """
+        Rebalances the builders at the same time, one process each, and
+        reports how many partition replicas move per device and zone.
+        A builder whose rebalance moves more than max_movement percent
+        of its replicas is not saved when movement_action is refuse,
+        unless force is set. Returns a dictionary of ring to (report,
+        error), see rebalance_ring.
+
+        :param rings: Rings to rebalance (default: all of them)
+        :param dry_run: Only report the movement, nothing is saved
+        :param force: Save the builders whatever the movement
+        """
+        rings = rings or RINGS
+        self._check_rings(rings)
+
+        if dry_run:
+            save = 'never'
+        elif force or self.movement_action == 'warn':
+            save = 'always'
+        else:
+            save = 'threshold'
+
+        jobs = {}
+        for ring in rings:
+            if not os.path.exists(self.builder_path(ring)):
+                status = 404
+                msg = 'Builder not found (%s)' % self.builder_path(ring)
+                raise RingBuilderError(status, msg)
+            jobs[ring] = (self.builder_path(ring), self.ring_path(ring),
+                          self.backup_dir, self.max_movement,
+                          self.used[ring], save)
+        return rebalance_rings(jobs)
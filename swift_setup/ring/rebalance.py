@@ -0,0 +1,230 @@
+""" See COPYING for license information """
+
+import re
+import time
+from multiprocessing import Process, Queue
+from Queue import Empty
+from swift_setup.common.exceptions import ResponseError
+from swift_setup.ring.builder import load_builder, save_builder, \
+    save_ring, format_dev
+
+
+"Value of a partition replica not assigned to any device"
+NONE_DEV = 2 ** 16 - 1
+
+SIZE_RE = re.compile(r'^(\d+(?:\.\d+)?)\s*([KMGTP]?)B?$', re.I)
+UNITS = 'KMGTP'
+
+
+def parse_size(value):
+    """
+    Returns the number of bytes of a size such as 500G or 1.5T
+
+    :param value: Size with an optional K, M, G, T or P suffix
+    """
+    m = SIZE_RE.match(str(value).strip())
+    if not m:
+        raise ValueError(value)
+    power = UNITS.index(m.group(2).upper()) + 1 if m.group(2) else 0
+    return int(float(m.group(1)) * 1024 ** power)
+
+
+def format_size(count):
+    """
+    Returns a byte count in a short human readable form (e.g: 1.2T)
+
+    :param count: Number of bytes
+    """
+    value = float(count)
+    unit = ''
+    for u in UNITS:
+        if value < 1024:
+            break
+        value /= 1024
+        unit = u
+    return '%.1f%s' % (value, unit)
+
+
+def assignment(builder):
+    """
+    Returns a copy of the replica to partition to device id table of a
+    builder, or None if it has never been rebalanced
+
+    :param builder: RingBuilder or JsonBuilder
+    """
+    rows = getattr(builder, '_replica2part2dev', None)
+    if not rows:
+        return None
+    return [list(row) for row in rows]
+
+
+def movement(before, after, devs):
+    """
+    Compares two partition replica assignments. Returns a dictionary
+    with the number of replicas, the partitions and replicas moved, and
+    the replicas gained and lost by every device and zone, as
+    dictionaries of device (see format_dev) or zone to [gained, lost].
+
+    :param before: Assignment before the rebalance (None if new)
+    :param after: Assignment after the rebalance
+    :param devs: Dictionary of device id to device, old and new ones
+    """
+    devices = {}
+    zones = {}
+
+    def _count(dev_id, idx):
+        if dev_id is None or dev_id == NONE_DEV:
+            return
+        dev = devs.get(dev_id)
+        if dev:
+            name = format_dev(dev)
+            zone = 'r%dz%d' % (dev.get('region', 1), dev['zone'])
+        else:
+            name = zone = 'id%d' % dev_id
+        devices.setdefault(name, [0, 0])[idx] += 1
+        zones.setdefault(zone, [0, 0])[idx] += 1
+
+    replicas = 0
+    moved = 0
+    moved_parts = set()
+    for idx, row in enumerate(after or []):
+        old = before[idx] if before and idx < len(before) else []
+        replicas += len(row)
+        for part, dev_id in enumerate(row):
+            prev = old[part] if part < len(old) else None
+            if prev != dev_id:
+                moved += 1
+                moved_parts.add(part)
+                _count(dev_id, 0)
+                _count(prev, 1)
+    return {'replicas': replicas, 'moved': moved,
+            'moved_parts': len(moved_parts), 'devices': devices,
+            'zones': zones}
+
+
+def rebalance_ring(ring, builder_path, ring_path, backup_dir,
+                   max_movement=10.0, used=0, save='threshold'):
+    """
+    Rebalances a builder in memory and works out how much it moves.
+    The builder and its ring are then saved according to save: never,
+    always or threshold (only if the replicas moved stay within
+    max_movement percent, or the ring is built for the first time).
+
+    Returns the movement (see movement) along with the ring, balance,
+    percent (of the replicas moved), bytes (to be replicated), duration,
+    new, exceeded and saved.
+
+    :param ring: Ring name
+    :param builder_path: Builder file location
+    :param ring_path: Ring file location
+    :param backup_dir: Where the previous builder is copied to
+    :param max_movement: Percentage of the replicas allowed to move
+    :param used: Bytes held by the ring, to estimate the bytes moved
+    :param save: never, always or threshold
+    """
+    start = time.time()
+    builder = load_builder(builder_path)
+    before = assignment(builder)
+    devs = dict((d['id'], dict(d)) for d in builder.devs if d is not None)
+    balance = builder.rebalance()[1]
+    devs.update((d['id'], dict(d)) for d in builder.devs if d is not None)
+
+    report = movement(before, assignment(builder), devs)
+    replicas = report['replicas'] or 1
+    report.update(ring=ring, balance=balance, new=before is None,
+                  percent=report['moved'] * 100.0 / replicas,
+                  bytes=int(used * report['moved'] / replicas))
+    report['exceeded'] = not report['new'] and \
+        report['percent'] > max_movement
+    report['saved'] = save == 'always' or \
+        (save == 'threshold' and not report['exceeded'])
+    if report['saved']:
+        save_builder(builder, builder_path, backup_dir)
+        save_ring(builder, ring_path)
+    report['duration'] = time.time() - start
+    return report
+
+
+def _rebalance_task(results, ring, args):
+    """
+    Rebalances a single ring. This is what each of the rebalance worker
+    processes will run.
+    """
+    try:
+        results.put((ring, rebalance_ring(ring, *args), None))
+    except ResponseError as e:
+        results.put((ring, None, e.reason))
+    except Exception as e:
+        results.put((ring, None, '%s: %s' % (e.__class__.__name__, e)))
+
+
+def rebalance_rings(jobs, poll_interval=0.2):
+    """
+    Rebalances the rings at the same time, one process per builder,
+    since the builders are independent. Returns a dictionary of ring
+    to (report, error).
+
+    :param jobs: Dictionary of ring to the rebalance_ring arguments
+                 following the ring name
+    """
+    results = Queue()
+    workers = {}
+    for ring, args in jobs.items():
+        p = Process(target=_rebalance_task, args=(results, ring, args))
+        p.start()
+        workers[ring] = p
+
+    done = {}
+    while len(done) < len(workers):
+        try:
+            ring, report, error = results.get(timeout=poll_interval)
+            done[ring] = (report, error)
+        except Empty:
+            for ring, p in workers.items():
+                if ring not in done and not p.is_alive() and \
+                        results.empty():
+                    "Worker died before reporting back"
+                    done[ring] = (None, 'rebalance process exited with %s'
+                                  % p.exitcode)
+    for p in workers.values():
+        p.join()
+    return done
+
+
+def format_movement(ring, report, error=None, details=False):
+    """
+    Returns the lines describing the rebalance of a ring, with the
+    replicas gained and lost by every zone and, when details is set,
+    by every device
+
+    :param ring: Ring name
+    :param report: Report as returned by rebalance_ring
+    :param error: Why the rebalance has failed
+    :param details: List the movement of every device
+    """
+    if error:
+        return ['%-9s rebalance has failed: %s' % (ring, error)]
+    if report['saved']:
+        state = 'saved'
+    elif report['exceeded']:
+        state = 'NOT saved, above max_movement'
+    else:
+        state = 'not saved'
+    lines = ['%-9s %d of %d replicas moved (%.2f%%) on %d partitions, '
+             '%s to replicate, balance %.2f, %.1fs [%s]'
+             % (ring, report['moved'], report['replicas'],
+                report['percent'], report['moved_parts'],
+                format_size(report['bytes']) if report['bytes'] else '?',
+                report['balance'], report['duration'], state)]
+    if report['new']:
+        lines.append('%-9s first rebalance, every replica is placed' % '')
+        return lines
+    groups = [('zone', report['zones'])]
+    if details:
+        groups.append(('device', report['devices']))
+    for kind, counts in groups:
+        for name in sorted(counts):
+            gained, lost = counts[name]
+            lines.append('    %-6s %-30s +%-8d -%d' % (kind, name, gained,
+                                                      lost))
+    return lines
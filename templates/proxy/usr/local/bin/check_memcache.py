@@ -26,16 +26,19 @@ Authors:
 '''
 
 
-import memcache
+import os
+import math
 import optparse
 import time
 import socket
+import threading
+from ConfigParser import RawConfigParser
 from subprocess import call
 
 def main():
     restart_attempted = False
     restarted = ''
-    usage = "usage: %prog [-h host] [-p port] [-s|-d] OR %prog [-m host1:port,host2:port,...] [-d]"
+    usage = "usage: %prog [-h host] [-p port] [-s|-d] OR %prog [-m host1:port,host2:port,...] [-d] OR %prog -P [-m host1:port,...] [-z]"
     p = optparse.OptionParser(usage)
     p.add_option('--host', '-H', default="127.0.0.1", help="Default = 127.0.0.1")
     p.add_option('--port', '-p', default="11211", help="Default = 11211")
@@ -44,7 +47,25 @@ def main():
     p.add_option('--multihost', '-m', default=False, help="(host:port,host:port,...)")
     p.add_option('--zenoss', '-z', action='store_true', help="output in a zenoss friendly format")
     p.add_option('--fix','-f', action='store_true', help="try to fix by restarting")
+    p.add_option('--probe', '-P', action='store_true', help="measure the get/set latency of every server (-m or memcache_server_list of --conf)")
+    p.add_option('--conf', default="/etc/swift/proxy-server.conf", help="Default = /etc/swift/proxy-server.conf")
+    p.add_option('--rounds', '-n', type='int', default=20, help="get/set round trips per server, Default = 20")
+    p.add_option('--timeout', '-t', type='float', default=1.0, help="seconds, Default = 1.0")
+    p.add_option('--warning', '-w', type='float', default=50.0, help="p99 latency warning in ms, Default = 50")
+    p.add_option('--critical', '-c', type='float', default=250.0, help="p99 latency critical in ms, Default = 250")
+    p.add_option('--max-errors', '-e', type='float', default=10.0, help="critical when this percent of the round trips fail, Default = 10")
     options, arguments = p.parse_args()
+    if options.probe is True:
+        if options.multihost is not False:
+            servers = options.multihost.split(",")
+        else:
+            servers = conf_servers(options.conf)
+        if not servers:
+            print "No memcache servers to probe"
+            exit(3)
+        results = probe(servers, options.rounds, options.timeout)
+        exit(probe_report(results, options.warning, options.critical,
+                          options.max_errors, options.zenoss))
     if options.multihost is not False:
         servers = options.multihost.split(",")
         result = mconnect(servers, options.stats, options.debug)
@@ -82,7 +103,155 @@ def main():
                 time.sleep(5)
             exit(2)
 
+def conf_servers(conf_file):
+    """
+    Returns the memcache_server_list of the cache filter of a proxy
+    server config
+    """
+    c = RawConfigParser()
+    if not c.read(conf_file) or \
+            not c.has_option('filter:cache', 'memcache_server_list'):
+        return []
+    servers = c.get('filter:cache', 'memcache_server_list')
+    return [s.strip() for s in servers.split(',') if s.strip()]
+
+
+def percentile(values, pct):
+    "Nearest-rank percentile of a sorted list"
+    if not values:
+        return None
+    idx = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(idx, len(values) - 1))]
+
+
+def probe_server(server, rounds, timeout, results):
+    """
+    Sends rounds pipelined set and get of a probe key to server over a
+    raw socket, timing every round trip, and stores in results the
+    sorted latencies (seconds) along with the timeouts and errors
+    """
+    host, port = server.rsplit(':', 1)
+    key = 'check_memcache_%s_%d' % (socket.gethostname(), os.getpid())
+    latencies = []
+    timeouts = 0
+    errors = 0
+    sock = None
+    for i in range(rounds):
+        value = '%d.%d' % (i, time.time() * 1000000)
+        request = ('set %s 0 60 %d\r\n%s\r\nget %s\r\n'
+                   % (key, len(value), value, key))
+        expected = ('STORED\r\nVALUE %s 0 %d\r\n%s\r\nEND\r\n'
+                    % (key, len(value), value))
+        try:
+            if sock is None:
+                sock = socket.create_connection((host, int(port)), timeout)
+            start = time.time()
+            sock.sendall(request)
+            response = ''
+            while not response.endswith('END\r\n') and not \
+                    ('ERROR' in response and response.endswith('\r\n')):
+                data = sock.recv(4096)
+                if not data:
+                    raise socket.error('connection closed')
+                response += data
+            elapsed = time.time() - start
+            if response != expected:
+                raise socket.error('unexpected response')
+            latencies.append(elapsed)
+            continue
+        except socket.timeout:
+            timeouts += 1
+        except (socket.error, ValueError):
+            errors += 1
+        "The connection is in an unknown state, use a new one"
+        if sock is not None:
+            sock.close()
+            sock = None
+    if sock is not None:
+        sock.close()
+    latencies.sort()
+    results[server] = {'rounds': rounds, 'latencies': latencies,
+                       'timeouts': timeouts, 'errors': errors}
+
+
+def probe(servers, rounds=20, timeout=1.0):
+    """
+    Probes all the servers at the same time, one thread each. Returns
+    a dictionary of server to probe_server results.
+    """
+    results = {}
+    threads = []
+    for server in servers:
+        t = threading.Thread(target=probe_server,
+                             args=(server, rounds, timeout, results))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return results
+
+
+def probe_status(result, warning, critical, max_errors):
+    """
+    Returns 0 (ok), 1 (warning) or 2 (critical) for the results of a
+    server, warning and critical being p99 latencies in ms
+    """
+    failed = result['timeouts'] + result['errors']
+    p99 = percentile(result['latencies'], 99)
+    if p99 is None or failed * 100.0 / result['rounds'] >= max_errors or \
+            p99 * 1000 >= critical:
+        return 2
+    if failed or p99 * 1000 >= warning:
+        return 1
+    return 0
+
+
+def probe_report(results, warning, critical, max_errors, zenoss=False):
+    """
+    Prints the latency percentiles, timeouts and errors of every server
+    and returns the exit status, the worst of the servers
+    """
+    names = ['OK', 'WARNING', 'CRITICAL']
+    worst = 0
+    lines = []
+    problems = []
+    perf = []
+    for server in sorted(results):
+        r = results[server]
+        status = probe_status(r, warning, critical, max_errors)
+        worst = max(worst, status)
+        stats = {}
+        for label, value in (('p50', percentile(r['latencies'], 50)),
+                             ('p99', percentile(r['latencies'], 99)),
+                             ('max', r['latencies'][-1]
+                              if r['latencies'] else None)):
+            stats[label] = '-' if value is None else '%.2fms' % (value * 1000)
+        line = ('%s p50=%s p99=%s max=%s timeouts=%d errors=%d/%d'
+                % (server, stats['p50'], stats['p99'], stats['max'],
+                   r['timeouts'], r['errors'], r['rounds']))
+        lines.append('%s %s' % (line, names[status].lower()))
+        if status:
+            problems.append(line)
+        if stats['p99'] != '-':
+            perf.append("'%s p50'=%s '%s p99'=%s;%s;%s"
+                        % (server, stats['p50'], server, stats['p99'],
+                           warning, critical))
+        perf.append("'%s failed'=%d" % (server, r['timeouts'] + r['errors']))
+
+    if zenoss is True:
+        summary = '; '.join(problems) or '%d servers' % len(results)
+        print 'MEMCACHED %s - %s | %s' % (names[worst], summary,
+                                         ' '.join(perf))
+    else:
+        for line in lines:
+            print line
+        print 'check:%s' % ['ok', 'warning', 'failed'][worst]
+    return worst
+
+
 def mconnect(servers, collectstats, debug):
+    import memcache
     try:
         mc = memcache.Client(servers, debug)
         stats = mc.get_stats()
@@ -105,6 +274,7 @@ def single_connect(host, port, collectstats, debug):
     server = host + ":" + port
     if debug:
         print "-> %s" % server
+    import memcache
     try:
         sc = memcache.Client([server], debug)
         stats = sc.get_stats()
@@ -19,24 +19,42 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
 
-import memcache
 import optparse
 import time
 import socket
+import struct
 import os,sys
 
+
+"Counters sampled by --interval, shown as per second rates"
+RATES = [('get/s', 'cmd_get'), ('set/s', 'cmd_set'),
+         ('evict/s', 'evictions'), ('read/s', 'bytes_read'),
+         ('written/s', 'bytes_written'), ('conn/s', 'total_connections')]
+COLUMNS = [label for label, key in RATES] + ['hit%', 'conns']
+
+
 def main():
 
-    usage = "usage: %prog [-s] [-d] "
+    usage = "usage: %prog [-s] [-d] OR %prog -i SECONDS [-n COUNT] [-o FILE]"
     p = optparse.OptionParser(usage)
     p.add_option('--stats', '-s', action="store_true", help="Full dump of stats command")
     p.add_option('--debug', '-d', action="store_true", help="Verbose mode")
     p.add_option('--connections', '-c', action="store_true", help="Just return connections value")
+    p.add_option('--port', '-p', type='int', default=None, help="Only the servers listening on this port (default: the memcached processes, or else 11211)")
+    p.add_option('--interval', '-i', type='float', default=None, help="Sample the rates of every server each INTERVAL seconds")
+    p.add_option('--count', '-n', type='int', default=0, help="Stop after COUNT samples (default: run until interrupted)")
+    p.add_option('--output', '-o', default=None, help="Append the samples to FILE as a time series instead of the table")
 
     options, arguments = p.parse_args()
 
-    server = find_bound()
-    mc_conn = single_connect(server, options.debug)
+    servers = find_servers(options.port)
+    if not servers:
+        print "Could not determined if memcache is bound to any ip/port \n"
+        sys.exit(1)
+
+    if options.interval:
+        sample(servers, options.interval, options.count, options.output)
+        sys.exit(0)
 
     if options.connections and options.stats :
         print "\n\t Only -s or -c can be specified at once "
@@ -44,27 +62,204 @@ def main():
 
     if options.connections:
         stat_type=1
-        get_info(mc_conn, stat_type)
     elif options.stats:
         stat_type=2
-        get_info(mc_conn, stat_type)
     else:
         stat_type=3
+    for server in servers:
+        if len(servers) > 1:
+            print "\n\t Server -> %s" % server
+        mc_conn = single_connect(server, options.debug)
         get_info(mc_conn, stat_type)
        
     sys.exit(0) 
 
 
-def find_bound():
-    mc_bound = os.popen("netstat -ntl4 | grep 11211 | awk '{ print $4}' | tr -d '\n' ").readlines()
-    if len(mc_bound) == 1 :
-        bind_ip,bind_port = mc_bound[0].split(':')
-        server = bind_ip + ":" + bind_port
-    else:
-        print "Could not determined if memcache is bound to any ip/port \n"
-        sys.exit(1)
+def proc_address(hex_addr):
+    """
+    Converts an address of /proc/net/tcp{,6} (hex words in host order)
+    to host:port, with IPv6 hosts in brackets
+    """
+    hex_ip, hex_port = hex_addr.split(':')
+    packed = ''.join([struct.pack('=I', int(hex_ip[i:i + 8], 16))
+                      for i in range(0, len(hex_ip), 8)])
+    port = int(hex_port, 16)
+    if len(packed) == 4:
+        return socket.inet_ntoa(packed), port
+    return '[%s]' % socket.inet_ntop(socket.AF_INET6, packed), port
+
+
+def listening_sockets():
+    "Returns the inode to (host, port) of the listening TCP sockets"
+    sockets = {}
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            lines = open(path).readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 9 and fields[3] == '0A':
+                sockets[fields[9]] = proc_address(fields[1])
+    return sockets
+
 
-    return server
+def memcached_inodes():
+    "Returns the inodes of the sockets held by memcached processes"
+    inodes = set()
+    for pid in [d for d in os.listdir('/proc') if d.isdigit()]:
+        try:
+            if open('/proc/%s/comm' % pid).read().strip() != 'memcached':
+                continue
+            fd_dir = '/proc/%s/fd' % pid
+            for fd in os.listdir(fd_dir):
+                target = os.readlink(os.path.join(fd_dir, fd))
+                if target.startswith('socket:['):
+                    inodes.add(target[8:-1])
+        except (IOError, OSError):
+            continue
+    return inodes
+
+
+def find_servers(port=None):
+    """
+    Returns host:port of every listening memcached, from /proc/net/tcp
+    and tcp6. Without port, the sockets of the memcached processes are
+    used, or the ones on 11211 when those cannot be told (not root).
+    Wildcard addresses are reached through the loopback.
+    """
+    sockets = listening_sockets()
+    if port is None:
+        inodes = memcached_inodes() & set(sockets)
+        if inodes:
+            sockets = dict([(i, sockets[i]) for i in inodes])
+        else:
+            port = 11211
+    if port is not None:
+        sockets = dict([(i, a) for i, a in sockets.items() if a[1] == port])
+
+    loopback = {'0.0.0.0': '127.0.0.1', '[::]': '[::1]'}
+    v4_ports = set([p for h, p in sockets.values() if not h.startswith('[')])
+    servers = []
+    for host, p in sorted(set(sockets.values())):
+        if host == '[::]' and p in v4_ports:
+            continue
+        servers.append('%s:%d' % (loopback.get(host, host), p))
+    return servers
+
+
+def get_stats(server, timeout=2.0):
+    "Returns the output of the stats command of server as a dictionary"
+    host, port = server.rsplit(':', 1)
+    sock = socket.create_connection((host.strip('[]'), int(port)), timeout)
+    try:
+        sock.sendall('stats\r\n')
+        response = ''
+        while not response.endswith('END\r\n'):
+            data = sock.recv(65536)
+            if not data:
+                raise socket.error('connection closed')
+            response += data
+    finally:
+        sock.close()
+    stats = {}
+    for line in response.splitlines():
+        parts = line.split(' ', 2)
+        if len(parts) == 3 and parts[0] == 'STAT':
+            stats[parts[1]] = parts[2]
+    return stats
+
+
+def rates(before, after, elapsed):
+    """
+    Returns the rates between two stats of a server along with the hit
+    rate of the interval and the open connections, or None when the
+    server has been restarted in between
+    """
+    if int(after['uptime']) < int(before['uptime']) or elapsed <= 0:
+        return None
+    result = {}
+    for label, key in RATES:
+        result[label] = (int(after[key]) - int(before[key])) / elapsed
+    "Leaving out the connection get_stats opened for the sample"
+    result['conn/s'] = max(0, result['conn/s'] - 1 / elapsed)
+    gets = int(after['cmd_get']) - int(before['cmd_get'])
+    hits = int(after['get_hits']) - int(before['get_hits'])
+    result['hit%'] = hits * 100.0 / gets if gets else None
+    result['conns'] = int(after['curr_connections'])
+    return result
+
+
+def format_rate(label, value):
+    if value is None:
+        return '-'
+    if label in ('read/s', 'written/s'):
+        for unit in ['', 'K', 'M', 'G']:
+            if value < 1024:
+                break
+            value /= 1024.0
+        return '%.1f%s' % (value, unit)
+    if label == 'conns':
+        return '%d' % value
+    return '%.1f' % value
+
+
+def sample(servers, interval, count=0, output=None):
+    """
+    Samples the stats of every server each interval seconds and shows
+    the rates over the last interval, as a table or appended to output
+    as one line per server and sample (epoch, server and COLUMNS)
+    """
+    out = None
+    if output:
+        out = open(output, 'a')
+        if out.tell() == 0:
+            out.write('# time server %s\n' % ' '.join(COLUMNS))
+    previous = {}
+    samples = 0
+    lines = 0
+    try:
+        while True:
+            start = time.time()
+            for server in servers:
+                try:
+                    now = time.time()
+                    stats = get_stats(server)
+                except (socket.error, socket.timeout):
+                    previous.pop(server, None)
+                    if out is None:
+                        print '%s  %-21s unreachable' % (
+                            time.strftime('%H:%M:%S'), server)
+                    continue
+                prev = previous.get(server)
+                previous[server] = (now, stats)
+                if prev is None:
+                    continue
+                result = rates(prev[1], stats, now - prev[0])
+                if result is None:
+                    continue
+                if out is not None:
+                    out.write('%.1f %s %s\n' % (now, server, ' '.join(
+                        ['-' if result[c] is None else '%.1f' % result[c]
+                         for c in COLUMNS])))
+                    continue
+                if lines % 20 == 0:
+                    print '%-9s %-21s %s' % ('time', 'server', ' '.join(
+                        ['%9s' % c for c in COLUMNS]))
+                print '%-9s %-21s %s' % (time.strftime('%H:%M:%S'), server,
+                                         ' '.join(['%9s' % format_rate(
+                                             c, result[c]) for c in COLUMNS]))
+                lines += 1
+            if out is not None:
+                out.flush()
+            samples += 1
+            if count and samples > count:
+                break
+            time.sleep(max(0, interval - (time.time() - start)))
+    except KeyboardInterrupt:
+        pass
+    if out is not None:
+        out.close()
 
 
 
@@ -72,6 +267,7 @@ def single_connect(server, debug):
 
     if debug:
         print "\n\t Connecting to Server -> %s" % server
+    import memcache
 
     try:
         sc = memcache.Client([server], debug)
@@ -105,7 +301,7 @@ def get_info (mc_conn, stat_type):
         print "\t Set Count " + stats[0][1]['cmd_set']
         print "\t Get Hits " + stats[0][1]['get_hits']
         print "\t Get Misses " + stats[0][1]['get_misses']
-        print "\t Cache HitRate %.5f" % ( float(stats[0][1]['get_hits']) / float(stats[0][1]['cmd_get']) )
+        print "\t Cache HitRate (lifetime) %.5f" % ( float(stats[0][1]['get_hits']) / float(stats[0][1]['cmd_get']) )
         print "\n" 
 
  
@@ -1,51 +1,152 @@
 #!/usr/bin/python
 
+import os
+import sys
+import json
 from sys import exit
+from optparse import OptionParser
+from hashlib import md5
 from smtplib import SMTP
 from socket import gethostname
-from swift.common.constraints import check_mount
-from swift.common.utils import whataremyips
-from swift.common.ring import Ring
 
 
-try:
-    ring = Ring('/etc/swift/object.ring.gz')
-except IOError:
-    exit()
+RINGS = ['account', 'container', 'object']
+SWIFT_DIR = '/etc/swift'
+CACHE_FILE = '/var/cache/swift/drive_mount_check.json'
 
 
-my_ips = whataremyips()
-mounted = 0
-drivecount = 0
-drivelabels = []
+def file_md5(path):
+    digest = md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-for dev in ring.devs:
+
+def ring_stamp(path):
+    st = os.stat(path)
+    return [os.path.realpath(path), st.st_mtime, st.st_size]
+
+
+def default_cache_file():
+    """
+    Returns CACHE_FILE when it can be written by the current user (the
+    agent runs as root) or a file in the home directory otherwise (e.g:
+    run from cron as swiftops with a root owned /var/cache/swift)
+    """
+    cache_dir = os.path.dirname(CACHE_FILE)
+    if os.access(CACHE_FILE, os.W_OK) or \
+            (not os.path.exists(CACHE_FILE) and
+             os.access(cache_dir, os.W_OK)):
+        return CACHE_FILE
+    return os.path.join(os.path.expanduser('~'),
+                        '.' + os.path.basename(CACHE_FILE))
+
+
+def local_devices(swift_dir=SWIFT_DIR, cache_file=CACHE_FILE, my_ips=None,
+                  warn=None):
+    """
+    Returns a dictionary of the devices of this node that have a weight
+    in any of the rings to the rings they are in. The index is kept in
+    cache_file and the rings are only loaded again to rebuild it when
+    one of them has changed (mtime, then md5) or the node IPs have.
+    When cache_file cannot be written, every call loads all the rings,
+    so the failure is passed to warn (printed on stderr by default).
+    """
+    from swift.common.utils import whataremyips
+    my_ips = sorted(my_ips or whataremyips())
     try:
-        if dev['ip'] in my_ips and float(dev['weight']) > 0:
-            drivecount += 1
-            if check_mount('/srv/node', dev['device']):
-                mounted += 1
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    old_rings = cache.get('rings', {})
+
+    rings = {}
+    stale = cache.get('ips') != my_ips
+    for ring in RINGS:
+        path = os.path.join(swift_dir, '%s.ring.gz' % ring)
+        if not os.path.exists(path):
+            continue
+        stamp = ring_stamp(path)
+        old = old_rings.get(ring)
+        if old and old['stamp'] == stamp:
+            rings[ring] = old
+            continue
+        digest = file_md5(path)
+        if not old or old['md5'] != digest:
+            stale = True
+        rings[ring] = {'stamp': stamp, 'md5': digest}
+    if sorted(rings) != sorted(old_rings):
+        stale = True
+
+    devices = cache.get('devices', {})
+    if stale:
+        from swift.common.ring import Ring
+        devices = {}
+        for ring in sorted(rings):
+            for dev in Ring(os.path.join(swift_dir,
+                                         '%s.ring.gz' % ring)).devs:
+                try:
+                    if dev['ip'] in my_ips and float(dev['weight']) > 0:
+                        devices.setdefault(dev['device'], []).append(ring)
+                except TypeError:
+                    pass
+
+    if stale or rings != old_rings:
+        tmp = cache_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'ips': my_ips, 'rings': rings,
+                           'devices': devices}, f)
+            os.rename(tmp, cache_file)
+        except (IOError, OSError) as e:
+            msg = 'Unable to write the device cache %s: %s' % (
+                cache_file, e.strerror)
+            if warn:
+                warn(msg)
             else:
-                drivelabels.append(dev['device'])
-    except TypeError:
-        pass
-
-unmounted = drivecount - mounted
-
-if unmounted > 0:
-    outdomain = '$OUTGOING_DOMAIN'
-    fromaddr = 'swift-alert@' + outdomain
-    toaddr = '$EMAIL_ADDR'
-    subject = 'Drive(s) not mounted found on %s' % (gethostname(), )
-    header = ('From: %s\r\nTo: %s\r\nSubject: %s\r\n\r\n'
-              % (fromaddr, toaddr, subject))
-    body = ('Unmounted drive(s) %s with labels %s'
-            % (unmounted, ' '.join(drivelabels)))
-    msg = header + body
-
-    server = SMTP('localhost')
-    server.set_debuglevel(0)
-    server.sendmail(fromaddr, toaddr, msg)
-    server.quit()
-
-exit(0)
+                sys.stderr.write(msg + '\n')
+    return devices
+
+
+def main():
+    from swift.common.constraints import check_mount
+
+    p = OptionParser(usage='%prog [-c CACHE_FILE]')
+    p.add_option('-c', '--cache', default=None,
+                 help='Local device index [default: %s if writable, '
+                      'else ~/.%s]' % (CACHE_FILE,
+                                       os.path.basename(CACHE_FILE)))
+    options, args = p.parse_args()
+
+    try:
+        devices = local_devices(cache_file=options.cache or
+                                default_cache_file())
+    except IOError:
+        exit()
+    drivelabels = [d for d in sorted(devices)
+                   if not check_mount('/srv/node', d)]
+    unmounted = len(drivelabels)
+
+    if unmounted > 0:
+        outdomain = '$OUTGOING_DOMAIN'
+        fromaddr = 'swift-alert@' + outdomain
+        toaddr = '$EMAIL_ADDR'
+        subject = 'Drive(s) not mounted found on %s' % (gethostname(), )
+        header = ('From: %s\r\nTo: %s\r\nSubject: %s\r\n\r\n'
+                  % (fromaddr, toaddr, subject))
+        body = ('Unmounted drive(s) %s with labels %s'
+                % (unmounted, ' '.join(drivelabels)))
+        msg = header + body
+
+        server = SMTP('localhost')
+        server.set_debuglevel(0)
+        server.sendmail(fromaddr, toaddr, msg)
+        server.quit()
+
+    exit(0)
+
+
+if __name__ == '__main__':
+    main()